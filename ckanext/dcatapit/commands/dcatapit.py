@@ -36,15 +36,45 @@ def initdb():
               help='Limit number of processed datasets during data migration')
 @click.option('-s', '--skip-orgs', is_flag=True,
               help='Skip organizations in data migration')
-def migrate_110(offset, limit, skip_orgs=False):
-    migrate110.do_migrate_data(limit=limit, offset=offset, skip_orgs=skip_orgs)
+@click.option('-w', '--workers', default=0, type=int,
+              help='Number of processes migrating the datasets in parallel')
+@click.option('-c', '--checkpoint', default=None, type=click.Path(dir_okay=False),
+              help='File recording the migrated datasets, used to resume an interrupted migration')
+@click.option('--chunk-size', default=migrate110.DEFAULT_CHUNK_SIZE, type=int,
+              help='Number of datasets migrated in a single transaction')
+def migrate_110(offset, limit, skip_orgs=False, workers=0, checkpoint=None, chunk_size=migrate110.DEFAULT_CHUNK_SIZE):
+    migrate110.do_migrate_data(limit=limit, offset=offset, skip_orgs=skip_orgs,
+                               workers=workers, checkpoint=checkpoint, chunk_size=chunk_size)
 
 
 @dcatapit.command(help='Migrate to 2.0.0 (themes are encoded in a different named field)')
 @click.option('-f', '--fix-old', is_flag=True, default=False,
               help='Try and fix datasets in older 1.0.0 format')
-def migrate_200(fix_old):
-    migrate200.migrate(fix_old)
+@click.option('--reindex/--no-reindex', default=True,
+              help='Reindex the migrated datasets, default: reindex')
+def migrate_200(fix_old, reindex):
+    migrate200.migrate(fix_old, reindex=reindex)
+
+
+@dcatapit.command(help='Apply the theme to group mapping to all the datasets')
+@click.option('--chunk-size', default=500, type=int,
+              help='Number of datasets processed and committed at once')
+@click.option('-c', '--clean', is_flag=True, default=False,
+              help='Remove the datasets from the groups not in the mapping')
+@click.option('--reindex/--no-reindex', default=True,
+              help='Reindex the updated datasets, default: reindex')
+def theme_groups(chunk_size, clean, reindex):
+    from ckan.lib import search
+    from ckanext.dcatapit.mapping import populate_theme_groups_bulk
+
+    count = 0
+    for package_ids in populate_theme_groups_bulk(chunk_size=chunk_size, clean_existing=clean):
+        count += len(package_ids)
+        if reindex and package_ids:
+            search.rebuild(package_ids=list(package_ids), defer_commit=True)
+    if reindex and count:
+        search.commit()
+    click.secho(f'{count} datasets updated', fg=u"green")
 
 
 @dcatapit.command(help='Load an RDF vocabulary into the DB')
@@ -78,3 +108,18 @@ def load(filename, url, format, eurovoc, name):
         log.warning(f'Option "name" is deprecated and unused.')
 
     load_voc(filename, url, eurovoc, format=format)
+
+
+@dcatapit.command(help='Export the whole catalog as RDF, one dataset at a time')
+@click.option('-o', '--output', required=True, type=click.File('w', encoding='utf-8'),
+              help='Output file ("-" for stdout)')
+@click.option('--format', 'format_', default='xml', type=click.Choice(['xml', 'ttl', 'nt']),
+              help='Serialization format, default: xml')
+@click.option('--page-size', default=100, type=int,
+              help='Number of datasets fetched from the search index at once')
+def export(output, format_, page_size):
+    from ckanext.dcatapit.dcat.stream import StreamingCatalogSerializer, iter_catalog_datasets
+
+    serializer = StreamingCatalogSerializer(format_, page_size=page_size)
+    for chunk in serializer.serialize(iter_catalog_datasets(page_size=page_size)):
+        output.write(chunk)
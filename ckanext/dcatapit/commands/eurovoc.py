@@ -0,0 +1,146 @@
+import logging
+import os
+import xml.etree.ElementTree as ET
+
+from rdflib import Graph, URIRef
+from rdflib.namespace import OWL, SKOS
+
+from ckanext.dcat.profiles import DCT
+
+log = logging.getLogger(__name__)
+
+# element and attribute names, in ElementTree notation
+RDF_ABOUT = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+RDF_RESOURCE = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+PREF_LABEL = '{http://www.w3.org/2004/02/skos/core#}prefLabel'
+HAS_TOP_CONCEPT = '{http://www.w3.org/2004/02/skos/core#}hasTopConcept'
+VERSION_INFO = '{http://www.w3.org/2002/07/owl#}versionInfo'
+IDENTIFIER = '{http://purl.org/dc/terms/}identifier'
+
+
+class EurovocConcept(object):
+    __slots__ = ('uri', 'labels', 'version', 'identifier', 'children')
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.labels = {}
+        self.version = ''
+        self.identifier = ''
+        self.children = []
+
+
+class EurovocIndex(object):
+    """
+    In-memory index of the EuroVoc concepts reachable from a set of root concepts.
+
+    Only labels, version, identifier and hasTopConcept children are kept, so that
+    the whole EuroVoc graph never needs to be loaded.
+    """
+
+    def __init__(self, concepts):
+        self.concepts = concepts
+
+    def get(self, uri):
+        return self.concepts.get(str(uri))
+
+    def __len__(self):
+        return len(self.concepts)
+
+    @classmethod
+    def load(cls, source, roots):
+        """
+        Build the index for the concepts reachable from `roots`.
+
+        Local RDF/XML files are streamed twice: the first pass only collects the
+        hierarchy, the second one the details of the reachable concepts.
+        Other sources are parsed with rdflib.
+        """
+        roots = [str(r) for r in roots]
+        if isinstance(source, str) and os.path.isfile(source):
+            try:
+                return cls._from_rdfxml(source, roots)
+            except ET.ParseError as e:
+                log.info(f'EuroVoc file is not RDF/XML ({e}), parsing it as a graph')
+
+        g = Graph()
+        g.parse(source)
+        return cls.from_graph(g, roots)
+
+    @classmethod
+    def from_graph(cls, g, roots):
+        concepts = {}
+        for uri in _reachable(roots, lambda u: [str(c) for c in g.objects(URIRef(u), SKOS.hasTopConcept)]):
+            ref = URIRef(uri)
+            concept = EurovocConcept(uri)
+            for pref_label in g.objects(ref, SKOS.prefLabel):
+                concept.labels[pref_label.language] = str(pref_label)
+            concept.version = str(g.value(ref, OWL.versionInfo) or '')
+            concept.identifier = str(g.value(ref, DCT.identifier) or '')
+            concept.children = [str(c) for c in g.objects(ref, SKOS.hasTopConcept)]
+            concepts[uri] = concept
+        return cls(concepts)
+
+    @classmethod
+    def _from_rdfxml(cls, path, roots):
+        children = {}
+        for uri, elem in _iter_nodes(path):
+            for prop in elem:
+                if prop.tag == HAS_TOP_CONCEPT and prop.get(RDF_RESOURCE):
+                    children.setdefault(uri, []).append(prop.get(RDF_RESOURCE))
+
+        reachable = set(_reachable(roots, lambda u: children.get(u, [])))
+
+        concepts = {}
+        for uri, elem in _iter_nodes(path):
+            if uri not in reachable:
+                continue
+            concept = concepts.get(uri)
+            if concept is None:
+                concept = concepts[uri] = EurovocConcept(uri)
+                concept.children = children.get(uri, [])
+            for prop in elem:
+                if prop.tag == PREF_LABEL:
+                    concept.labels[prop.get(XML_LANG, elem.get(XML_LANG))] = prop.text or ''
+                elif prop.tag == VERSION_INFO:
+                    concept.version = prop.text or ''
+                elif prop.tag == IDENTIFIER:
+                    concept.identifier = prop.text or ''
+
+        log.debug(f'Loaded {len(concepts)} EuroVoc concepts')
+        return cls(concepts)
+
+
+def _reachable(roots, get_children):
+    seen = set()
+    stack = list(reversed(roots))
+    while stack:
+        uri = stack.pop()
+        if uri in seen:
+            continue
+        seen.add(uri)
+        yield uri
+        stack.extend(reversed(get_children(uri)))
+
+
+def _iter_nodes(path):
+    """
+    Yields (uri, element) for each top level node element of an RDF/XML file.
+
+    Elements are discarded once consumed, so memory does not depend on the file size.
+    """
+    depth = 0
+    root = None
+    for event, elem in ET.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = elem
+            depth += 1
+            continue
+
+        depth -= 1
+        if depth == 1:
+            uri = elem.get(RDF_ABOUT)
+            if uri:
+                yield uri, elem
+            root.clear()
@@ -1,5 +1,7 @@
 import json
 import logging
+import multiprocessing
+import os
 import uuid
 from datetime import datetime
 
@@ -8,7 +10,6 @@ from sqlalchemy import and_
 import ckan.plugins.toolkit as toolkit
 from ckan.lib.base import config
 from ckan.lib.navl.dictization_functions import Invalid
-from ckan.logic import ValidationError
 from ckan.logic.validators import tag_name_validator
 from ckan.model.meta import Session
 from ckan.model import (
@@ -24,6 +25,7 @@ from ckanext.multilang.model import PackageMultilang as ML_PM
 from ckanext.dcatapit.schema import FIELD_THEMES_AGGREGATE
 from ckanext.dcatapit import validators
 import ckanext.dcatapit.interfaces as interfaces
+from ckanext.dcatapit.model import detach_db_connections
 
 REGION_TYPE = 'https://w3id.org/italia/onto/CLV/Region'
 NAME_TYPE = 'https://w3id.org/italia/onto/l0/name'
@@ -31,26 +33,36 @@ NAME_TYPE = 'https://w3id.org/italia/onto/l0/name'
 DEFAULT_LANG = config.get('ckan.locale_default', 'en')
 DATE_FORMAT = '%d-%m-%Y'
 
+# packages migrated in a single transaction
+DEFAULT_CHUNK_SIZE = 100
+
+# migration context and schema, created once per process
+_migration = {}
+
 log = logging.getLogger(__name__)
 
 
-def do_migrate_data(limit=None, offset=None, skip_orgs=False, pkg_uuid: list = None):
-    # Data migrations from 1.0.0 to 1.1.0
-    # ref: https://github.com/geosolutions-it/ckanext-dcatapit/issues/188
+def do_migrate_data(limit=None, offset=None, skip_orgs=False, pkg_uuid: list = None,
+                    workers=0, checkpoint=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Data migrations from 1.0.0 to 1.1.0
 
-    from ckanext.dcatapit.plugin import DCATAPITPackagePlugin
+    Packages are migrated in chunks of `chunk_size`, each one in a single transaction;
+    with `workers` > 1 chunks are migrated in parallel by a pool of processes.
+    If a `checkpoint` file is given, the outcome of each package is appended to it
+    once its chunk is committed, and packages already migrated are skipped, so that
+    an interrupted migration can be resumed.
+
+    :returns: the number of migrated packages
+    """
+    # ref: https://github.com/geosolutions-it/ckanext-dcatapit/issues/188
 
     user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
     context = {'user': user['name'],
                'ignore_auth': True,
                'use_cache': False}
-    pshow = toolkit.get_action('package_show')
-    pupdate = toolkit.get_action('package_update')
-    pcreate = toolkit.get_action('package_create')
     oshow = toolkit.get_action('organization_show')
     oupdate = toolkit.get_action('organization_patch')
-    pupdate_schema = DCATAPITPackagePlugin().update_package_schema()
-    pupdate_schema['tags']['name'].remove(tag_name_validator)
     org_list = get_organization_list()
     ocount = org_list.count()
     oidx = 0
@@ -78,90 +90,202 @@ def do_migrate_data(limit=None, offset=None, skip_orgs=False, pkg_uuid: list = N
                 # oupdate(ocontext, {'id': odata['id'],
                 #                  'identifier': tmp_identifier})
                 update_organization_identifier(odata['id'], tmp_identifier)
+        Session.commit()
     else:
         log.info(u'Skipping organizations processing')
-    pcontext = context.copy()
+
     pkg_list = get_package_list(pkg_uuid)
     pcount = pkg_list.count()
     log.info(f'processing {pcount} packages')
-    errored = []
 
     if offset:
         pkg_list = pkg_list.offset(offset)
     if limit:
         pkg_list = pkg_list.limit(limit)
+    pkg_ids = [pkg_id for (pkg_id,) in pkg_list]
+
+    if checkpoint:
+        done = read_checkpoint(checkpoint)
+        if done:
+            log.info(f'skipping {len(done)} packages already migrated according to {checkpoint}')
+            pkg_ids = [pkg_id for pkg_id in pkg_ids if pkg_id not in done]
+    # the worker processes must not share the parent transaction
+    Session.commit()
+
+    chunks = [pkg_ids[idx:idx + chunk_size] for idx in range(0, len(pkg_ids), chunk_size)]
+    if workers > 1 and chunks:
+        log.info(f'migrating {len(pkg_ids)} packages in {len(chunks)} chunks with {workers} processes')
+        pool = multiprocessing.get_context('fork').Pool(workers, initializer=detach_db_connections)
+        results = pool.imap_unordered(migrate_chunk, chunks)
+    else:
+        pool = None
+        results = map(migrate_chunk, chunks)
 
     # pidx may be not initialized for empty slice, need separate counter
     # to count actually processed datasets
     pidx_count = 0
-    for pidx, pname in enumerate(pkg_list):
-        pcontext['schema'] = pupdate_schema
-        pname = pname[0]
-        log.info(f'processing {pidx + 1}/{pcount} package: {pname}')
-        pdata = pshow(context, {'name_or_id': pname})  # , 'use_default_schema': True})
-
-        # remove empty conforms_to to avoid silly validation errors
-        if not pdata.get('conforms_to'):
-            pdata.pop('conforms_to', None)
-        # ... the same for alternate_identifier
-        if not pdata.get('alternate_identifier'):
-            pdata.pop('alternate_identifier', None)
-
-        update_creator(pdata)
-        update_temporal_coverage(pdata)
-        update_theme(pdata)
-        update_identifier(pdata)
-        update_modified(pdata)
-        update_frequency(pdata)
-        update_conforms_to(pdata)
-        update_holder_info(pdata)
-        interfaces.populate_resource_license(pdata)
-        pdata['metadata_modified'] = None
-        log.info(f"updating {pdata['id']} {pdata['name']}")
-        try:
-            out = pupdate(pcontext, pdata)
-            pidx_count += 1
-        except ValidationError as err:
-            log.error(
-                f"Cannot update due to validation error {pdata['name']}",
-                exc_info=True
-            )
-            errored.append((pidx, pdata['name'], err,))
-            continue
-
-        except Exception as err:
-            log.error(
-                f"Cannot update due to general error {pdata['name']}",
-                exc_info=True
-            )
-            errored.append((pidx, pdata['name'], err,))
-            continue
-        log.debug('-' * 9)
+    errored = []
+    try:
+        for migrated, failed in results:
+            pidx_count += len(migrated)
+            errored.extend(failed)
+            if checkpoint:
+                write_checkpoint(checkpoint, migrated, failed)
+            log.info(f'processed {pidx_count + len(errored)}/{len(pkg_ids)} packages')
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     if not skip_orgs:
         log.info(f'processed {oidx} out of {ocount} organizations')
     log.info(f'processed {pidx_count} out of {pcount} packages in total')
     if errored:
         log.info(f'Following {len(errored)} datasets failed:')
-        for position, ptitile, err in errored:
-            err_summary = getattr(err, 'error', None) or err
+        for pkg_id, pname, err_summary in errored:
+            log.info(f' {pname} ({pkg_id}): {err_summary}')
+    return pidx_count
+
+
+def migrate_chunk(pkg_ids):
+    """
+    Migrates the packages in a single transaction.
+
+    If the chunk fails, also while committing (e.g. when indexing), the transaction is
+    rolled back and the packages are migrated again one per transaction, so that only
+    the failing ones are reported.
+
+    :returns: tuple (list of migrated ids, list of (id, name, error summary) of failed packages)
+    """
+    context, pupdate_schema = _get_migration_context()
+    try:
+        for pkg_id in pkg_ids:
+            migrate_package(context, pupdate_schema, pkg_id)
+        Session.commit()
+        return list(pkg_ids), []
+    except Exception:
+        log.warning(f'Cannot migrate a chunk of {len(pkg_ids)} packages, migrating them one by one',
+                    exc_info=True)
+        Session.rollback()
+
+    migrated = []
+    failed = []
+    for pkg_id in pkg_ids:
+        try:
+            migrate_package(context, pupdate_schema, pkg_id)
+            Session.commit()
+            migrated.append(pkg_id)
+        except Exception as err:
+            log.error(f'Cannot update package {pkg_id}', exc_info=True)
+            Session.rollback()
+            failed.append((pkg_id, _get_package_name(pkg_id), _error_summary(err)))
+    return migrated, failed
 
-            # this is a hack on dumb override in __str__() in some exception subclasses
-            # stringified exception raises itself otherwise.
+
+def migrate_package(context, pupdate_schema, pkg_id):
+    pshow = toolkit.get_action('package_show')
+    pupdate = toolkit.get_action('package_update')
+
+    pcontext = dict(context, schema=pupdate_schema, defer_commit=True)
+    pdata = pshow(context.copy(), {'name_or_id': pkg_id})  # , 'use_default_schema': True})
+
+    # remove empty conforms_to to avoid silly validation errors
+    if not pdata.get('conforms_to'):
+        pdata.pop('conforms_to', None)
+    # ... the same for alternate_identifier
+    if not pdata.get('alternate_identifier'):
+        pdata.pop('alternate_identifier', None)
+
+    update_creator(pdata)
+    update_temporal_coverage(pdata)
+    update_theme(pdata)
+    update_identifier(pdata)
+    update_modified(pdata)
+    update_frequency(pdata)
+    update_conforms_to(pdata)
+    update_holder_info(pdata)
+    interfaces.populate_resource_license(pdata)
+    pdata['metadata_modified'] = None
+    log.info(f"updating {pdata['id']} {pdata['name']}")
+    pupdate(pcontext, pdata)
+    log.debug('-' * 9)
+
+
+def _get_migration_context():
+    if 'context' not in _migration:
+        from ckanext.dcatapit.plugin import DCATAPITPackagePlugin
+
+        user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
+        pupdate_schema = DCATAPITPackagePlugin().update_package_schema()
+        pupdate_schema['tags']['name'].remove(tag_name_validator)
+        _migration['context'] = ({'user': user['name'],
+                                  'ignore_auth': True,
+                                  'use_cache': False},
+                                 pupdate_schema)
+    return _migration['context']
+
+
+def _get_package_name(pkg_id):
+    pkg = Session.query(Package.name).filter(Package.id == pkg_id).first()
+    return pkg.name if pkg else pkg_id
+
+
+def _error_summary(err):
+    err_summary = getattr(err, 'error_dict', None) or getattr(err, 'error', None) or err
+
+    # this is a hack on dumb override in __str__() in some exception subclasses
+    # stringified exception raises itself otherwise.
+    try:
+        return f'{err.__class__}{err_summary}'
+    except Exception as str_err:
+        return f'{err.__class__}{str_err}'
+
+
+def read_checkpoint(path):
+    """
+    Returns the ids of the packages marked as migrated in the checkpoint file
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
             try:
-                log.info(
-                    f' {ptitile} at position {position}: {err.__class__}{err_summary}'
-                )
-            except Exception as err:
-                err_summary = err
-                log.error(
-                    f' {ptitile} at position {position}: {err.__class__}{err_summary}'
-                )
-    return pidx_count
+                entry = json.loads(line)
+            except ValueError:
+                # truncated line, written while the migration was interrupted
+                continue
+            if entry.get('status') == 'migrated':
+                done.add(entry['id'])
+            else:
+                done.discard(entry['id'])
+    return done
+
+
+def write_checkpoint(path, migrated, failed):
+    """
+    Appends the outcome of a committed chunk to the checkpoint file
+    """
+    lines = [json.dumps({'id': pkg_id, 'status': 'migrated'}) for pkg_id in migrated]
+    lines.extend(json.dumps({'id': pkg_id, 'name': pname, 'status': 'error', 'error': err_summary})
+                 for pkg_id, pname, err_summary in failed)
+
+    # binary mode, as text files do not support seeking relative to the end
+    with open(path, 'ab+') as f:
+        # do not append to a line truncated by an interrupted migration
+        f.seek(0, os.SEEK_END)
+        if f.tell() > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+        for line in lines:
+            f.write(line.encode('utf-8') + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
 
 
 def get_package_list(pkg_uuid=None):
-    query = Session.query(Package.name)\
+    query = Session.query(Package.id)\
                 .filter(Package.state.in_(['active', 'draft']),
                         Package.type == 'dataset')
 
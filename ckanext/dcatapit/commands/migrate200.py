@@ -6,6 +6,7 @@ from datetime import datetime
 from sqlalchemy import and_
 
 import ckan.plugins.toolkit as toolkit
+from ckan.lib import search
 from ckan.lib.base import config
 from ckan.lib.navl.dictization_functions import Invalid
 from ckan.logic import ValidationError
@@ -19,6 +20,8 @@ from ckan.model import (
     repo,
 )
 
+from ckanext.dcatapit.mapping import themes_to_aggr_json
+from ckanext.dcatapit.model.subtheme import Subtheme
 from ckanext.dcatapit.schema import FIELD_THEMES_AGGREGATE
 from ckanext.dcatapit import validators
 import ckanext.dcatapit.interfaces as interfaces
@@ -29,14 +32,24 @@ NAME_TYPE = 'https://w3id.org/italia/onto/l0/name'
 DEFAULT_LANG = config.get('ckan.locale_default', 'en')
 DATE_FORMAT = '%d-%m-%Y'
 
+# theme used when an obsolete theme value can't be parsed
+DEFAULT_THEME = 'OP_DATPRO'
+
+# extras converted, and datasets reindexed, at once
+DEFAULT_BATCH_SIZE = 500
+
 log = logging.getLogger(__name__)
 
 
-def migrate(fix_old=False):
+def migrate(fix_old=False, reindex=True):
     # Data migrations from 1.1.0 to 2.0.0
 
-    cnt_migrated = migrate_themes()
-    cnt_obsolete_found, cnt_obsolete_migrated = check_obsolete_themes(fix_old)
+    cnt_migrated, migrated_ids = migrate_themes()
+    cnt_obsolete_found, cnt_obsolete_migrated, obsolete_ids = check_obsolete_themes(fix_old)
+
+    touched = set(migrated_ids) | set(obsolete_ids)
+    if reindex and touched:
+        reindex_packages(touched)
 
     log.info(f'========== Migration summary ==========')
     log.info(f'Migrated theme extra keys: {cnt_migrated}')
@@ -45,38 +58,150 @@ def migrate(fix_old=False):
         log.info(f'Obsolete theme migrated: {cnt_obsolete_migrated}')
     elif cnt_obsolete_found:
         log.info(f'*** You may want to use the --fix-old argument to fix the pre-1.1.0 datasets')
+    if touched:
+        log.info(f'Reindexed datasets: {len(touched) if reindex else 0}')
+
 
 def migrate_themes():
+    """
+    Renames the theme extras in the aggregated format, with a single UPDATE
+
+    :returns: tuple (number of renamed extras, ids of the packages updated)
+    """
     # migrate current extras
     extra_themes = Session.query(PackageExtra) \
         .filter(PackageExtra.key == 'theme') \
         .filter(PackageExtra.value.like('%"subthemes"%'))
 
-    cnt_extra = extra_themes.count()
+    package_ids = [pkg_id for (pkg_id,) in extra_themes.with_entities(PackageExtra.package_id)]
 
-    log.info(f'Migrating theme extra keys: {cnt_extra}')
-    for x_theme in extra_themes:
-        x_theme.key = FIELD_THEMES_AGGREGATE
-        x_theme.save()
+    log.info(f'Migrating theme extra keys: {len(package_ids)}')
+    cnt_extra = extra_themes.update({'key': FIELD_THEMES_AGGREGATE}, synchronize_session=False)
+    Session.commit()
 
-    return cnt_extra
+    return cnt_extra, package_ids
 
-def check_obsolete_themes(fix_old):
+
+def check_obsolete_themes(fix_old, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Looks for the theme extras in the 1.0.0 plain format and, if `fix_old` is set,
+    converts them into aggregated themes, `batch_size` extras at a time.
+
+    :returns: tuple (number of obsolete extras, number of converted extras, ids of the packages updated)
+    """
     bad_extra_themes = Session.query(PackageExtra) \
             .filter(PackageExtra.key == 'theme') \
             .filter(PackageExtra.value.notlike('%"subthemes"%'))
 
     cnt_bad = bad_extra_themes.count()
     migrated = 0
+    package_ids = []
 
     if cnt_bad:
         log.error(f'There are {cnt_bad} themes in the 1.0.0 plain format. Please review your DB.')
 
         if fix_old:
-            import ckanext.dcatapit.commands.migrate110 as migrate110
-
-            uuid = [pe.package_id for pe in bad_extra_themes]
-            log.debug(f'bad packages id {uuid}')
-            migrated = migrate110.do_migrate_data(skip_orgs=True, pkg_uuid=uuid)
-
-    return cnt_bad, migrated
+            last_id = None
+            while True:
+                q = bad_extra_themes.with_entities(PackageExtra.id, PackageExtra.package_id, PackageExtra.value) \
+                    .order_by(PackageExtra.id) \
+                    .limit(batch_size)
+                if last_id is not None:
+                    q = q.filter(PackageExtra.id > last_id)
+                rows = q.all()
+                if not rows:
+                    break
+                last_id = rows[-1].id
+
+                migrated += _convert_obsolete_themes(rows)
+                package_ids.extend(row.package_id for row in rows)
+                log.debug(f'Converted obsolete themes: {migrated}/{cnt_bad}')
+
+    return cnt_bad, migrated, package_ids
+
+
+def _convert_obsolete_themes(rows):
+    """
+    Converts a batch of (id, package_id, value) obsolete theme extras, committing once.
+
+    If the package already has aggregated themes, they take precedence and the
+    obsolete extra is removed, as the package validation would do; if it has a
+    deleted aggregated themes extra, that one is reactivated with the converted themes.
+    """
+    aggr_extras = {}
+    for extra_id, pkg_id, state in Session.query(PackageExtra.id, PackageExtra.package_id, PackageExtra.state)\
+            .filter(PackageExtra.package_id.in_({row.package_id for row in rows}),
+                    PackageExtra.key == FIELD_THEMES_AGGREGATE)\
+            .order_by(PackageExtra.id):
+        # an active extra is preferred over the deleted ones
+        if pkg_id not in aggr_extras or state == 'active':
+            aggr_extras[pkg_id] = (extra_id, state)
+    tree = Subtheme.get_tree()
+
+    updates = []
+    to_delete = []
+    for row in rows:
+        extra_id, state = aggr_extras.get(row.package_id, (None, None))
+        if state == 'active':
+            to_delete.append(row.id)
+            continue
+        themes = _parse_obsolete_themes(row.value, tree) or [DEFAULT_THEME]
+        if extra_id is None:
+            updates.append({'id': row.id,
+                            'key': FIELD_THEMES_AGGREGATE,
+                            'value': themes_to_aggr_json(themes)})
+        else:
+            updates.append({'id': extra_id,
+                            'value': themes_to_aggr_json(themes),
+                            'state': 'active'})
+            to_delete.append(row.id)
+
+    if updates:
+        Session.bulk_update_mappings(PackageExtra, updates)
+    if to_delete:
+        Session.query(PackageExtra).filter(PackageExtra.id.in_(to_delete)).delete(synchronize_session=False)
+    Session.commit()
+    return len(rows)
+
+
+def _parse_obsolete_themes(value, tree):
+    """
+    Returns the names of the themes in an obsolete theme value (`{ECON,AGRI}`, or a json
+    list or string), skipping the ones not in the themes vocabulary
+    """
+    try:
+        themes = json.loads(value)
+    except (TypeError, ValueError):
+        themes = (value or '').strip('{}').split(',')
+    if isinstance(themes, str):
+        themes = [themes]
+    elif not isinstance(themes, list):
+        themes = []
+
+    names = []
+    for theme in themes:
+        if not isinstance(theme, str):
+            continue
+        # if it's a URL, only take the final name
+        name = theme.strip().strip('"').split('/')[-1].upper()
+        if not name:
+            continue
+        try:
+            tree.uris_for_theme(name)
+        except ValueError:
+            log.warning(f'Skipping unknown theme {theme!r} in {value!r}')
+            continue
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def reindex_packages(package_ids, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Reindexes the given packages in batches, committing to Solr once at the end
+    """
+    package_ids = sorted(package_ids)
+    for idx in range(0, len(package_ids), batch_size):
+        search.rebuild(package_ids=package_ids[idx:idx + batch_size], defer_commit=True)
+        log.debug(f'Reindexed {min(idx + batch_size, len(package_ids))}/{len(package_ids)} datasets')
+    search.commit()
@@ -5,23 +5,26 @@ from rdflib import Graph, Namespace
 from rdflib.namespace import DC, SKOS, RDF, RDFS, OWL
 from rdflib.term import URIRef
 
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import and_, bindparam, func, orm
 
 from ckan.lib.base import config, model
 from ckan.lib.munge import munge_tag
 from ckan.model import Vocabulary
+from ckan.model.types import make_uuid
 from ckan.model.meta import Session
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.dcat.profiles import DCT
 from ckanext.dcat.profiles import namespaces as dcat_namespaces
 
 from ckanext.dcatapit import interfaces
 from ckanext.dcatapit.commands import DataException, ConfigException
+from ckanext.dcatapit.commands.eurovoc import EurovocIndex
 from ckanext.dcatapit.interfaces import DBAction
-from ckanext.dcatapit.model import License, ThemeToSubtheme, Subtheme, SubthemeLabel
-from ckanext.dcatapit.model.license import clear_licenses
-from ckanext.dcatapit.model.subtheme import clear_subthemes
+from ckanext.dcatapit.model import License, LocalizedLicenseName, ThemeToSubtheme, Subtheme, SubthemeLabel
+from ckanext.dcatapit.model.cache import bump_generation
+from ckanext.dcatapit.model.license import LICENSES_CACHE
+from ckanext.dcatapit.model.subtheme import SUBTHEMES_CACHE, clear_subthemes
+from ckanext.dcatapit.model.vocabulary import VOCABULARY_CACHE, TagLocalization, dcatapit_vocabulary_table
 
 CLVAPIT = Namespace('https://w3id.org/italia/onto/CLV/')
 DCATAPIT = Namespace('http://dati.gov.it/onto/dcatapit#')
@@ -102,10 +105,7 @@ def load_from_file(filename=None, url=None, eurovoc=None, *args, **kwargs):
 def load(g, name, uri, eurovoc):
 
     if name == LICENSES_NAME:
-        ret = {'licenses_deleted': License.count()}
-        clear_licenses()
-        load_licenses(g)
-        ret['licenses_created'] = License.count()
+        ret = load_licenses(g)
         Session.commit()
         return ret
 
@@ -150,14 +150,11 @@ def do_load(g, vocab_name: str):
     else:
         vocab_load = do_load_vocab
 
-    ids = []
     cnt = Counter()
 
     concepts = vocab_load(g, vocab_name)
 
     user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name'], 'ignore_auth': True}
-
     log.debug("Using site user '%s'", user['name'])
 
     vocab = Vocabulary.get(vocab_name)
@@ -166,7 +163,21 @@ def do_load(g, vocab_name: str):
     else:
         log.info(f'Creating vocabulary "{vocab_name}"')
         vocab = Vocabulary(vocab_name)
-        vocab.save()
+        Session.add(vocab)
+        Session.flush()
+
+    # Load the current state of the vocabulary, and diff it in memory against the concepts
+    tags = {name: tag_id for tag_id, name in
+            Session.query(model.Tag.id, model.Tag.name).filter(model.Tag.vocabulary_id == vocab.id)}
+    labels = {(tag_id, lang): (tl_id, text) for tl_id, tag_id, lang, text in
+              Session.query(TagLocalization.id, TagLocalization.tag_id, TagLocalization.lang, TagLocalization.text)
+              .join(model.Tag, model.Tag.id == TagLocalization.tag_id)
+              .filter(model.Tag.vocabulary_id == vocab.id)}
+
+    ids = set()
+    new_tags = []
+    new_labels = {}
+    updated_labels = {}
 
     for concept in concepts:
         tag_name = concept['name']
@@ -175,11 +186,11 @@ def do_load(g, vocab_name: str):
             cnt.incr('tag_skipped')
             continue
 
-        tag = model.Tag.by_name(tag_name, vocab)
-        if tag is None:
+        tag_id = tags.get(tag_name)
+        if tag_id is None:
             log.info(f"Adding tag {vocab_name}::{tag_name}")
-            tag = model.Tag(name=tag_name, vocabulary_id=vocab.id)
-            tag.save()
+            tag_id = tags[tag_name] = make_uuid()
+            new_tags.append({'id': tag_id, 'name': tag_name, 'vocabulary_id': vocab.id})
             cnt.incr('tag_added')
         else:
             cnt.incr('tag_exists')
@@ -193,33 +204,79 @@ def do_load(g, vocab_name: str):
             tag_lang = LANG_MAPPING_SKOS_TO_CKAN[pref_label['lang']]
             tag_text = pref_label['text']
 
-            try:
-                log.debug('Storing tag: name[%s] lang[%s] label[%s]', tag_name, tag_lang, tag_text)
-            except UnicodeEncodeError:
-                log.error(f'Storing tag: name[{tag_name}] lang[{tag_lang}]')
-
-            action, tl_id = interfaces.persist_tag_multilang(tag, tag_lang, tag_text, vocab)
+            key = (tag_id, tag_lang)
+            new_label = new_labels.get(key)
+            existing = labels.get(key)
+            if new_label is None and existing is None:
+                new_labels[key] = {'tag_id': tag_id, 'tag_name': tag_name, 'lang': tag_lang, 'text': tag_text}
+                action = DBAction.CREATED
+            elif not tag_text:
+                log.warning(f'Skipping empty label V:{vocab_name} T:{tag_name} L:{tag_lang}')
+                action = DBAction.ERROR
+            elif new_label is not None:
+                # label already added by this same load
+                if tag_text == new_label['text']:
+                    action = DBAction.NONE
+                else:
+                    new_label['text'] = tag_text
+                    action = DBAction.UPDATED
+            elif tag_text == existing[1]:
+                action = DBAction.NONE
+            else:
+                labels[key] = (existing[0], tag_text)
+                updated_labels[existing[0]] = tag_text
+                action = DBAction.UPDATED
 
             _update_label_counter(cnt, action)
 
-        ids.append(tag.id)
-
-    # delete from DB old tags not found in input graph
-    tag_not_in_voc = model.Session.query(model.Tag)\
-        .filter(model.Tag.id.notin_(ids))\
-        .filter(model.Tag.vocabulary_id==vocab.id)\
+        ids.add(tag_id)
+
+    if new_tags:
+        Session.execute(model.tag_table.insert(), new_tags)
+    if new_labels:
+        Session.execute(dcatapit_vocabulary_table.insert(), list(new_labels.values()))
+    if updated_labels:
+        Session.execute(dcatapit_vocabulary_table.update()
+                        .where(dcatapit_vocabulary_table.c.id == bindparam('_id'))
+                        .values(text=bindparam('_text')),
+                        [{'_id': tl_id, '_text': text} for tl_id, text in updated_labels.items()])
+
+    # delete from DB old tags not found in input graph, unless they are used in some active package
+    package_tag = model.package_tag_table
+    package = model.package_table
+    vocab_tags = Session.query(model.Tag.id, model.Tag.name, func.count(package.c.id))\
+        .outerjoin(package_tag, and_(package_tag.c.tag_id == model.Tag.id,
+                                     package_tag.c.state == 'active'))\
+        .outerjoin(package, and_(package.c.id == package_tag.c.package_id,
+                                 package.c.state == 'active'))\
+        .filter(model.Tag.vocabulary_id == vocab.id)\
+        .group_by(model.Tag.id, model.Tag.name)\
         .all()
-    for tag_to_delete in tag_not_in_voc:
-        pkg_cnt = len(tag_to_delete.packages)
+
+    to_delete = []
+    for tag_id, tag_name, pkg_cnt in vocab_tags:
+        if tag_id in ids:
+            continue
         if pkg_cnt == 0:
-            tag_to_delete.delete()
-            Session.commit()
-            log.info(f"Deleting tag {tag_to_delete} from vocabulary '{vocab_name}'")
+            log.info(f"Deleting tag {tag_name} from vocabulary '{vocab_name}'")
+            to_delete.append(tag_id)
             cnt.incr('tag_deleted')
         else:
-            log.info(f"Cannot delete tag {tag_to_delete} from vocabulary '{vocab_name}' used in {pkg_cnt} packages")
+            log.info(f"Cannot delete tag {tag_name} from vocabulary '{vocab_name}' used in {pkg_cnt} packages")
             cnt.incr('tag_notdeletable')
 
+    if to_delete:
+        Session.execute(dcatapit_vocabulary_table.delete().where(dcatapit_vocabulary_table.c.tag_id.in_(to_delete)))
+        Session.execute(package_tag.delete().where(package_tag.c.tag_id.in_(to_delete)))
+        Session.execute(model.tag_table.delete().where(model.tag_table.c.id.in_(to_delete)))
+
+    # let all the processes reload the localized labels
+    bump_generation(VOCABULARY_CACHE)
+    if vocab_name == ThemeToSubtheme.VOCAB_NAME:
+        # the subtheme tree holds the theme names
+        bump_generation(SUBTHEMES_CACHE)
+    Session.commit()
+
     log.info(f'Vocabulary successfully loaded ({vocab_name})')
 
     return cnt.get()
@@ -278,9 +335,15 @@ def do_load_vocab(g, vocab_name):
 def load_licenses(g: Graph):
     """
     Loads license tree into db from provided graph
-    """
-    License.delete_all()
 
+    Licenses are matched by URI against the ones already in the DB, and only the
+    differences are applied, within the current transaction: other sessions keep
+    seeing the previous licenses until the transaction is committed.
+
+    :return: a dict with the number of licenses created, updated, unchanged and deleted
+    """
+    cnt = Counter()
+    incoming = {}
     for license in g.subjects(None, SKOS.Concept):
         rank_order = g.value(license, CLVAPIT.hasRankOrder)
         version = g.value(license, OWL.versionInfo)
@@ -294,104 +357,164 @@ def load_licenses(g: Graph):
             license_type = g.value(parent, SKOS.exactMatch)
 
         _labels = g.objects(license, SKOS.prefLabel)
-        labels = dict([(l.language, l) for l in _labels])
-        license_path = str(license).split('/')[-1].split('_')[0]
-        log.debug('Adding license [%r] [%s]', license, labels.get('it', None))
-        l = License.from_data(license_type or '',
-                              str(version) if version else None,
-                              uri=str(license),
-                              path=license_path,
-                              document_uri=str(doc_uri) if doc_uri else None,
-                              rank_order=int(str(rank_order)),
-                              names=labels,
-                              parent=None)  # parent will be set later
+        labels = dict([(l.language, str(l)) for l in _labels])
+        parent = g.value(license, SKOS.broader)
+
+        incoming[str(license)] = {
+            'license_type': str(license_type or ''),
+            'version': str(version) if version else None,
+            'path': str(license).split('/')[-1].split('_')[0],
+            'document_uri': str(doc_uri) if doc_uri else None,
+            'rank_order': int(str(rank_order)),
+            'default_name': labels['it'],
+            'names': labels,
+            'parent': str(parent) if parent else None,
+        }
 
-    for license in g.subjects(None, SKOS.Concept):
-        parents = list(g.objects(license, SKOS.broader))
-        if parents:
-            parent = parents[0]
-            License.get(license).set_parent(parent)
+    existing = {l.uri: l for l in License.q().options(orm.joinedload(License.names))}
+    removed = [l for uri, l in existing.items() if uri not in incoming]
+    removed_ids = {l.id for l in removed}
+
+    # drop the removed licenses first, so their paths can be reused
+    for l in existing.values():
+        if l.parent_id in removed_ids:
+            l.parent_id = None
+    Session.flush()
+    for l in removed:
+        log.debug('Removing license [%s]', l.uri)
+        for name in l.names:
+            Session.delete(name)
+        Session.delete(l)
+        cnt.incr('licenses_deleted')
+    Session.flush()
+
+    by_uri = {}
+    for uri, data in incoming.items():
+        labels = data['names']
+        fields = {k: v for k, v in data.items() if k not in ('names', 'parent')}
+        l = existing.get(uri)
+        if l is None:
+            log.debug('Adding license [%s] [%s]', uri, labels.get('it'))
+            l = License(uri=uri, **fields)
+            l.names = [LocalizedLicenseName(lang=lang, label=label) for lang, label in labels.items()]
+            Session.add(l)
+            cnt.incr('licenses_created')
+        else:
+            changed = False
+            for k, v in fields.items():
+                if getattr(l, k) != v:
+                    setattr(l, k, v)
+                    changed = True
+            if {n.lang: n.label for n in l.names} != labels:
+                for name in l.names:
+                    Session.delete(name)
+                l.names = [LocalizedLicenseName(lang=lang, label=label) for lang, label in labels.items()]
+                changed = True
+            cnt.incr('licenses_updated' if changed else 'licenses_unchanged')
+        by_uri[uri] = l
+    Session.flush()
+
+    # resolve parents in one pass, now that all the licenses have an id
+    for uri, data in incoming.items():
+        parent = by_uri.get(data['parent'])
+        if data['parent'] and parent is None:
+            raise ValueError(f'No parent {data["parent"]} object')
+        parent_id = parent.id if parent else None
+        if by_uri[uri].parent_id != parent_id:
+            by_uri[uri].parent_id = parent_id
+    Session.flush()
+
+    # drop any license index built while loading
+    bump_generation(LICENSES_CACHE)
+    return cnt.get()
 
 
 def load_subthemes(t2sub_mapping, eurovoc, themes_g=None):
+    """
+    Loads the subthemes mapped to the eu themes, along with their EuroVoc subtree.
+
+    Only the EuroVoc concepts reachable from the mapping are read, the hierarchy
+    is computed in memory and written with bulk statements.
+    """
     if themes_g is None:
         themes_g = Graph()
         themes_g.parse(t2sub_mapping)
 
-    eurovoc_g = Graph()
-    eurovoc_g.parse(eurovoc)
-
-    ThemeToSubtheme.vocab_id = None  # reset vocabulary attached to mapping
+    mapping = [(Subtheme.normalize_theme(theme), [str(sub) for sub in themes_g.objects(theme, SKOS.narrowMatch)])
+               for theme in themes_g.subjects(RDF.type, SKOS.Concept)]
 
-    for theme in themes_g.subjects(RDF.type, SKOS.Concept):
-        sub_themes = themes_g.objects(theme, SKOS.narrowMatch)
-        for sub_theme in sub_themes:
-            add_subtheme(eurovoc_g, theme, sub_theme)
-
-
-def add_subtheme(eurovoc, theme_ref, subtheme_ref, parent=None):
-
-    def info(theme, inst):
-        return f"T:{theme} id:{inst.id:4} dpth:{inst.depth} par:{inst.parent_id or '':5} P:{inst.path}"
-
-    theme = Subtheme.normalize_theme(theme_ref)
-    existing = Subtheme.q().filter_by(uri=str(subtheme_ref)).first()
-    theme_tag = ThemeToSubtheme.get_tag(theme)
-
-    # several themes may refer to this subtheme, so we'll just return
-    # exising instance
-    if existing:
-        if not theme_tag in existing.themes:
-            existing.themes.append(theme_tag)
-        Subtheme.Session.flush()
-        log.error(f'Subtheme {subtheme_ref} already exists - {info(theme, existing)}. Skipping')
-        return existing
-
-    labels = {}
-    for pref_label in eurovoc.objects(subtheme_ref, SKOS.prefLabel):
-        labels[pref_label.language] = str(pref_label)
-    if not labels:
-        log.error(f'No labels found in EUROVOC for subtheme {subtheme_ref}. Skipping')
-        return
-    version = eurovoc.value(subtheme_ref, OWL.versionInfo) or ''
-    identifier = eurovoc.value(subtheme_ref, DCT.identifier) or ''
-    default_label = labels[DEFAULT_LANG]
-    inst = Subtheme(version=str(version),
-               identifier=str(identifier),
-               uri=str(subtheme_ref),
-               default_label=default_label,
-               parent_id=parent.id if parent else None,
-               depth=parent.depth + 1 if parent else 0)
-    inst.update_path()
-
-    inst.add()
-    Subtheme.Session.flush()
-
-    log.info(f"Added sub {info(theme, inst)}")
-
-    if parent is None:
-        inst.parent_id = inst.id
-
-    theme_m = ThemeToSubtheme(tag_id=theme_tag.id, subtheme_id=inst.id)
-    theme_m.add()
-
-    for lang, label in labels.items():
-        l = SubthemeLabel(subtheme_id=inst.id,
-                          lang=lang,
-                          label=label)
-        l.add()
-    Subtheme.Session.flush()
-    # handle children
-
-    # make sure that we have all the intermediate items from the subtheme upto the main theme
-    for child in eurovoc.objects(subtheme_ref, SKOS.hasTopConcept):
-        try:
-            add_subtheme(eurovoc, theme_ref, child, inst)
-        except IntegrityError as e:
-            # same parent may have already been added
-            log.error(f'Not adding subtheme parent "{child}" for "{theme_ref}" and sub "{subtheme_ref}"')
+    eurovoc_idx = EurovocIndex.load(eurovoc, [sub for theme, subs in mapping for sub in subs])
 
-    return inst
+    ThemeToSubtheme.vocab_id = None  # reset vocabulary attached to mapping
+    theme_tags = dict(Session.query(model.Tag.name, model.Tag.id)
+                      .filter(model.Tag.vocabulary_id == ThemeToSubtheme.get_vocabulary_id()))
+
+    existing = dict(Session.query(Subtheme.uri, Subtheme.id))
+    nodes = {}  # new subthemes by uri, parents before children
+    links = []  # (tag_id, subtheme uri)
+
+    def add_subtheme(tag_id, uri, parent=None):
+        # several themes may refer to this subtheme, so we'll just link it
+        if uri in existing or uri in nodes:
+            log.debug(f'Subtheme {uri} already exists, linking it to tag {tag_id}')
+            links.append((tag_id, uri))
+            return
+
+        concept = eurovoc_idx.get(uri)
+        if concept is None or not concept.labels:
+            log.error(f'No labels found in EUROVOC for subtheme {uri}. Skipping')
+            return
+
+        default_label = concept.labels[DEFAULT_LANG]
+        node = nodes[uri] = {
+            'uri': uri,
+            'version': concept.version,
+            'identifier': concept.identifier,
+            'default_label': default_label,
+            'parent': parent['uri'] if parent else uri,
+            'depth': parent['depth'] + 1 if parent else 0,
+            'path': f"{parent['path']}/{default_label}" if parent else default_label,
+            'labels': concept.labels,
+        }
+        links.append((tag_id, uri))
+
+        # make sure that we have all the intermediate items from the subtheme upto the main theme
+        for child in concept.children:
+            add_subtheme(tag_id, child, node)
+
+    for theme, subthemes in mapping:
+        tag_id = theme_tags.get(theme)
+        if tag_id is None:
+            raise ValueError(f'No tag for {theme}')
+        for subtheme in subthemes:
+            add_subtheme(tag_id, subtheme)
+
+    if nodes:
+        table = Subtheme.__table__
+        Session.execute(table.insert(),
+                        [{k: n[k] for k in ('uri', 'version', 'identifier', 'default_label', 'depth', 'path')}
+                         for n in nodes.values()])
+        existing = dict(Session.query(Subtheme.uri, Subtheme.id))
+        Session.execute(table.update()
+                        .where(table.c.id == bindparam('_id'))
+                        .values(parent_id=bindparam('_parent_id')),
+                        [{'_id': existing[n['uri']], '_parent_id': existing[n['parent']]} for n in nodes.values()])
+        Session.execute(SubthemeLabel.__table__.insert(),
+                        [{'subtheme_id': existing[n['uri']], 'lang': lang, 'label': label}
+                         for n in nodes.values() for lang, label in n['labels'].items()])
+
+    linked = set(Session.query(ThemeToSubtheme.tag_id, ThemeToSubtheme.subtheme_id))
+    new_links = []
+    for tag_id, uri in links:
+        link = (tag_id, existing[uri])
+        if link not in linked:
+            linked.add(link)
+            new_links.append({'tag_id': tag_id, 'subtheme_id': link[1]})
+    if new_links:
+        Session.execute(ThemeToSubtheme.__table__.insert(), new_links)
+
+    log.info(f'Added {len(nodes)} subthemes and {len(new_links)} theme mappings')
+    bump_generation(SUBTHEMES_CACHE)
 
 
 def validate_vocabulary(filename=None, url=None, eurovoc=None):
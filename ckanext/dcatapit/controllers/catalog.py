@@ -0,0 +1,21 @@
+import logging
+
+from flask import Response, stream_with_context
+
+from ckan.lib.base import abort
+import ckan.plugins.toolkit as tk
+
+from ckanext.dcatapit.dcat.stream import STREAM_FORMATS, StreamingCatalogSerializer, iter_catalog_datasets
+
+log = logging.getLogger(__name__)
+
+
+def stream_catalog(_format):
+    if _format not in STREAM_FORMATS:
+        return abort(404, detail=f'Unsupported format {_format}')
+
+    context = {'user': tk.g.user}
+    serializer = StreamingCatalogSerializer(_format)
+    chunks = serializer.serialize(iter_catalog_datasets(context))
+
+    return Response(stream_with_context(chunks), mimetype=serializer.mimetype)
@@ -0,0 +1,60 @@
+from rdflib import Literal
+from rdflib.namespace import RDF
+
+DEFAULT_DEPTH = 2
+
+
+class GraphIndex(object):
+    """
+    Read-only view of a graph, indexing the triples of the nodes reachable from a root node.
+
+    Each subject found within `depth` hops from the root (e.g. dataset -> distribution ->
+    license) is indexed with all its predicates and objects, so that lookups on it don't
+    go through the whole graph.
+    Lookups on subjects not in the index, and any other graph method, are delegated to
+    the underlying graph.
+    """
+
+    def __init__(self, graph, root, depth=DEFAULT_DEPTH):
+        self.graph = graph
+        self._index = {}
+
+        level = [root]
+        for _ in range(depth + 1):
+            next_level = []
+            for subject in level:
+                if subject in self._index:
+                    continue
+                predicates = self._index[subject] = {}
+                for predicate, obj in graph.predicate_objects(subject):
+                    predicates.setdefault(predicate, []).append(obj)
+                    # types are shared by all the nodes, there's nothing to parse in them
+                    if predicate != RDF.type and not isinstance(obj, Literal):
+                        next_level.append(obj)
+            level = next_level
+
+    def __len__(self):
+        return sum(len(objects) for predicates in self._index.values() for objects in predicates.values())
+
+    def __contains__(self, triple):
+        subject, predicate, obj = triple
+        predicates = self._index.get(subject)
+        if predicates is None or predicate is None or obj is None:
+            return triple in self.graph
+        return obj in predicates.get(predicate, ())
+
+    def __getattr__(self, name):
+        return getattr(self.graph, name)
+
+    def objects(self, subject=None, predicate=None):
+        predicates = self._index.get(subject)
+        if predicates is None or predicate is None:
+            return self.graph.objects(subject, predicate)
+        return iter(predicates.get(predicate, ()))
+
+    def value(self, subject=None, predicate=RDF.value, object=None, default=None, any=True):
+        if subject not in self._index or predicate is None or object is not None or not any:
+            return self.graph.value(subject, predicate, object, default, any)
+        for obj in self.objects(subject, predicate):
+            return obj
+        return default
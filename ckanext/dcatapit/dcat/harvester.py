@@ -1,16 +1,25 @@
+import atexit
 import json
 import logging
 
 import ckan.plugins as p
 import ckanext.dcatapit.interfaces as interfaces
 from ckan.lib.munge import munge_name
+from ckan.model import Resource, Session
 from ckanext.dcat.interfaces import IDCATRDFHarvester
 from ckanext.dcatapit import helpers as dcatapit_helpers
 from ckanext.dcatapit.dcat.const import LOCALISED_DICT_NAME_BASE, LOCALISED_DICT_NAME_RESOURCES
+from ckanext.dcatapit.dcat.parallel import ParallelRDFParser, get_parse_workers
 from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest.model import HarvestObject
 
 log = logging.getLogger(__name__)
 
+# harvested datasets reindexed before a Solr commit, unless set in the harvest source config
+DEFAULT_SOLR_COMMIT_EVERY = 500
+# seconds without harvested datasets after which the reindexed ones are committed
+DEFAULT_SOLR_COMMIT_IDLE = 10
+
 
 class DCATAPITHarvesterPlugin(p.SingletonPlugin):
 
@@ -25,18 +34,24 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
     def after_download(self, content, harvest_job):
         return content, []
 
+    def after_parsing(self, rdf_parser, harvest_job):
+        workers = get_parse_workers(self._get_source_config(harvest_job))
+        if rdf_parser and workers > 1:
+            rdf_parser = ParallelRDFParser(rdf_parser, workers)
+        return rdf_parser, []
+
     def before_update(self, harvest_object, dataset_dict, temp_dict):
         self._before(dataset_dict, temp_dict, harvest_object)
 
     def after_update(self, harvest_object, dataset_dict, temp_dict):
-        return self._after(dataset_dict, temp_dict)
+        return self._after(harvest_object, dataset_dict, temp_dict)
 
     def before_create(self, harvest_object, dataset_dict, temp_dict):
         self._before_create(harvest_object, dataset_dict)
         self._before(dataset_dict, temp_dict, harvest_object)
 
     def after_create(self, harvest_object, dataset_dict, temp_dict):
-        return self._after(dataset_dict, temp_dict)
+        return self._after(harvest_object, dataset_dict, temp_dict)
 
     def _before_create(self, harvest_object, dataset_dict):
         title = dataset_dict['title']
@@ -59,13 +74,17 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
             }
         self._handle_rights_holder(dataset_dict, temp_dict, job)
 
-    def _handle_rights_holder(self, dataset_dict, temp_dict, job):
+    def _get_source_config(self, harvest_object_or_job):
+        source = harvest_object_or_job.source
         try:
-            config = json.loads(job.source.config) if job.source.config else {}
+            return json.loads(source.config) if source.config else {}
         except (TypeError, ValueError) as err:
-            log.warning('Cannot parse job config to get rights holder: %s',
+            log.warning('Cannot parse harvest source config: %s',
                         err, exc_info=err)
-            config = {}
+            return {}
+
+    def _handle_rights_holder(self, dataset_dict, temp_dict, job):
+        config = self._get_source_config(job)
 
         orgs_conf = config.get('remote_orgs', None)
         ctx = {'ignore_auth': True,
@@ -92,61 +111,92 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
                 dataset_dict.pop('holder_name', None)
                 dataset_dict.pop('holder_identifier', None)
 
-    def _after(self, dataset_dict, temp_dict):
+    def _after(self, harvest_object, dataset_dict, temp_dict):
         dcatapit_dict = temp_dict.get('dcatapit')
         if not dcatapit_dict:
             return None
 
         base_dict = dcatapit_dict[LOCALISED_DICT_NAME_BASE]
-        if base_dict:
-            pkg_id = dataset_dict['id']
-            err = self._save_package_multilang(pkg_id, base_dict)
-            if err:
-                return err
-
         resources_dict = dcatapit_dict[LOCALISED_DICT_NAME_RESOURCES]
-        if resources_dict:
-            err = self._save_resources_multilang(pkg_id, resources_dict)
+        if base_dict or resources_dict:
+            err = self._save_multilang(dataset_dict['id'], base_dict, resources_dict)
             if err:
                 return err
 
         ##
         # Managing Solr indexes for harvested package dict
         ##
-        interfaces.update_solr_package_indexes(dataset_dict)
+        self._queue_solr_index(harvest_object, dataset_dict)
 
         return None
 
-    def _save_package_multilang(self, pkg_id, base_dict):
+    def _queue_solr_index(self, harvest_object, dataset_dict):
+        """
+        Reindex the package in Solr, committing once for many datasets.
+
+        The commit is issued when no more objects of the job are waiting to be
+        imported, when another job starts, every `solr_commit_every` objects
+        (1 commits each object), or when no object has been reindexed for
+        `solr_commit_idle` seconds, so that the datasets are committed even if
+        the last objects of the job are not reindexed (deleted or failed).
+        """
+        if not dataset_dict:
+            log.warning('::: package_dict is None: SOLR INDEX CANNOT BE UPDATED! :::')
+            return
+
+        job_id = harvest_object.harvest_job_id
+        queue = self._get_solr_index_queue(harvest_object)
+        queue.add(dataset_dict)
+
+        if not self._job_has_waiting_objects(job_id):
+            log.debug('No more objects waiting for job %s, committing Solr index', job_id)
+            queue.flush()
+
+    def _job_has_waiting_objects(self, job_id):
+        waiting = Session.query(HarvestObject.id)\
+            .filter(HarvestObject.harvest_job_id == job_id,
+                    HarvestObject.state == 'WAITING')\
+            .first()
+        return waiting is not None
+
+    def _get_solr_index_queue(self, harvest_object):
+        job_id = harvest_object.harvest_job_id
+        if getattr(self, '_solr_index_job_id', None) != job_id:
+            self._flush_solr_index_queue()
+            source_config = self._get_source_config(harvest_object)
+            self._solr_index_queue = interfaces.SolrIndexQueue(
+                commit_every=_get_number(source_config, 'solr_commit_every', DEFAULT_SOLR_COMMIT_EVERY, int),
+                idle_flush=_get_number(source_config, 'solr_commit_idle', DEFAULT_SOLR_COMMIT_IDLE, float))
+            self._solr_index_job_id = job_id
+
+            if not getattr(self, '_solr_index_atexit', False):
+                atexit.register(self._flush_solr_index_queue)
+                self._solr_index_atexit = True
+        return self._solr_index_queue
+
+    def _flush_solr_index_queue(self):
+        queue = getattr(self, '_solr_index_queue', None)
+        if queue is not None:
+            queue.flush()
+
+    def _save_multilang(self, pkg_id, base_dict, resources_dict):
+        """
+        Save the localized fields of the package and of its resources in a single transaction
+        """
         try:
-            for field, lang_dict in base_dict.items():
-                for lang, text in lang_dict.items():
-                    interfaces.upsert_package_multilang(pkg_id,
-                                                        field,
-                                                        'package',
-                                                        lang,
-                                                        text)
+            res_fields = {}
+            if resources_dict:
+                uri_id_mapping = self._get_resource_uri_id_mapping(pkg_id)
 
-        except Exception as err:
-            return str(err)
-
-        return None
+                for res_uri, res_dict in resources_dict.items():
+                    res_id = uri_id_mapping.get(res_uri, None)
+                    if not res_id:
+                        log.warning('Could not find resource id for URI %s', res_uri)
+                        continue
+                    res_fields[res_id] = res_dict
 
-    def _save_resources_multilang(self, pkg_id, resources_dict):
-        try:
-            uri_id_mapping = self._get_resource_uri_id_mapping(pkg_id)
-
-            for res_uri, res_dict in resources_dict.items():
-                res_id = uri_id_mapping.get(res_uri, None)
-                if not res_id:
-                    log.warning('Could not find resource id for URI %s', res_uri)
-                    continue
-                for field, lang_dict in res_dict.items():
-                    for lang, text in lang_dict.items():
-                        interfaces.upsert_resource_multilang(res_id,
-                                                             field,
-                                                             lang,
-                                                             text)
+            stats = interfaces.save_multilang_bulk(pkg_id, base_dict, res_fields)
+            log.debug('Saved localized fields for package %s: %s', pkg_id, stats)
 
         except Exception as err:
             return str(err)
@@ -154,13 +204,19 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
         return None
 
     def _get_resource_uri_id_mapping(self, pkg_id):
+        """
+        Map the URIs of the package resources to their ids.
+
+        The `uri` of a resource is stored in its extras, so they are read directly
+        from the resource table, without running a full package_show.
+        """
         ret = {}
-#        log.info("DATASET DICT: %s", dataset_dict)
-        dataset = p.toolkit.get_action('package_show')({}, {'id': pkg_id})
-#        log.info("DATASET ----------- %s", dataset)
-        for resource in dataset.get('resources', []):
-            res_id = resource.get('id', None)
-            res_uri = resource.get('uri', None)
+        q = Session.query(Resource.id, Resource.name, Resource.extras)\
+            .filter(Resource.package_id == pkg_id,
+                    Resource.state == 'active')\
+            .order_by(Resource.position)
+        for res_id, res_name, res_extras in q:
+            res_uri = (res_extras or {}).get('uri', None)
             if res_id and res_uri:
                 log.debug('Mapping resource id %s to URI "%s"',
                           res_id,
@@ -168,7 +224,7 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
                 ret[res_uri] = res_id
             else:
                 log.warning("Can't map URI for resource \"%s\"",
-                            resource.get('name', '---'))
+                            res_name or '---')
 
         return ret
 
@@ -181,3 +237,11 @@ class DCATAPITHarvesterPlugin(p.SingletonPlugin):
             {})
         self._user_name = user['name']
         return self._user_name
+
+
+def _get_number(source_config, key, default, _type):
+    try:
+        return _type(source_config.get(key, default))
+    except (TypeError, ValueError):
+        log.warning('Bad value for %s: %s', key, source_config.get(key))
+        return default
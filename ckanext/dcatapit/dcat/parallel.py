@@ -0,0 +1,125 @@
+import logging
+import multiprocessing
+
+from rdflib import Graph, Literal
+from rdflib.namespace import RDF
+
+from ckan.common import config
+
+from ckanext.dcat.processors import RDFParser
+from ckanext.dcat.profiles import DCAT
+
+from ckanext.dcatapit.model import detach_db_connections
+from ckanext.dcatapit.model.license import License
+from ckanext.dcatapit.model.subtheme import Subtheme
+
+log = logging.getLogger(__name__)
+
+# number of worker processes used to parse a harvested catalog; 0 or 1 parse it serially
+CONFIG_PARSE_WORKERS = 'ckanext.dcatapit.harvest.parse_workers'
+# same setting in the harvest source config
+SOURCE_PARSE_WORKERS = 'parse_workers'
+
+# datasets sent to a worker at once
+CHUNK_SIZE = 20
+
+# hops from the dataset node included in its subgraph (e.g. dataset -> distribution -> checksum -> value)
+SUBGRAPH_DEPTH = 3
+
+# state of the worker processes
+_worker = {}
+
+
+def get_parse_workers(source_config=None):
+    value = (source_config or {}).get(SOURCE_PARSE_WORKERS, config.get(CONFIG_PARSE_WORKERS, 0))
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        log.warning(f'Bad value for {SOURCE_PARSE_WORKERS}: {value}')
+        return 0
+
+
+def dataset_subgraph(graph, dataset_ref, depth=SUBGRAPH_DEPTH):
+    """
+    Return a new Graph with the triples of the dataset and of the nodes reachable from it.
+
+    Types and other datasets (e.g. in dct:isVersionOf) are not followed,
+    so that the subgraph contains a single dataset.
+    """
+    sub = Graph()
+    seen = set()
+    level = [dataset_ref]
+    for _ in range(depth + 1):
+        next_level = []
+        for subject in level:
+            if subject in seen:
+                continue
+            seen.add(subject)
+            for predicate, obj in graph.predicate_objects(subject):
+                sub.add((subject, predicate, obj))
+                if predicate == RDF.type or isinstance(obj, Literal):
+                    continue
+                if (obj, RDF.type, DCAT.Dataset) in graph:
+                    continue
+                next_level.append(obj)
+        level = next_level
+    return sub
+
+
+class ParallelRDFParser(object):
+    """
+    Wraps an RDFParser, so that its datasets are parsed in a pool of worker processes.
+
+    Each dataset is extracted with its related nodes in a subgraph, which is parsed
+    by a worker with the profiles of the wrapped parser; dataset dicts (including the localized
+    dicts) are yielded in the same order as the wrapped parser.
+    """
+
+    def __init__(self, parser, workers):
+        self.parser = parser
+        self.workers = workers
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    def profile_names(self):
+        # RDFParser sets the entry point name on each profile class it loads
+        return [profile.name for profile in self.parser._profiles]
+
+    def datasets(self):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            log.warning('Parallel parsing is not supported on this platform, parsing serially')
+            yield from self.parser.datasets()
+            return
+
+        # load the caches used by the profiles once, the forked workers will share them
+        License.get_record(License.DEFAULT_LICENSE)
+        Subtheme.get_tree()
+
+        g = self.parser.g
+        payloads = (dataset_subgraph(g, dataset_ref).serialize(format='nt', encoding='utf-8')
+                    for dataset_ref in g.subjects(RDF.type, DCAT.Dataset))
+
+        log.info(f'Parsing datasets with {self.workers} processes')
+        with context.Pool(self.workers,
+                          initializer=_init_worker,
+                          initargs=(self.profile_names(), self.parser.compatibility_mode)) as pool:
+            for dataset_dict in pool.imap(_parse_dataset, payloads, CHUNK_SIZE):
+                if dataset_dict is not None:
+                    yield dataset_dict
+
+
+def _init_worker(profiles, compatibility_mode):
+    detach_db_connections()
+    _worker['parser'] = RDFParser(profiles=profiles, compatibility_mode=compatibility_mode)
+
+
+def _parse_dataset(payload):
+    parser = _worker['parser']
+    parser.g = Graph()
+    parser.g.parse(data=payload, format='nt')
+    for dataset_dict in parser.datasets():
+        return dataset_dict
+    return None
@@ -29,7 +29,11 @@ from ckanext.dcatapit.dcat.const import DCATAPIT, it_namespaces, THEME_BASE_URI,
     FORMAT_BASE_URI, GEO_BASE_URI, THEME_CONCEPTS, GEO_CONCEPTS, DEFAULT_THEME_KEY, DEFAULT_FORMAT_CODE, \
     DEFAULT_FREQ_CODE, LOCALISED_DICT_NAME_BASE, LOCALISED_DICT_NAME_RESOURCES, lang_mapping_ckan_to_voc, \
     lang_mapping_xmllang_to_ckan, lang_mapping_ckan_to_xmllang, format_mapping
-from ckanext.dcatapit.model.subtheme import Subtheme
+from ckanext.dcatapit.dcat.graph_index import GraphIndex
+from ckanext.dcatapit.model.cache import GenerationCache
+from ckanext.dcatapit.model.license import LICENSES_CACHE
+from ckanext.dcatapit.model.subtheme import SUBTHEMES_CACHE, Subtheme
+from ckanext.dcatapit.model.vocabulary import VOCABULARY_CACHE
 from ckanext.dcatapit.mapping import theme_name_to_uri, theme_aggrs_unpack, theme_names_to_uris, themes_parse_to_uris
 from ckanext.dcatapit.schema import FIELD_THEMES_AGGREGATE
 
@@ -39,6 +43,12 @@ OFFERED_LANGS = set(get_locales()).intersection(HANDLED_LANGS)
 
 log = logging.getLogger(__name__)
 
+# Prebuilt triples of the concepts referenced by the datasets, shared across datasets and requests.
+# Only existing concepts are memoized, so that the memos are bounded by the vocabularies size.
+_tag_concepts = GenerationCache(VOCABULARY_CACHE, dict)
+_subtheme_concepts = GenerationCache(SUBTHEMES_CACHE, dict)
+_license_concepts = GenerationCache(LICENSES_CACHE, dict)
+
 
 class ItalianDCATAPProfile(RDFProfile):
     '''
@@ -53,6 +63,16 @@ class ItalianDCATAPProfile(RDFProfile):
             # not a DCATAPIT dataset
             return dataset_dict
 
+        # run all the lookups against the triples of this dataset and of its related nodes only
+        graph = self.g
+        self.g = GraphIndex(graph, dataset_ref)
+        try:
+            return self._parse_dataset(dataset_dict, dataset_ref)
+        finally:
+            self.g = graph
+
+    def _parse_dataset(self, dataset_dict, dataset_ref):
+
         # date info
         for predicate, key, logf in (
                 (DCT.issued, 'issued', log.debug),
@@ -402,7 +422,7 @@ class ItalianDCATAPProfile(RDFProfile):
             row = {'theme': theme_name, 'subthemes': []}
 
             try:
-                subthemes_for_theme = Subtheme.for_theme_values(theme_name)
+                subthemes_for_theme = Subtheme.get_tree().uris_for_theme(theme_name)
             except ValueError as err:
                 subthemes_for_theme = []
 
@@ -576,13 +596,18 @@ class ItalianDCATAPProfile(RDFProfile):
         title = dataset_dict.get('title')
 
         # extract fields from extras, just in case
-        schema_fields = schema.get_custom_package_schema()
-        for fdef in schema_fields:
-            for eidx, ex in enumerate(dataset_dict.get('extras') or []):
-                if ex['key'] == fdef['name']:
-                    dataset_dict['extras'].pop(eidx)
-                    dataset_dict[fdef['name']] = ex['value']
-                    break
+        field_names = schema.get_package_schema_plan().field_names
+        extras = dataset_dict.get('extras') or []
+        moved = set()
+        kept = []
+        for ex in extras:
+            if ex['key'] in field_names and ex['key'] not in moved:
+                moved.add(ex['key'])
+                dataset_dict[ex['key']] = ex['value']
+            else:
+                kept.append(ex)
+        if moved:
+            extras[:] = kept
 
         g = self.g
 
@@ -873,22 +898,9 @@ class ItalianDCATAPProfile(RDFProfile):
             # "license_title" : "Creative Commons CCZero",
             # "license_url" : "http://www.opendefinition.org/licenses/cc-zero",
 
-            license_info = interfaces.get_license_for_dcat(resource_dict.get('license_type'))
-            dcat_license, license_title, license_url, license_version, dcatapit_license, names = license_info
-
-            # be lenient about license existence
-            license_maybe = license_url or dcatapit_license
-            if license_maybe:
-                license = URIRef(license_maybe)
-
-                g.add((license, RDF.type, DCATAPIT.LicenseDocument))
-                g.add((license, RDF.type, DCT.LicenseDocument))
-                g.add((license, DCT.type, URIRef(dcat_license)))
-                if license_version:
-                    g.add((license, OWL.versionInfo, Literal(license_version)))
-                for lang, name in names.items():
-                    g.add((license, FOAF.name, Literal(name, lang=lang)))
-
+            license, triples = self._get_license_triples(resource_dict.get('license_type'))
+            if license:
+                g.addN((*t, g) for t in triples)
                 g.add((distribution, DCT.license, license))
             else:
                 log.error('*** License not set')
@@ -1001,19 +1013,25 @@ class ItalianDCATAPProfile(RDFProfile):
         subthemes is a list of eurovoc hrefs.
 
         """
+        memo = _subtheme_concepts.get()
         for subtheme in subthemes:
             sref = URIRef(subtheme)
-            sthm = Subtheme.get(subtheme)
-            if not sthm:
-                log.info(f'No subtheme for {subtheme}')
-                continue
+            triples = memo.get(subtheme)
+            if triples is None:
+                sthm = Subtheme.get(subtheme)
+                if not sthm:
+                    log.info(f'No subtheme for {subtheme}')
+                    continue
 
-            labels = sthm.get_names_dict()
-            self.g.add((sref, RDF.type, SKOS.Concept))
-            self.g.add((sref, RDF.type, DCATAPIT.subTheme))  # only for dcatapit 0.4, not in 1.0
-            for lang, label in labels.items():
-                if lang in OFFERED_LANGS:
-                    self.g.add((sref, SKOS.prefLabel, Literal(label, lang=lang)))
+                labels = sthm.get_names_dict()
+                triples = [(sref, RDF.type, SKOS.Concept),
+                           (sref, RDF.type, DCATAPIT.subTheme)]  # only for dcatapit 0.4, not in 1.0
+                for lang, label in labels.items():
+                    if lang in OFFERED_LANGS:
+                        triples.append((sref, SKOS.prefLabel, Literal(label, lang=lang)))
+                memo[subtheme] = triples = tuple(triples)
+
+            self.g.addN((*t, self.g) for t in triples)
             self.g.add((ref, DCT.subject, sref))
 
     def _add_creators(self, dataset_dict, ref):
@@ -1139,20 +1157,57 @@ class ItalianDCATAPProfile(RDFProfile):
         if uri:
             tag = uri.replace('#', '/').split('/')[-1]
 
-        loc_dict = interfaces.get_all_localized_tag_labels(tag)
+        key = (uri, base_uri, tag)
+        memo = _tag_concepts.get()
+        triples = memo.get(key)
 
-        if loc_dict and len(loc_dict) > 0:
+        if triples is None:
+            loc_dict = interfaces.get_all_localized_tag_labels(tag)
+            if not loc_dict:
+                return False
 
             concept = URIRef(uri if uri else f'{base_uri}{tag}')
-            self.g.add((concept, RDF['type'], SKOS.Concept))
-
+            triples = [(concept, RDF['type'], SKOS.Concept)]
             for lang, label in loc_dict.items():
                 lang = lang.split('_')[0]  # rdflib is quite picky in lang names
-                self.g.add((concept, SKOS.prefLabel, Literal(label, lang=lang)))
+                triples.append((concept, SKOS.prefLabel, Literal(label, lang=lang)))
+            memo[key] = triples = tuple(triples)
 
-            return True
+        self.g.addN((*t, self.g) for t in triples)
+        return True
+
+    def _get_license_triples(self, license_type):
+        """
+        Returns the license document ref and its triples, or (None, None) if no license is found.
+
+        Triples are memoized by the resolved license, so that the license types falling
+        back to the default license don't add entries.
+        """
+        license_info = interfaces.get_license_for_dcat(license_type)
+        dcat_license, license_title, license_url, license_version, dcatapit_license, names = license_info
+
+        # be lenient about license existence
+        license_maybe = license_url or dcatapit_license
+        if not license_maybe:
+            return None, None
+
+        key = (license_maybe, dcat_license)
+        memo = _license_concepts.get()
+        out = memo.get(key)
+        if out is not None:
+            return out
+
+        license = URIRef(license_maybe)
+        triples = [(license, RDF.type, DCATAPIT.LicenseDocument),
+                   (license, RDF.type, DCT.LicenseDocument),
+                   (license, DCT.type, URIRef(dcat_license))]
+        if license_version:
+            triples.append((license, OWL.versionInfo, Literal(license_version)))
+        for lang, name in names.items():
+            triples.append((license, FOAF.name, Literal(name, lang=lang)))
 
-        return False
+        memo[key] = out = (license, tuple(triples))
+        return out
 
     def graph_from_catalog(self, catalog_dict, catalog_ref):
 
@@ -0,0 +1,245 @@
+import itertools
+import logging
+import re
+
+from rdflib import BNode, Graph, URIRef
+from rdflib.namespace import RDF, SKOS
+
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dcat.processors import RDFSerializer
+from ckanext.dcat.profiles import DCAT, DCT, FOAF
+
+import ckanext.dcatapit.interfaces as interfaces
+from ckanext.dcatapit.dcat.const import DCATAPIT
+
+log = logging.getLogger(__name__)
+
+# url format -> (rdflib format, mimetype)
+STREAM_FORMATS = {
+    'nt': ('nt', 'application/n-triples'),
+    'ttl': ('turtle', 'text/turtle'),
+    'xml': ('xml', 'application/rdf+xml'),
+}
+
+DEFAULT_PAGE_SIZE = 100
+
+TURTLE_PREFIX_RE = re.compile(r'^@prefix (\S*): <([^>]*)> \.$')
+XML_NS_RE = re.compile(r'xmlns(?::(\S+))?="([^"]*)"')
+
+# nodes with a stable URI shared among datasets, emitted only once
+SHARED_TYPES = (SKOS.Concept, SKOS.ConceptScheme, DCT.LicenseDocument, DCATAPIT.LicenseDocument)
+
+
+class StreamingCatalogSerializer(object):
+    """
+    Serializes the catalog one dataset at a time.
+
+    Each dataset is rendered in its own graph, and the serialized chunks are
+    yielded as soon as they are ready, so that memory usage does not depend on
+    the number of datasets.
+    Nodes shared among datasets (concepts, licences, agents) are emitted only once.
+    Datasets are rendered in pages, so that their localized fields are loaded at once.
+    """
+
+    def __init__(self, _format='xml', profiles=None, compatibility_mode=False, page_size=DEFAULT_PAGE_SIZE):
+        if _format not in STREAM_FORMATS:
+            raise ValueError(f'Unsupported streaming format: {_format}')
+        self.format = _format
+        # datasets rendered at once
+        self.page_size = page_size
+        self.rdf_format, self.mimetype = STREAM_FORMATS[_format]
+        self._serializer = RDFSerializer(profiles=profiles, compatibility_mode=compatibility_mode)
+        # namespaces declared in the document header
+        self._namespaces = {}
+        # keys of the shared nodes already emitted
+        self._emitted = set()
+        # agent key -> blank node emitted for it
+        self._agents = {}
+
+    def serialize(self, dataset_dicts, catalog_dict=None):
+        """
+        Yields the serialized catalog as a sequence of str chunks
+        """
+        g = self._new_graph()
+        catalog_ref = self._serializer.graph_from_catalog(catalog_dict)
+        self._namespaces = {prefix: str(ns) for prefix, ns in g.namespaces()}
+        shared = self._remove_emitted(g, {catalog_ref})
+
+        yield self._header()
+        yield self._body(g, shared)
+
+        count = 0
+        dataset_dicts = iter(dataset_dicts)
+        while True:
+            page = list(itertools.islice(dataset_dicts, self.page_size))
+            if not page:
+                break
+
+            # the localized fields of the whole page are loaded at once
+            with interfaces.prefetch_multilang(page):
+                bodies = [self._dataset_body(catalog_ref, dataset_dict) for dataset_dict in page]
+            yield from bodies
+            count += len(page)
+
+        yield self._footer()
+        log.debug(f'Streamed {count} datasets')
+
+    def _dataset_body(self, catalog_ref, dataset_dict):
+        g = self._new_graph()
+        dataset_ref = self._serializer.graph_from_dataset(dataset_dict)
+        g.add((catalog_ref, DCAT.dataset, dataset_ref))
+
+        own = {catalog_ref, dataset_ref}
+        own.update(g.objects(dataset_ref, DCAT.distribution))
+        shared = self._remove_emitted(g, own)
+        return self._body(g, shared)
+
+    def _new_graph(self):
+        g = Graph()
+        for prefix, ns in self._namespaces.items():
+            g.bind(prefix, ns)
+        self._serializer.g = g
+        return g
+
+    def _remove_emitted(self, g, own):
+        """
+        Removes from the graph the shared nodes already emitted.
+
+        Concepts and licence documents are matched by their URI; agents are blank nodes,
+        so they are matched by their description, and the references to an agent already
+        emitted are replaced with the blank node emitted for it.
+        Returns the agent blank nodes referenced in the graph.
+        """
+        shared = set()
+        for s in set(g.subjects(RDF.type, None)):
+            if s in own:
+                continue
+            types = set(g.objects(s, RDF.type))
+            if FOAF.Agent in types:
+                agent = self._share_agent(g, s)
+                if agent is not None:
+                    shared.add(agent)
+            elif isinstance(s, URIRef) and types.intersection(SHARED_TYPES):
+                # blank nodes are different in each graph, so they can't be matched
+                if any(isinstance(o, BNode) for o in g.objects(s, None)):
+                    continue
+                if s in self._emitted:
+                    g.remove((s, None, None))
+                else:
+                    self._emitted.add(s)
+        return shared
+
+    def _share_agent(self, g, agent):
+        description = frozenset(g.predicate_objects(agent))
+        if any(isinstance(o, BNode) for p, o in description):
+            return None
+        # the agents must be referenced by named nodes, so that they can be serialized as triples
+        if any(not isinstance(s, URIRef) for s in g.subjects(None, agent)):
+            return None
+        if isinstance(agent, URIRef):
+            key = agent
+        else:
+            key = (g.value(agent, DCT.identifier), description)
+
+        if key in self._emitted:
+            g.remove((agent, None, None))
+            emitted = self._agents.get(key, agent)
+            for s, p in list(g.subject_predicates(agent)):
+                g.remove((s, p, agent))
+                g.add((s, p, emitted))
+            return emitted if isinstance(emitted, BNode) else None
+
+        self._emitted.add(key)
+        if isinstance(agent, BNode):
+            self._agents[key] = agent
+            return agent
+        return None
+
+    def _header(self):
+        if self.format == 'xml':
+            decls = ''.join(f'\n   {_xmlns(prefix, ns)}'
+                            for prefix, ns in sorted(self._namespaces.items()))
+            return f'<?xml version="1.0" encoding="utf-8"?>\n<rdf:RDF{decls}\n>\n'
+        elif self.format == 'ttl':
+            return ''.join(f'@prefix {prefix}: <{ns}> .\n'
+                           for prefix, ns in sorted(self._namespaces.items())) + '\n'
+        return ''
+
+    def _footer(self):
+        return '</rdf:RDF>\n' if self.format == 'xml' else ''
+
+    def _body(self, g, shared=()):
+        if self.format == 'ttl' and shared:
+            # turtle writes the blank nodes referenced once as anonymous nodes, so the shared
+            # agents are written as N-Triples, which are valid turtle too
+            triples = Graph()
+            for agent in shared:
+                for t in itertools.chain(g.triples((agent, None, None)), g.triples((None, None, agent))):
+                    triples.add(t)
+                    g.remove(t)
+            return self._body(g) + triples.serialize(format='nt', encoding='utf-8').decode('utf-8')
+
+        if not len(g):
+            return ''
+        out = g.serialize(format=self.rdf_format, encoding='utf-8').decode('utf-8')
+
+        if self.format == 'xml':
+            return self._xml_body(out)
+        elif self.format == 'ttl':
+            return self._turtle_body(out)
+        return out
+
+    def _turtle_body(self, out):
+        # keep only the prefixes not declared in the header (allowed anywhere in turtle)
+        lines = []
+        for line in out.splitlines(True):
+            m = TURTLE_PREFIX_RE.match(line.strip())
+            if m and self._namespaces.get(m.group(1)) == m.group(2):
+                continue
+            lines.append(line)
+        return ''.join(lines)
+
+    def _xml_body(self, out):
+        start = out.index('<rdf:RDF')
+        end_start_tag = out.index('>', start) + 1
+        end = out.rindex('</rdf:RDF>')
+
+        body = out[end_start_tag:end].strip('\n')
+        if not body:
+            return ''
+
+        # namespaces not declared in the header are declared on each top level element
+        missing = [(prefix or '', ns) for prefix, ns in XML_NS_RE.findall(out[start:end_start_tag])
+                   if self._namespaces.get(prefix or '') != ns]
+        if missing:
+            decls = ' '.join(_xmlns(prefix, ns) for prefix, ns in missing)
+            body = re.sub(r'^(\s*<rdf:Description) ', rf'\1 {decls} ', body, flags=re.MULTILINE)
+
+        return body + '\n'
+
+
+def _xmlns(prefix, ns):
+    return f'xmlns:{prefix}="{ns}"' if prefix else f'xmlns="{ns}"'
+
+
+def iter_catalog_datasets(context=None, fq=None, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Yields the public datasets of the catalog, fetching them from the search index page by page
+    """
+    package_search = toolkit.get_action('package_search')
+    start = 0
+    while True:
+        data_dict = {'q': '*:*',
+                     'sort': 'name asc',
+                     'rows': page_size,
+                     'start': start,
+                     }
+        if fq:
+            data_dict['fq'] = fq
+        results = package_search(dict(context or {}), data_dict)['results']
+        yield from results
+
+        if len(results) < page_size:
+            break
+        start += page_size
@@ -2,8 +2,6 @@ import json
 import logging
 
 import ckanext.dcatapit.harvesters.utils as utils
-from ckan import model
-from ckan.model import Session
 from ckan.plugins.core import SingletonPlugin
 from ckanext.dcatapit import interfaces
 from ckanext.dcatapit.model import License
@@ -118,17 +116,27 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
             'form_config_interface': 'Text'
         }
 
+    def _get_harvest_config(self, harvest_object):
+        """
+        Returns the CSWHarvestConfig of the source, created once for each harvest job
+        """
+        key = (harvest_object.harvest_source_id, harvest_object.harvest_job_id) if harvest_object else None
+        if getattr(self, '_harvest_config_key', None) != key or getattr(self, '_harvest_config', None) is None:
+            self._harvest_config = utils.CSWHarvestConfig(self.source_config, self.DEFAULT_CONFIG)
+            self._harvest_config_key = key
+        return self._harvest_config
+
     def get_package_dict(self, iso_values, harvest_object):
         package_dict = super(DCATAPITCSWHarvester, self).get_package_dict(iso_values, harvest_object)
 
-        mapping_frequencies_to_mdr_vocabulary = self.source_config.get('mapping_frequencies_to_mdr_vocabulary',
-                                                                       utils._mapping_frequencies_to_mdr_vocabulary)
-        mapping_languages_to_mdr_vocabulary = self.source_config.get('mapping_languages_to_mdr_vocabulary',
-                                                                     utils._mapping_languages_to_mdr_vocabulary)
+        harvest_config = self._get_harvest_config(harvest_object)
+
+        mapping_frequencies_to_mdr_vocabulary = harvest_config.mapping_frequencies
+        mapping_languages_to_mdr_vocabulary = harvest_config.mapping_languages
 
-        self._ckan_locales_mapping = self.source_config.get('ckan_locales_mapping') or utils._ckan_locales_mapping
+        self._ckan_locales_mapping = harvest_config.ckan_locales_mapping
 
-        dcatapit_config = self.source_config.get('dcatapit_config', self.DEFAULT_CONFIG)
+        dcatapit_config = harvest_config.dcatapit_config
 
         # if dcatapit_config and not all(name in dcatapit_config for name in self._dcatapit_config):
         #    dcatapit_config = self._dcatapit_config
@@ -138,12 +146,8 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         # elif not dcatapit_config:
         #    dcatapit_config = self._dcatapit_config
 
-        controlled_vocabularies = dcatapit_config.get(
-            'controlled_vocabularies',
-            self.DEFAULT_CONFIG.get('controlled_vocabularies'))
-        agents = dcatapit_config.get(
-            'agents',
-            self.DEFAULT_CONFIG.get('agents'))
+        controlled_vocabularies = harvest_config.controlled_vocabularies
+        agents = harvest_config.agents
 
         # ------------------------------#
         #    MANDATORY FOR DCAT-AP_IT   #
@@ -161,7 +165,8 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
             default_vocab_id = self.DEFAULT_CONFIG.get('controlled_vocabularies').get('dcatapit_skos_theme_id')
             dataset_themes = utils.get_controlled_vocabulary_values(
                 'eu_themes',
-                controlled_vocabularies.get('dcatapit_skos_theme_id', default_vocab_id), iso_values['keywords'])
+                controlled_vocabularies.get('dcatapit_skos_theme_id', default_vocab_id), iso_values['keywords'],
+                index=harvest_config.keyword_index('eu_themes'))
 
         if dataset_themes:
             dataset_themes = list(set(dataset_themes))
@@ -178,9 +183,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
 
         #  -- publisher -- #
         agent_name, agent_code = utils.get_responsible_party(
-            iso_values['cited-responsible-party'],
-            agents.get('publisher',
-                       self.DEFAULT_CONFIG.get('agents').get('publisher')))
+            iso_values['cited-responsible-party'], agents['publisher'])
         package_dict['extras'].append({'key': 'publisher_name', 'value': agent_name})
         package_dict['extras'].append({'key': 'publisher_identifier', 'value': agent_code or default_ipa})
 
@@ -197,8 +200,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
 
         #  -- rights_holder -- #
         agent_name, agent_code = utils.get_responsible_party(
-            iso_values['cited-responsible-party'],
-            agents.get('owner', self.DEFAULT_CONFIG.get('agents').get('owner')))
+            iso_values['cited-responsible-party'], agents['owner'])
         package_dict['extras'].append({'key': 'holder_name', 'value': agent_name})
         package_dict['extras'].append({'key': 'holder_identifier', 'value': agent_code or default_ipa})
 
@@ -218,7 +220,8 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
             default_vocab_id = self.DEFAULT_CONFIG.get('controlled_vocabularies').get('dcatapit_skos_theme_id')
             dataset_places = utils.get_controlled_vocabulary_values(
                 'places',
-                controlled_vocabularies.get('dcatapit_skos_places_id', default_vocab_id), iso_values['keywords'])
+                controlled_vocabularies.get('dcatapit_skos_places_id', default_vocab_id), iso_values['keywords'],
+                index=harvest_config.keyword_index('places'))
 
         if dataset_places and len(dataset_places) > 1:
             dataset_places = list(set(dataset_places))
@@ -290,8 +293,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         # ###############
         #  -- creator -- #
         agent_name, agent_code = utils.get_responsible_party(
-            iso_values['cited-responsible-party'],
-            agents.get('author', self.DEFAULT_CONFIG.get('agents').get('author')))
+            iso_values['cited-responsible-party'], agents['author'])
 
         agent_code = agent_code or default_ipa
         if agent_name and agent_code:
@@ -306,15 +308,7 @@ class DCATAPITCSWHarvester(CSWHarvester, SingletonPlugin):
         ckan_license = None
         use_constraints = iso_values.get('use-constraints')
         if use_constraints:
-            use_constraints = use_constraints[0]
-            import ckan.logic.action.get as _license
-            license_list = _license.license_list({'model': model, 'session': Session, 'user': 'harvest'}, {})
-            for license in license_list:
-                if use_constraints == str(license.get('id')) or \
-                        use_constraints == str(license.get('url')) or \
-                        (str(license.get('id')) in use_constraints.lower()):
-                    ckan_license = license
-                    break
+            ckan_license = harvest_config.licenses.find(use_constraints[0])
 
         if ckan_license:
             package_dict['license_id'] = ckan_license.get('id')
@@ -2,7 +2,10 @@ import json
 import logging
 import re
 
-from ckan.model import Session, Tag
+from sqlalchemy import or_
+
+from ckan import model
+from ckan.model import Session, Tag, Vocabulary
 
 from ckanext.dcatapit.model import TagLocalization
 from ckanext.dcatapit.model.license import License
@@ -39,47 +42,89 @@ _ckan_locales_mapping = {
 
 
 def get_responsible_party(citedResponsiblePartys, agent_config):
+    """
+    :param agent_config: an AgentConfig, or the agent dict of the harvest source config
+    """
+    if not isinstance(agent_config, AgentConfig):
+        agent_config = AgentConfig(agent_config)
+
     for party in citedResponsiblePartys:
-        role = agent_config.get('role', None)
+        role = agent_config.role
         if not role:
             log.warning('Warning: Agent role missing in harvest configuration ...')
             continue
 
         if party['role'] == role:
             remote_name = party['organisation-name']
-            parsed_code, parsed_name = get_agent(remote_name, agent_config)
+            parsed_code, parsed_name = agent_config.parse(remote_name)
 
             name = parsed_name or remote_name
-            code = parsed_code or agent_config.get('code', None)
+            code = parsed_code or agent_config.code
 
             return [name, code]
     return [None, None]
 
 
-def get_controlled_vocabulary_values(vocabulary_id, thesaurus_id, keywords):
+def get_controlled_vocabulary_values(vocabulary_id, thesaurus_id, keywords, index=None):
+    """
+    Returns the names of the tags of the vocabulary matching the keywords of the given thesaurus.
+
+    :param index: the KeywordIndex of the vocabulary; if not given, it is loaded from the DB
+    """
     log.debug('::::: Collecting thesaurus data for dcatapit skos {0} from the metadata keywords :::::'.format(vocabulary_id))
 
     values = []
 
-    #
-    # Get all the places tag names by the vocabulary id
-    #
-    tag_names_list = get_vocabulary_tag_names(vocabulary_id)
+    if index is None:
+        index = KeywordIndex.load(vocabulary_id)
 
-    if len(tag_names_list) > 0:
+    if len(index) > 0:
         for key in keywords:
             if thesaurus_id and (thesaurus_id in key['thesaurus-identifier'] or thesaurus_id in key['thesaurus-title']):
                 for k in key['keyword']:
-                    query = Session.query(TagLocalization) \
-                        .filter(TagLocalization.text == k, TagLocalization.tag_name.in_(tag_names_list))
-                    query = query.autoflush(True)
-                    theme = query.first()
-
-                    if theme and theme.tag_name:
-                        values.append(theme.tag_name)
+                    tag_name = index.get(k)
+                    if tag_name:
+                        values.append(tag_name)
     return values
 
 
+def normalize_keyword(keyword):
+    return ' '.join(str(keyword).split()).casefold()
+
+
+class KeywordIndex(object):
+    """
+    In-memory index from the localized labels of the tags of a vocabulary to the tag names.
+
+    Labels in all the languages are normalized (case and whitespaces); if more
+    tags have the same label, the first one loaded is used.
+    """
+
+    def __init__(self, rows=()):
+        self.tags = {}
+        for tag_name, text in rows:
+            if text:
+                self.tags.setdefault(normalize_keyword(text), tag_name)
+
+    def get(self, keyword):
+        return self.tags.get(normalize_keyword(keyword))
+
+    def __len__(self):
+        return len(self.tags)
+
+    @classmethod
+    def load(cls, vocab_id_or_name):
+        q = Session.query(TagLocalization.tag_name, TagLocalization.text)\
+            .join(Tag, Tag.id == TagLocalization.tag_id)\
+            .join(Vocabulary, Vocabulary.id == Tag.vocabulary_id)\
+            .filter(or_(Vocabulary.id == vocab_id_or_name,
+                        Vocabulary.name == vocab_id_or_name))\
+            .order_by(TagLocalization.id)
+        index = cls(q)
+        log.debug(f'Loaded {len(index)} keywords for vocabulary {vocab_id_or_name}')
+        return index
+
+
 def get_vocabulary_tag_names(vocab_id_or_name):
     tag_names_list = []
 
@@ -100,45 +145,126 @@ def get_vocabulary_tag_names(vocab_id_or_name):
 
 
 def get_agent(agent_string, agent_config):
-    # Agent Code
-    code_regex = agent_config.get('code_regex', None)
-    agent_code = re.search(code_regex.get('regex'), agent_string) if code_regex and code_regex.get('regex') else None
+    if not isinstance(agent_config, AgentConfig):
+        agent_config = AgentConfig(agent_config)
+    return agent_config.parse(agent_string)
+
+
+class AgentConfig(object):
+    """
+    Agent configuration of a harvest source, with the code and name regexes compiled
+    """
 
-    if agent_code:
-        regex_groups = code_regex.get('groups', None)
+    def __init__(self, agent_config):
+        agent_config = agent_config or {}
+        self.role = agent_config.get('role')
+        self.code = agent_config.get('code')
+        self.code_regex, self.code_groups = _compile_agent_regex(agent_config.get('code_regex'))
+        self.name_regex, self.name_groups = _compile_agent_regex(agent_config.get('name_regex'))
 
-        if regex_groups:
-            code = ''
-            if isinstance(regex_groups, list) and len(regex_groups) > 0:
-                for group in regex_groups:
-                    code += agent_code.group(group)
-            else:
-                code = agent_code.group(regex_groups)
+    def parse(self, agent_string):
+        """
+        Returns [code, name] parsed from the agent string, None if not matched
+        """
+        agent_code = _search_groups(self.code_regex, self.code_groups, agent_string)
+        if agent_code is not None:
+            agent_code = agent_code.lower().strip()
 
-            agent_code = code
+        agent_name = _search_groups(self.name_regex, self.name_groups, agent_string)
+        if agent_name is not None:
+            agent_name = agent_name.lstrip()
 
-        agent_code = agent_code.lower().strip()
+        return [agent_code, agent_name]
 
-    # Agent Name
-    name_regex = agent_config.get('name_regex', None)
-    agent_name = re.search(name_regex.get('regex'), agent_string) if name_regex and name_regex.get('regex') else None
 
-    if agent_name:
-        regex_groups = name_regex.get('groups', None)
+def _compile_agent_regex(regex_config):
+    if not regex_config or not regex_config.get('regex'):
+        return None, None
+    return re.compile(regex_config['regex']), regex_config.get('groups')
 
-        if regex_groups:
-            code = ''
-            if isinstance(regex_groups, list) and len(regex_groups) > 0:
-                for group in regex_groups:
-                    code += agent_name.group(group)
-            else:
-                code = agent_name.group(regex_groups)
 
-            agent_name = code
+def _search_groups(regex, groups, value):
+    if regex is None:
+        return None
+    match = regex.search(value)
+    if not match:
+        return None
+    if not groups:
+        return match.group(0)
+    if isinstance(groups, list):
+        return ''.join(match.group(group) for group in groups)
+    return match.group(groups)
 
-        agent_name = agent_name.lstrip()
 
-    return [agent_code, agent_name]
+class LicenseMatcher(object):
+    """
+    Lookup of the CKAN licenses matching an ISO use constraint.
+
+    A license matches if its id or url is equal to the constraint, or if its id is
+    contained in the constraint; the first matching license in the list is returned.
+    """
+
+    def __init__(self, licenses):
+        self.licenses = [(str(l.get('id')), l) for l in licenses]
+        self._positions = {}
+        for idx, l in enumerate(licenses):
+            self._positions.setdefault(str(l.get('id')), idx)
+            self._positions.setdefault(str(l.get('url')), idx)
+
+    def find(self, use_constraints):
+        exact = self._positions.get(use_constraints, len(self.licenses))
+        lowered = use_constraints.lower()
+        for license_id, license in self.licenses[:exact]:
+            if license_id in lowered:
+                return license
+        return self.licenses[exact][1] if exact < len(self.licenses) else None
+
+    @classmethod
+    def load(cls):
+        import ckan.logic.action.get as _license
+        return cls(_license.license_list({'model': model, 'session': Session, 'user': 'harvest'}, {}))
+
+
+class CSWHarvestConfig(object):
+    """
+    Configuration of a CSW harvest source, parsed once and reused for all the harvested records.
+
+    Keeps the compiled agent regexes, the value mappings, and lazily loads the
+    CKAN licenses and the keyword indexes of the controlled vocabularies.
+    """
+
+    def __init__(self, source_config, default_config):
+        self.source_config = source_config or {}
+        self.default_config = default_config
+
+        self.mapping_frequencies = self.source_config.get('mapping_frequencies_to_mdr_vocabulary',
+                                                          _mapping_frequencies_to_mdr_vocabulary)
+        self.mapping_languages = self.source_config.get('mapping_languages_to_mdr_vocabulary',
+                                                        _mapping_languages_to_mdr_vocabulary)
+        self.ckan_locales_mapping = self.source_config.get('ckan_locales_mapping') or _ckan_locales_mapping
+
+        self.dcatapit_config = self.source_config.get('dcatapit_config', default_config)
+        self.controlled_vocabularies = self.dcatapit_config.get('controlled_vocabularies',
+                                                                default_config.get('controlled_vocabularies'))
+
+        agents = self.dcatapit_config.get('agents', default_config.get('agents'))
+        self.agents = {role: AgentConfig(agents.get(role, default_config.get('agents').get(role)))
+                       for role in ('publisher', 'owner', 'author')}
+
+        self._licenses = None
+        self._keyword_indexes = {}
+
+    @property
+    def licenses(self):
+        if self._licenses is None:
+            self._licenses = LicenseMatcher.load()
+        return self._licenses
+
+    def keyword_index(self, vocabulary_name):
+        index = self._keyword_indexes.get(vocabulary_name)
+        if index is None:
+            index = self._keyword_indexes[vocabulary_name] = KeywordIndex.load(vocabulary_name)
+        return index
 
 
 def get_license_from_package(pkg_dict):
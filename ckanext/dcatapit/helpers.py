@@ -276,9 +276,10 @@ def get_dcatapit_subthemes(lang):
     def _get_name(opt_val, depth):
         return '{} {}'.format('-' * depth, opt_val)
 
-    for theme in Subtheme.get_theme_names():
+    tree = Subtheme.get_tree()
+    for theme in tree.theme_names():
         out[theme] = theme_l = []
-        for opt, label in Subtheme.for_theme(theme, lang):
+        for opt, label in tree.for_theme(theme, lang):
             theme_l.append({'name': _get_name(label, opt.depth),
                             'value': opt.uri})
     return out
@@ -308,12 +309,13 @@ def dcatapit_string_to_localized_aggregated_themes(value, lang):
     """
     data = dcatapit_string_to_aggregated_themes(value)
     out = []
+    tree = Subtheme.get_tree()
 
     for item in data:
         localized_theme = interfaces.get_localized_tag_name(item['theme'], lang=lang)
         outitem = {'theme': localized_theme,
                    'subthemes': []}
-        from_model = Subtheme.for_theme(item['theme'], lang)
+        from_model = tree.for_theme(item['theme'], lang)
         for st, label in from_model:
             if st.uri in item['subthemes']:
                 outitem['subthemes'].append(label)
@@ -383,3 +385,19 @@ def dataset_is_local(pkg_id):
     q = Session.query(HarvestObject).filter(HarvestObject.package_id == pkg_id).exists()
     is_remote = Session.query(q).scalar()
     return not is_remote
+
+
+def datasets_are_local(pkg_ids):
+    """
+    Bulk version of `dataset_is_local`.
+
+    :return: a dict {pkg_id: is_local} for the given package ids
+    """
+    pkg_ids = set(pkg_ids)
+    if not pkg_ids:
+        return {}
+    q = Session.query(HarvestObject.package_id)\
+        .filter(HarvestObject.package_id.in_(pkg_ids))\
+        .distinct()
+    remote_ids = {row[0] for row in q}
+    return {pkg_id: pkg_id not in remote_ids for pkg_id in pkg_ids}
@@ -1,8 +1,12 @@
 import json
 import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
 from enum import Enum
 
 import ckan.lib.search as search
+import ckan.plugins.toolkit as toolkit
 from ckan.common import config
 from ckan.lib.base import model
 from ckan.lib.i18n import get_lang
@@ -13,9 +17,13 @@ from ckanext.dcatapit.model import (
     License,
     Subtheme,
 )
+from ckanext.dcatapit.model.cache import GenerationCache, bump_generation
 
 log = logging.getLogger(__name__)
 
+# name of the cache generation bumped when an organization is modified
+ORGANIZATIONS_CACHE = 'organizations'
+
 
 class ICustomSchema(Interface):
     """
@@ -74,46 +82,105 @@ def update_solr_package_indexes(package_dict):
     if package_dict:
         log.debug('::: UPDATING SOLR INDEX :::')
 
-        # solr update here
-        psi = search.PackageSearchIndex()
-
-        # update the solr index in batches
-        BATCH_SIZE = 50
-
-        def process_solr(q):
-            # update the solr index for the query
-            query = search.PackageSearchQuery()
-            q = {
-                'q': q,
-                'fl': 'data_dict',
-                'wt': 'json',
-                'fq': 'site_id:"%s"' % config.get('ckan.site_id'),
-                'rows': BATCH_SIZE
-            }
-
-            for result in query.run(q)['results']:
-                data_dict = json.loads(result['data_dict'])
-                if data_dict['owner_org'] == package_dict.get('owner_org'):
-                    psi.index_package(data_dict, defer_commit=True)
-
-        count = 0
-        q = []
-
-        q.append('id:"%s"' % (package_dict.get('id')))
-        count += 1
-        if count % BATCH_SIZE == 0:
-            process_solr(' OR '.join(q))
-            q = []
-
-        if len(q):
-            process_solr(' OR '.join(q))
-        # finally commit the changes
-        psi.commit()
+        queue = SolrIndexQueue()
+        queue.add(package_dict)
+        queue.flush()
     else:
         log.warning('::: package_dict is None: SOLR INDEX CANNOT BE UPDATED! :::')
 
 
-def save_extra_package_multilang(pkg, lang, field_type):
+class SolrIndexQueue(object):
+    """
+    Collects the packages to be reindexed, and reindexes them in batches.
+
+    Packages are reindexed from the data_dict stored in Solr, in batches of BATCH_SIZE,
+    and the Solr commit is only issued by `flush()`, once `commit_every` packages
+    have been reindexed (0 means only on `flush()`), or when no package has been added
+    for `idle_flush` seconds (0 disables it).
+    """
+
+    BATCH_SIZE = 50
+
+    def __init__(self, commit_every=0, idle_flush=0):
+        self.commit_every = commit_every
+        self.idle_flush = idle_flush
+        # package id -> owner_org
+        self._pending = {}
+        # packages reindexed but not committed yet
+        self._uncommitted = 0
+        self._psi = search.PackageSearchIndex()
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def __len__(self):
+        return len(self._pending) + self._uncommitted
+
+    def add(self, package_dict):
+        with self._lock:
+            self._pending[package_dict['id']] = package_dict.get('owner_org')
+
+            if len(self._pending) >= self.BATCH_SIZE:
+                self._reindex()
+            if self.commit_every and len(self) >= self.commit_every:
+                self.flush()
+            else:
+                self._schedule_flush()
+
+    def flush(self):
+        """
+        Reindex all the pending packages and commit
+        """
+        with self._lock:
+            self._cancel_flush()
+            self._reindex()
+            if self._uncommitted:
+                self._psi.commit()
+                log.debug(f'Committed {self._uncommitted} reindexed packages')
+                self._uncommitted = 0
+
+    def _schedule_flush(self):
+        self._cancel_flush()
+        if self.idle_flush and len(self):
+            self._timer = threading.Timer(self.idle_flush, self._flush_idle)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _cancel_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _flush_idle(self):
+        try:
+            self.flush()
+        except Exception:
+            log.error('Cannot commit the reindexed packages', exc_info=True)
+        finally:
+            Session.remove()
+
+    def _reindex(self):
+        if not self._pending:
+            return
+
+        # update the solr index for the query
+        query = search.PackageSearchQuery()
+        q = {
+            'q': ' OR '.join(f'id:"{pkg_id}"' for pkg_id in self._pending),
+            'fl': 'data_dict',
+            'wt': 'json',
+            'fq': 'site_id:"%s"' % config.get('ckan.site_id'),
+            'rows': len(self._pending),
+        }
+
+        for result in query.run(q)['results']:
+            data_dict = json.loads(result['data_dict'])
+            if data_dict['id'] in self._pending and data_dict['owner_org'] == self._pending[data_dict['id']]:
+                self._psi.index_package(data_dict, defer_commit=True)
+                self._uncommitted += 1
+        self._pending = {}
+
+
+def save_extra_package_multilang(pkg, lang, field_type, defer_commit=False):
     try:
         from ckanext.multilang.model import PackageMultilang
     except ImportError:
@@ -121,7 +188,12 @@ def save_extra_package_multilang(pkg, lang, field_type):
         return
 
     log.debug('Creating create_loc_field for package ID: %r', str(pkg.get('id')))
-    PackageMultilang.persist(pkg, lang, field_type)
+    if defer_commit:
+        # committed with the caller's transaction
+        Session.add(PackageMultilang(package_id=pkg.get('id'), field=pkg.get('field'), field_type=field_type,
+                                     lang=lang, text=pkg.get('text')))
+    else:
+        PackageMultilang.persist(pkg, lang, field_type)
     log.info('Localized field created successfully')
 
 
@@ -159,7 +231,86 @@ def upsert_resource_multilang(res_id, field_name, lang, text):
         ml.save()
 
 
-def update_extra_package_multilang(extra, pkg_id, field, lang, field_type='extra'):
+def save_multilang_bulk(pkg_id, package_fields=None, resources_fields=None, field_type='package'):
+    """
+    Same as `upsert_package_multilang` and `upsert_resource_multilang`, for all the
+    localized fields of a package and of its resources at once.
+
+    Existing records are loaded with one query per table, and all the changes are
+    committed together.
+
+    :param package_fields: {field: {lang: text}}
+    :param resources_fields: {resource_id: {field: {lang: text}}}
+    :return: a dict with the number of records created, updated, deleted and unchanged
+    """
+    try:
+        from ckanext.multilang.model import PackageMultilang, ResourceMultilang
+    except ImportError:
+        log.warning('DCAT-AP_IT: multilang extension not available.')
+        return
+
+    cnt = Counter()
+
+    try:
+        if package_fields:
+            existing = {}
+            q = Session.query(PackageMultilang)\
+                .filter(PackageMultilang.package_id == pkg_id,
+                        PackageMultilang.field_type == field_type)
+            for ml in q:
+                existing.setdefault((ml.field, ml.lang), ml)
+
+            for field, lang_dict in package_fields.items():
+                for lang, text in lang_dict.items():
+                    action = _diff_multilang(existing.get((field, lang)), text)
+                    if action == 'created':
+                        Session.add(PackageMultilang(package_id=pkg_id, field=field, field_type=field_type,
+                                                     lang=lang, text=text))
+                    cnt[f'package_{action}'] += 1
+
+        if resources_fields:
+            existing = {}
+            q = Session.query(ResourceMultilang)\
+                .filter(ResourceMultilang.resource_id.in_(list(resources_fields.keys())))
+            for ml in q:
+                existing.setdefault((ml.resource_id, ml.field, ml.lang), ml)
+
+            for res_id, res_dict in resources_fields.items():
+                for field, lang_dict in res_dict.items():
+                    for lang, text in lang_dict.items():
+                        action = _diff_multilang(existing.get((res_id, field, lang)), text)
+                        if action == 'created':
+                            Session.add(ResourceMultilang(res_id, field, lang, text))
+                        cnt[f'resource_{action}'] += 1
+
+        Session.commit()
+    except Exception:
+        # leave a clean session to the caller
+        Session.rollback()
+        raise
+    return dict(cnt)
+
+
+def _diff_multilang(ml, text):
+    """
+    Apply `text` to the existing multilang record `ml`, and return the action performed.
+    New records are left to the caller.
+    """
+    if not ml:
+        return 'created' if text else 'unchanged'
+    if not text:
+        Session.delete(ml)
+        return 'deleted'
+    if ml.text != text:
+        ml.text = text
+        return 'updated'
+    return 'unchanged'
+
+
+def update_extra_package_multilang(extra, pkg_id, field, lang, field_type='extra', defer_commit=False):
+    """
+    With `defer_commit` the changes are left to the caller's transaction
+    """
     try:
         from ckanext.multilang.model import PackageMultilang
     except ImportError:
@@ -172,17 +323,22 @@ def update_extra_package_multilang(extra, pkg_id, field, lang, field_type='extra
         f = PackageMultilang.get(pkg_id, field['name'], lang, field_type)
         if f:
             if extra.get('value') == '':
-                f.purge()
+                if defer_commit:
+                    Session.delete(f)
+                else:
+                    f.purge()
             elif f.text != extra.get('value'):
                 # Update the localized field value for the current language
                 f.text = extra.get('value')
-                f.save()
+                if not defer_commit:
+                    f.save()
 
                 log.info('Localized field updated successfully')
 
         elif extra.get('value') != '':
             # Create the localized field record
-            save_extra_package_multilang({'id': pkg_id, 'text': extra.get('value'), 'field': extra.get('key')}, lang, 'extra')
+            save_extra_package_multilang({'id': pkg_id, 'text': extra.get('value'), 'field': extra.get('key')},
+                                         lang, 'extra', defer_commit=defer_commit)
 
 
 def get_localized_field_value(field=None, pkg_id=None, field_type='extra'):
@@ -222,6 +378,10 @@ def get_for_package(pkg_id):
         # TODO: if no multilang, return the dataset in a single language in the same format of the multilang data
         return None
 
+    prefetch = _get_multilang_prefetch()
+    if prefetch is not None and pkg_id in prefetch.packages:
+        return dict(prefetch.packages[pkg_id])
+
     records = PackageMultilang.get_for_package(pkg_id)
     return _multilang_to_dict(records)
 
@@ -241,6 +401,10 @@ def get_for_group_or_organization(pkg_id):
 
         # TODO: if no multilang, return the dataset in a single language in the same format of the multilang data
         return None
+    prefetch = _get_multilang_prefetch()
+    if prefetch is not None and pkg_id in prefetch.groups:
+        return dict(prefetch.groups[pkg_id])
+
     records = GroupMultilang.get_for_group_id(pkg_id)
     return _multilang_to_dict(records)
 
@@ -260,6 +424,10 @@ def get_for_resource(res_id):
 
         return None
 
+    prefetch = _get_multilang_prefetch()
+    if prefetch is not None and res_id in prefetch.resources:
+        return dict(prefetch.resources[res_id])
+
     records = ResourceMultilang.get_for_resource_id(res_id)
     return _multilang_to_dict(records)
 
@@ -281,6 +449,76 @@ def _multilang_to_dict(records):
     return fields_dict
 
 
+class MultilangPrefetch(object):
+    """
+    Localized fields of a page of datasets, of their organizations and of their resources.
+
+    Each dict maps an id to the localized fields, in the same format returned
+    by `get_for_package`; ids without localized fields are mapped to an empty dict.
+    """
+
+    def __init__(self, packages=None, groups=None, resources=None):
+        self.packages = packages or {}
+        self.groups = groups or {}
+        self.resources = resources or {}
+
+    @classmethod
+    def load(cls, dataset_dicts):
+        """
+        Loads the localized fields for the dataset dicts, with one query for each kind of object.
+
+        Returns None if multilang extension not loaded.
+        """
+        try:
+            from ckanext.multilang.model import GroupMultilang, PackageMultilang, ResourceMultilang
+        except ImportError:
+            log.warning('DCAT-AP_IT: multilang extension not available.')
+            return None
+
+        pkg_ids = set()
+        group_ids = set()
+        res_ids = set()
+        for dataset_dict in dataset_dicts:
+            pkg_ids.add(dataset_dict['id'])
+            if dataset_dict.get('owner_org'):
+                group_ids.add(dataset_dict['owner_org'])
+            res_ids.update(r['id'] for r in dataset_dict.get('resources') or [])
+
+        return cls(_load_multilang(PackageMultilang, PackageMultilang.package_id, pkg_ids),
+                   _load_multilang(GroupMultilang, GroupMultilang.group_id, group_ids),
+                   _load_multilang(ResourceMultilang, ResourceMultilang.resource_id, res_ids))
+
+
+def _load_multilang(model_class, id_column, ids):
+    by_id = {obj_id: [] for obj_id in ids}
+    if ids:
+        for record in Session.query(model_class).autoflush(False).filter(id_column.in_(ids)):
+            by_id[getattr(record, id_column.key)].append(record)
+    return {obj_id: _multilang_to_dict(records) for obj_id, records in by_id.items()}
+
+
+_multilang_prefetch = threading.local()
+
+
+def _get_multilang_prefetch():
+    return getattr(_multilang_prefetch, 'value', None)
+
+
+@contextmanager
+def prefetch_multilang(dataset_dicts):
+    """
+    Within this context, the localized fields of the given datasets, of their organizations
+    and of their resources are read by `get_for_package`, `get_for_group_or_organization`
+    and `get_for_resource` from memory, after being loaded with three queries.
+    """
+    previous = _get_multilang_prefetch()
+    _multilang_prefetch.value = MultilangPrefetch.load(dataset_dicts)
+    try:
+        yield _multilang_prefetch.value
+    finally:
+        _multilang_prefetch.value = previous
+
+
 class DBAction(Enum):
     ERROR = -1
     NONE = 0
@@ -324,21 +562,15 @@ def get_localized_tag_name(tag_name=None, fallback_lang=None, lang=None):
         if lang is None:
             lang = get_language()
 
-        localized_tag_name = TagLocalization.by_name(tag_name, lang)
+        labels = TagLocalization.get_labels()
+        localized_tag_name = labels.get_by_name(tag_name, lang)
 
         if localized_tag_name:
-            return localized_tag_name.text
+            return localized_tag_name
+        elif fallback_lang:
+            return labels.get_by_name(tag_name, fallback_lang) or tag_name
         else:
-            if fallback_lang:
-                fallback_name = TagLocalization.by_name(tag_name, fallback_lang)
-
-                if fallback_name:
-                    fallback_name = fallback_name.text
-                    return fallback_name
-                else:
-                    return tag_name
-            else:
-                return tag_name
+            return tag_name
     else:
         return None
 
@@ -347,12 +579,11 @@ def get_localized_tag_by_id(tag_id, lang=None):
     if lang is None:
         lang = get_language()
 
-    localized_tag_name = TagLocalization.by_tag_id(tag_id, lang)
-    return localized_tag_name.text if localized_tag_name else None
+    return TagLocalization.get_labels().get_by_id(tag_id, lang)
 
 
 def get_all_localized_tag_labels(tag_name):
-    return TagLocalization.all_by_name(tag_name)
+    return TagLocalization.get_labels().get_all_by_name(tag_name)
 
 
 def get_resource_licenses_tree(value, lang):
@@ -371,33 +602,36 @@ def get_resource_licenses_tree(value, lang):
 
 
 def get_license_for_dcat(license_type):
-    l = License.get(license_type or License.DEFAULT_LICENSE)
+    l = License.get_record(license_type or License.DEFAULT_LICENSE)
     if not l or not l.license_type:
-        l = License.get(License.DEFAULT_LICENSE)
+        l = License.get_record(License.DEFAULT_LICENSE)
     if not l:
         log.error('*** Licenses vocabulary has not been loaded ***')
         return None, '-', None, None, None, None
-    names = dict((k['lang'], k['name']) for k in l.get_names())
+    names = dict(l.names)
     return l.license_type, l.default_name, l.document_uri, l.version, l.uri, names
 
 
 def get_license_from_dcat(license_uri, license_dct, prefname, **license_names):
+    """
+    Returns the LicenseRecord matching the dcat license info
+    """
     # First try dcatapit info
-    l = License.get(license_uri)
+    l = License.get_record(license_uri)
 
     if not l and prefname:
-        l = License.get(prefname)
+        l = License.get_record(prefname)
 
     if not l:
         for lang, name in license_names.items():
-            l = License.get_by_lang(lang, name)
+            l = License.get_record_by_lang(lang, name)
             if l:
                 break
     if not l and license_dct:
         # try and use DCT licence URI (usually level 2 in DCATAPIT voc)
-        l = License.get(license_dct)
+        l = License.get_record(license_dct)
 
-    return l or License.get(License.DEFAULT_LICENSE)
+    return l or License.get_record(License.DEFAULT_LICENSE)
 
 
 def get_localized_subtheme(subtheme, lang):
@@ -409,7 +643,7 @@ def get_localized_subtheme(subtheme, lang):
 
 def get_localized_subthemes(subthemes):
 
-    q = Subtheme.get_localized(*subthemes)
+    q = Subtheme.get_localized_memo(*subthemes)
     out = {}
     for item in q:
         lang, label = item  # .lang, item.label
@@ -420,6 +654,40 @@ def get_localized_subthemes(subthemes):
     return out
 
 
+def get_organization_for_index(org_id):
+    """
+    Returns the organization dict used when indexing the datasets it owns.
+
+    Datasets are indexed one by one, so while rebuilding the search index the
+    same organizations are requested over and over: the dicts are memoized
+    until an organization is modified (see `invalidate_organizations`).
+    The returned dict must not be modified.
+    """
+    memo = _org_index_memo.get()
+    org = memo.get(org_id)
+    if org is None:
+        from ckanext.dcatapit.helpers import get_org_context
+
+        organization_show = toolkit.get_action('organization_show')
+        org = organization_show(get_org_context(), {'id': org_id,
+                                                    'include_tags': False,
+                                                    'include_users': False,
+                                                    'include_groups': False,
+                                                    'include_extras': True,
+                                                    'include_followers': False,
+                                                    'include_datasets': False,
+                                                    })
+        memo[org_id] = org
+    return org
+
+
+def invalidate_organizations():
+    bump_generation(ORGANIZATIONS_CACHE)
+
+
+_org_index_memo = GenerationCache(ORGANIZATIONS_CACHE, dict)
+
+
 def populate_resource_license(package_dict):
     license_id = package_dict.get('license_id')
     license_url = None
@@ -1,10 +1,14 @@
 import json
 import logging
 import os
+import threading
 from configparser import SafeConfigParser as ConfigParser
+from types import MappingProxyType
+
+from sqlalchemy import or_
 
 from ckan.lib.base import config
-from ckan.model import Session
+from ckan.model import Package, PackageExtra, Session
 from ckan.model.group import Group, Member
 from ckan.plugins import toolkit
 
@@ -16,6 +20,10 @@ log = logging.getLogger(__name__)
 DCATAPIT_THEMES_MAP = 'ckanext.dcatapit.nonconformant_themes_mapping.file'
 DCATAPIT_THEMES_MAP_SECTION = 'terms_theme_mapping'
 
+# parsed mapping files: (path, loader) -> (mtime, size, mapping)
+_mapping_files = {}
+_mapping_files_lock = threading.Lock()
+
 
 def themes_to_aggr_json(themes: list) -> str:
     aggr = []
@@ -107,18 +115,30 @@ def _map_themes_ini(fdesc):
     return out
 
 
-def _load_mapping_data():
+def _load_mapping_file(fpath, loader):
     """
-    Retrives mapping data depending on configuration.
+    Returns the mapping parsed from the file by `loader`, as a read-only dict of tuples.
 
-    :returns: dict with from->[to] mapping or None, if no configuration is available
+    The parsed mapping is kept in memory, and the file is parsed again only
+    when its modification time or size changes.
     """
-    fpath = config.get(DCATAPIT_THEMES_MAP)
-    if not fpath:
-        return
-    if not os.path.exists(fpath):
-        log.warning("Mapping themes in %s doesn't exist", fpath)
-        return
+    fpath = os.path.abspath(fpath)
+    stat = os.stat(fpath)
+    key = (fpath, loader)
+
+    cached = _mapping_files.get(key)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+
+    with _mapping_files_lock:
+        data = loader(fpath)
+        if data is not None:
+            data = MappingProxyType({k: tuple(v) for k, v in data.items()})
+        _mapping_files[key] = (stat.st_mtime_ns, stat.st_size, data)
+    return data
+
+
+def _read_mapping_data(fpath):
     base, ext = os.path.splitext(fpath)
     if ext == '.json':
         handler = _map_themes_json
@@ -126,9 +146,22 @@ def _load_mapping_data():
         handler = _map_themes_ini
 
     with open(fpath) as f:
-        map_data = handler(f)
+        return handler(f)
+
+
+def _load_mapping_data():
+    """
+    Retrives mapping data depending on configuration.
 
-        return map_data
+    :returns: read-only dict with from->(to) mapping or None, if no configuration is available
+    """
+    fpath = config.get(DCATAPIT_THEMES_MAP)
+    if not fpath:
+        return
+    if not os.path.exists(fpath):
+        log.warning("Mapping themes in %s doesn't exist", fpath)
+        return
+    return _load_mapping_file(fpath, _read_mapping_data)
 
 
 def _get_new_themes(from_groups, map_data, add_existing=True):
@@ -254,10 +287,15 @@ MAPPING_SECTION = 'dcatapit:theme_group_mapping'
 DCATAPIT_THEME_TO_MAPPING_SOURCE = 'ckanext.dcatapit.theme_group_mapping.file'
 DCATAPIT_THEME_TO_MAPPING_ADD_NEW_GROUPS = 'ckanext.dcatapit.theme_group_mapping.add_new_groups'
 
+# datasets processed at once by populate_theme_groups_bulk
+DEFAULT_CHUNK_SIZE = 500
+
 
 def get_theme_to_groups():
     """
-    Returns dictionary with groups for themes
+    Returns read-only dictionary with groups for themes
+
+    The mapping file is parsed again only when it changes.
     """
     fname = config.get(DCATAPIT_THEME_TO_MAPPING_SOURCE)
     if not fname:
@@ -265,7 +303,7 @@ def get_theme_to_groups():
     if not os.path.exists(fname):
         log.warning('Cannot parse theme mapping, no such file: %s', fname)
         return
-    return import_theme_to_group(fname)
+    return _load_mapping_file(fname, import_theme_to_group)
 
 
 def _clean_groups(package):
@@ -276,63 +314,104 @@ def _clean_groups(package):
         package_id = package['id']
     else:
         package_id = package.id
+    _clean_packages_groups([package_id])
+
+
+def _clean_packages_groups(package_ids):
+    """
+    Removes the packages from their groups; organizations are not affected
+    """
+    group_ids = Session.query(Group.id).filter(Group.type == 'group')
     Session.query(Member).filter(Member.table_name == 'package',
-                                 Member.table_id == package_id,
+                                 Member.table_id.in_(package_ids),
+                                 Member.group_id.in_(group_ids.subquery()),
                                  Member.capacity != 'admin')\
-        .update({'state': 'deleted'})
+        .update({'state': 'deleted'}, synchronize_session='fetch')
 
 
 def _add_groups(package_id, groups):
     """
     Adds groups to package
     """
-    for g in groups:
-        if g.id is None:
-            raise ValueError('No id in group %s' % g)
-
-        q = Session.query(Member).filter_by(state='active',
-                                            table_id=package_id,
-                                            group_id=g.id,
-                                            table_name='package')
-        # this group is already added to package, skipping
-        # note: this will work with groups flushed to db
-        if Session.query(q.exists()).scalar():
-            continue
-
-        member = Member(state='active',
-                        table_id=package_id,
-                        group_id=g.id,
-                        group=g,
-                        table_name='package')
-        Session.add(member)
-
-
-def _get_group_from_session(gname):
-    """
-    If Group was created within current session, get
-    it from cache instead of db.
+    return _add_packages_groups({package_id: groups})
+
 
-    This exists because new, uncommited/unflushed objects are
-    not accessible by Session.query.
+def _add_packages_groups(packages_groups):
     """
-    for obj in Session.new:
-        if isinstance(obj, Group):
-            if obj.name == gname:
-                return obj
+    Adds the packages to their groups, skipping the existing memberships.
 
+    :param packages_groups: dict package id -> iterable of Groups
+    :returns: set of ids of the packages added to some group
+    """
+    group_ids = set()
+    for groups in packages_groups.values():
+        for g in groups:
+            if g.id is None:
+                raise ValueError('No id in group %s' % g)
+            group_ids.add(g.id)
+    if not group_ids:
+        return set()
+
+    # note: this will work with groups flushed to db
+    existing = set(Session.query(Member.table_id, Member.group_id)
+                   .filter(Member.state == 'active',
+                           Member.table_name == 'package',
+                           Member.table_id.in_(list(packages_groups.keys())),
+                           Member.group_id.in_(group_ids)))
+
+    members = []
+    for package_id, groups in packages_groups.items():
+        for g in set(groups):
+            if (package_id, g.id) in existing:
+                continue
+            members.append(Member(state='active',
+                                  table_id=package_id,
+                                  group_id=g.id,
+                                  group=g,
+                                  table_name='package'))
+    Session.add_all(members)
+    return {m.table_id for m in members}
+
+
+def _resolve_groups(names, add_new=False):
+    """
+    Returns a dict name -> Group for the given group names (or ids).
 
-def populate_theme_groups(instance, clean_existing=False):
+    Groups are loaded with a single query; groups created within the current
+    session and not flushed yet are found as well, since uncommited/unflushed
+    objects are not accessible by Session.query.
+    If `add_new` is set, missing groups are created and flushed, so they have an id.
     """
-    For given instance, it finds groups from mapping corresponding to
-    Dataset's themes, and will assign dataset to those groups.
+    names = set(names)
+    if not names:
+        return {}
+
+    groups = {}
+    for group in Session.query(Group)\
+            .filter(or_(Group.name.in_(names), Group.id.in_(names))):
+        groups[group.name if group.name in names else group.id] = group
+
+    missing = names - groups.keys()
+    if missing:
+        for obj in Session.new:
+            if isinstance(obj, Group) and obj.name in missing:
+                groups[obj.name] = obj
+
+    if add_new:
+        for gname in names - groups.keys():
+            group = groups[gname] = Group(name=gname)
+            Session.add(group)
 
-    Existing groups will be removed, if clean_existing is set to True.
+    if any(g.id is None for g in groups.values()):
+        # flush to db, refresh with ids
+        Session.flush()
+    return groups
 
-    This utilizes `ckanext.dcatapit.theme_group_mapping.add_new_groups`
-    configuration option. If it's set to true, and mapped group doesn't exist,
-    new group will be created.
+
+def _get_instance_themes(instance):
+    """
+    Returns the theme names of a package dict, from the aggregated themes or from the theme extra
     """
-    add_new = toolkit.asbool(config.get(DCATAPIT_THEME_TO_MAPPING_ADD_NEW_GROUPS))
     themes = []
     for ex in (instance.get('extras') or []):
         if ex['key'] == FIELD_THEMES_AGGREGATE:
@@ -364,6 +443,32 @@ def populate_theme_groups(instance, clean_existing=False):
 
                 themes.extend(tval)
             # dont break the for loop: if aggregates are there, they get precedence
+    return themes
+
+
+def _get_group_names(themes, theme_map):
+    names = set()
+    for theme in themes:
+        for gname in theme_map.get(theme) or ():
+            gname = gname.strip()
+            if gname:
+                names.add(gname)
+    return names
+
+
+def populate_theme_groups(instance, clean_existing=False):
+    """
+    For given instance, it finds groups from mapping corresponding to
+    Dataset's themes, and will assign dataset to those groups.
+
+    Existing groups will be removed, if clean_existing is set to True.
+
+    This utilizes `ckanext.dcatapit.theme_group_mapping.add_new_groups`
+    configuration option. If it's set to true, and mapped group doesn't exist,
+    new group will be created.
+    """
+    add_new = toolkit.asbool(config.get(DCATAPIT_THEME_TO_MAPPING_ADD_NEW_GROUPS))
+    themes = _get_instance_themes(instance)
 
     if not themes:
         log.debug('no theme from %s', instance)
@@ -375,36 +480,76 @@ def populate_theme_groups(instance, clean_existing=False):
         return instance
     if not isinstance(themes, list):
         themes = [themes]
-    all_groups = set()
-    for theme in themes:
-        _groups = theme_map.get(theme)
-        if not _groups:
-            continue
-        all_groups = all_groups.union(set(_groups))
+
     if clean_existing:
         _clean_groups(instance)
-    groups = []
-    for gname in all_groups:
-        gname = gname.strip()
-        if not gname:
-            continue
-        group = Group.get(gname) or _get_group_from_session(gname)
-        if add_new and group is None:
-            group = Group(name=gname)
-            Session.add(group)
-        if group:
-            groups.append(group)
-
-    if Session.new:
-        # flush to db, refresh with ids
-        Session.flush()
-        groups = [(Group.get(g.name) if g.id is None else g) for g in groups]
-    _add_groups(instance['id'], set(groups))
+    groups = _resolve_groups(_get_group_names(themes, theme_map), add_new)
+    _add_groups(instance['id'], groups.values())
 
     Session.flush()
     return instance
 
 
+def populate_theme_groups_bulk(chunk_size=DEFAULT_CHUNK_SIZE, clean_existing=False):
+    """
+    Applies the theme to group mapping to all the active datasets, `chunk_size` datasets at a time.
+
+    For each chunk the themes, the groups and the existing memberships are loaded
+    with one query each, the missing memberships are inserted together and committed.
+
+    :returns: generator yielding, for each chunk, the ids of the updated datasets
+    """
+    add_new = toolkit.asbool(config.get(DCATAPIT_THEME_TO_MAPPING_ADD_NEW_GROUPS))
+    theme_map = get_theme_to_groups()
+    if not theme_map:
+        log.warning('Theme to group map is empty')
+        return
+
+    groups = {}
+    last_id = None
+    while True:
+        q = Session.query(Package.id)\
+            .filter(Package.state == 'active', Package.type == 'dataset')\
+            .order_by(Package.id)\
+            .limit(chunk_size)
+        if last_id is not None:
+            q = q.filter(Package.id > last_id)
+        package_ids = [pkg_id for (pkg_id,) in q]
+        if not package_ids:
+            break
+        last_id = package_ids[-1]
+
+        instances = {pkg_id: {'id': pkg_id, 'extras': []} for pkg_id in package_ids}
+        extras = Session.query(PackageExtra.package_id, PackageExtra.key, PackageExtra.value)\
+            .filter(PackageExtra.package_id.in_(package_ids),
+                    PackageExtra.key.in_([FIELD_THEMES_AGGREGATE, 'theme']),
+                    PackageExtra.state == 'active')\
+            .order_by(PackageExtra.package_id, PackageExtra.key)
+        for pkg_id, key, value in extras:
+            instances[pkg_id]['extras'].append({'key': key, 'value': value})
+
+        # as in populate_theme_groups, datasets without themes are left untouched
+        packages_names = {}
+        for pkg_id, instance in instances.items():
+            themes = _get_instance_themes(instance)
+            if themes:
+                packages_names[pkg_id] = _get_group_names(themes, theme_map)
+
+        missing = set().union(*packages_names.values()) - groups.keys()
+        groups.update(_resolve_groups(missing, add_new))
+
+        cleaned = set()
+        if clean_existing and packages_names:
+            cleaned = set(packages_names.keys())
+            _clean_packages_groups(list(cleaned))
+        updated = _add_packages_groups({pkg_id: [groups[n] for n in names if n in groups]
+                                        for pkg_id, names in packages_names.items() if names})
+        Session.commit()
+
+        log.debug(f'Processed {len(package_ids)} datasets, {len(updated)} added to groups')
+        yield cleaned | updated
+
+
 def import_theme_to_group(fname):
     """
     Import theme to group mapping configuration from path
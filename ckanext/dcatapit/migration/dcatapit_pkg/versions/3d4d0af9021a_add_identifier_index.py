@@ -0,0 +1,27 @@
+"""Add dataset identifier index
+
+Revision ID: 3d4d0af9021a
+Revises: d54a365195ea
+Create Date: 2026-10-18 10:12:41.218305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3d4d0af9021a'
+down_revision = 'd54a365195ea'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Partial index on the hash of the value, so that the uniqueness check on the
+    # dataset identifier is a single index probe, whatever the length of the value.
+    # Using op.execute in order not to raise error if the index was created by `dcatapit initdb`
+    op.execute('CREATE INDEX IF NOT EXISTS dcatapit_package_extra_identifier_idx '
+               "ON package_extra (md5(value)) WHERE key = 'identifier'")
+
+
+def downgrade():
+    op.execute('DROP INDEX IF EXISTS dcatapit_package_extra_identifier_idx')
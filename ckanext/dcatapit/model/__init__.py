@@ -1,6 +1,9 @@
 # this is a namespace package
 import logging
 
+from ckan.model import meta
+from sqlalchemy import text
+
 from ckanext.dcatapit.model.license import License, LocalizedLicenseName
 
 from ckanext.dcatapit.model.subtheme import ThemeToSubtheme, Subtheme, SubthemeLabel
@@ -12,12 +15,19 @@ log = logging.getLogger(__name__)
 
 __all__ = ['setup']
 
+# also created by the dcatapit_pkg migration 3d4d0af9021a
+IDENTIFIER_INDEX = 'dcatapit_package_extra_identifier_idx'
+
+# DB session and connection pool inherited by a forked worker process
+_inherited_connections = []
+
 
 def setup_db():
     log.debug('Setting up DCATAPIT tables...')
     created = setup_vocabulary_models()
     created = setup_subtheme_models() or created
     created = setup_license_models() or created
+    created = setup_identifier_index() or created
 
     return created
 
@@ -74,3 +84,32 @@ def setup_license_models():
             log.debug(f'DCATAPIT: table {t.name} already exists')
 
     return created
+
+
+def setup_identifier_index():
+    """
+    Index on the dataset identifier extra, used by the `dcatapit_id_unique` validator
+    """
+    exists = meta.engine.execute(text('SELECT 1 FROM pg_indexes WHERE indexname = :name'),
+                                 name=IDENTIFIER_INDEX).first()
+    if exists:
+        log.debug(f'DCATAPIT: index {IDENTIFIER_INDEX} already exists')
+        return False
+
+    log.info(f'DCATAPIT: creating index {IDENTIFIER_INDEX}')
+    meta.engine.execute(f'CREATE INDEX IF NOT EXISTS {IDENTIFIER_INDEX} '
+                        "ON package_extra (md5(value)) WHERE key = 'identifier'")
+    return True
+
+
+def detach_db_connections():
+    """
+    To be called in a forked worker process, before using the DB.
+
+    The DB session and connections are inherited from the parent process, which is
+    still using them: keep them referenced, so that they are never closed or rolled
+    back from here, and let this process open its own connections when needed.
+    """
+    _inherited_connections.append((meta.Session.registry(), meta.engine.pool))
+    meta.Session.registry.clear()
+    meta.engine.pool = meta.engine.pool.recreate()
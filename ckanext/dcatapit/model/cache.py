@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+
+from ckan.common import config
+from ckan.model import meta
+from ckan.model.system_info import SystemInfo
+
+log = logging.getLogger(__name__)
+
+__all__ = ['GenerationCache', 'bump_generation']
+
+CONFIG_CHECK_INTERVAL = 'ckanext.dcatapit.cache.check_interval'
+DEFAULT_CHECK_INTERVAL = 60
+
+GENERATION_KEY = 'dcatapit.cache.{}.generation'
+
+
+def _get_check_interval():
+    try:
+        return int(config.get(CONFIG_CHECK_INTERVAL, DEFAULT_CHECK_INTERVAL))
+    except (TypeError, ValueError):
+        return DEFAULT_CHECK_INTERVAL
+
+
+def _get_db_generation(name):
+    obj = meta.Session.query(SystemInfo).filter_by(key=GENERATION_KEY.format(name)).first()
+    return obj.value if obj else None
+
+
+def bump_generation(name):
+    """
+    Invalidate all the caches registered for the given generation name.
+
+    Caches in the current process are dropped immediately; the new generation value
+    is stored in the `system_info` table within the current transaction, so other
+    processes will notice it (after the commit) within the configured check interval.
+    """
+    key = GENERATION_KEY.format(name)
+    value = str(time.time())
+
+    obj = meta.Session.query(SystemInfo).filter_by(key=key).first()
+    if obj:
+        obj.value = value
+    else:
+        obj = SystemInfo(key, value)
+    meta.Session.add(obj)
+
+    for cache in GenerationCache.registry.get(name, []):
+        cache.clear()
+    log.debug(f'DCATAPIT: bumped cache generation {name} to {value}')
+
+
+class GenerationCache(object):
+    """
+    Process-wide cache for data loaded from the DB.
+
+    The value is built by `loader` on first access and kept until the named
+    generation is bumped with `bump_generation()`.
+    """
+
+    registry = {}
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+        self._lock = threading.Lock()
+        self._value = None
+        self._generation = None
+        self._checked_at = 0
+        GenerationCache.registry.setdefault(name, []).append(self)
+
+    def clear(self):
+        self._value = None
+
+    def _is_stale(self):
+        interval = _get_check_interval()
+        now = time.monotonic()
+        if now - self._checked_at < interval:
+            return False
+        self._checked_at = now
+        return _get_db_generation(self.name) != self._generation
+
+    def get(self):
+        value = self._value
+        if value is not None and not self._is_stale():
+            return value
+
+        with self._lock:
+            if self._value is None or self._value is value:
+                generation = _get_db_generation(self.name)
+                self._value = self.loader()
+                self._generation = generation
+                self._checked_at = time.monotonic()
+                log.debug(f'DCATAPIT: loaded cache {self.name} (generation {generation})')
+            return self._value
@@ -5,9 +5,11 @@ from ckan.model import meta, DomainObject
 from sqlalchemy import Column, ForeignKey, orm, types
 from sqlalchemy.ext.declarative import declarative_base
 
+from ckanext.dcatapit.model.cache import GenerationCache, bump_generation
+
 log = logging.getLogger(__name__)
 
-__all__ = ['License', 'LocalizedLicenseName']
+__all__ = ['License', 'LocalizedLicenseName', 'LicenseRecord']
 
 DeclarativeBase = declarative_base(metadata=meta.metadata)
 
@@ -38,6 +40,9 @@ GNU_LICENSE = re.compile(r'https{0,1}://www.gnu.org/licenses/(?P<license>[\w\-\.
 
 LICENSES = (CC_LICENSE, OPENDATA_LICENSE, DATI_LICENSE, FORMEZ_LICENSE, GNU_LICENSE,)
 
+# name of the cache generation bumped when the licenses vocabulary changes
+LICENSES_CACHE = 'licenses'
+
 
 class License(DeclarativeBase, DomainObject):
     __tablename__ = 'dcatapit_license'
@@ -70,22 +75,44 @@ class License(DeclarativeBase, DomainObject):
             * document uri (dcatapit reference to normative doc)
             * license name (dcatapit refererence from foaf:name)
             * license_type (dcat uri)
+
+        Matching is done against the in-memory license index, so only the
+        License instance itself may be loaded from the DB.
         """
-        inst = None
-        try:
-            inst = cls.q().filter_by(id=int(id_or_uri)).first()
-        except ValueError:
-            pass
-        if not inst:
-            inst = cls.q().filter_by(uri=id_or_uri).order_by(License.rank_order).first()
-        if not inst:
-            inst = cls.q().filter_by(document_uri=id_or_uri).first()
-        if not inst:
-            inst = cls.q().filter_by(default_name=id_or_uri).first()
-        if not inst:
-            inst = cls.q().filter_by(license_type=id_or_uri).first()
+        return cls._get_from_index(lambda index: index.resolve(id_or_uri))
 
-        return inst
+    @classmethod
+    def get_record(cls, id_or_uri):
+        """
+        Same as `get`, but returns the LicenseRecord from the license index,
+        so no query is performed once the index is loaded.
+        """
+        return _license_index.get().resolve(id_or_uri)
+
+    @classmethod
+    def get_record_by_lang(cls, lang, label):
+        """
+        Same as `get_by_lang`, but returns the LicenseRecord from the license index.
+        """
+        return _license_index.get().by_lang.get((lang, label))
+
+    @classmethod
+    def _get_from_index(cls, lookup):
+        """
+        Return the License instance for the LicenseRecord returned by `lookup(index)`.
+
+        If the License is not in the DB anymore, the licenses have been reloaded by
+        another process: the index is rebuilt and the lookup retried once.
+        """
+        for attempt in range(2):
+            record = lookup(_license_index.get())
+            if record is None:
+                return None
+            inst = cls.Session.query(cls).get(record.id)
+            if inst is not None:
+                return inst
+            _license_index.clear()
+        return None
 
     def __str__(self):
         return 'License({}/version {}: {}{})'.format(self.license_type, self.version, self.default_name, ' [doc: {}]'.format(self.document_uri) if self.document_uri else '')
@@ -175,11 +202,12 @@ class License(DeclarativeBase, DomainObject):
         cls.Session.query(LocalizedLicenseName).delete()
         cls.Session.query(cls).delete()
         cls.Session.flush()
+        bump_generation(LICENSES_CACHE)
 
     @classmethod
     def get_as_tokens(cls):
         out = {}
-        for l in cls.q():
+        for l in cls.q().order_by(cls.id):
             tokens = l.generate_tokens()
             for t in tokens:
                 try:
@@ -206,20 +234,18 @@ class License(DeclarativeBase, DomainObject):
 
         :rtype: (License, bool,)
         """
-        # get list of token-> license mapping
-        tokenized = cls.get_as_tokens()
-
-        # generate tokens from input
-        normalized_tokens = cls.generate_tokens_from_str(*search_for)
-        for token in normalized_tokens:
-            try:
-                from_tokenized = tokenized[token]
-                from_tokenized.sort(key=lambda t: t.version or t.rank_order)
-                # return latest version
-                license = from_tokenized[-1]
-                return license, False
-            except KeyError:
-                pass
+        normalized_tokens = list(cls.generate_tokens_from_str(*search_for))
+
+        def _lookup(index):
+            for token in normalized_tokens:
+                record = index.tokens.get(token)
+                if record is not None:
+                    return record
+
+        license = cls._get_from_index(_lookup)
+        if license is not None:
+            return license, False
+
         # return default if nothing was found
         license = cls.get(cls.DEFAULT_LICENSE)
         assert license is not None
@@ -311,3 +337,98 @@ class LocalizedLicenseName(DeclarativeBase, DomainObject):
 def clear_licenses():
     LocalizedLicenseName.q().delete()
     License.q().delete()
+    bump_generation(LICENSES_CACHE)
+
+
+class LicenseRecord(object):
+    """
+    Read-only copy of a License and its localized names, detached from the DB session
+    """
+
+    __slots__ = ('id', 'license_type', 'version', 'uri', 'path', 'document_uri',
+                 'rank_order', 'default_name', 'parent_id', 'names',)
+
+    def __init__(self, license):
+        for attr in self.__slots__[:-1]:
+            setattr(self, attr, getattr(license, attr))
+        self.names = dict((n.lang, n.label) for n in license.names)
+
+    def get_name(self, lang):
+        return self.names.get(lang, self.default_name)
+
+    def get_names(self):
+        return [{'lang': lang, 'name': label} for lang, label in self.names.items()]
+
+    def __str__(self):
+        return 'LicenseRecord({}/version {}: {})'.format(self.license_type, self.version, self.default_name)
+
+
+def _version_sort_key(license):
+    # licenses without version (upper levels of the tree) sort before the versioned ones
+    if license.version:
+        return 1, license.version, license.rank_order
+    return 0, '', license.rank_order
+
+
+class LicenseIndex(object):
+    """
+    In-memory view of the licenses vocabulary.
+
+    Holds a LicenseRecord for each License, keyed by id and by all the
+    aliases used in `License.get`, and the token map used in `License.find_by_token`.
+    """
+
+    def __init__(self, licenses):
+        self.by_id = {}
+        self.by_uri = {}
+        self.by_document_uri = {}
+        self.by_default_name = {}
+        self.by_license_type = {}
+        self.by_lang = {}
+
+        tokens = {}
+        for license in licenses:
+            record = LicenseRecord(license)
+            self.by_id[record.id] = record
+            # as in the original uri lookup, the license with the lowest rank wins
+            current = self.by_uri.get(record.uri)
+            if current is None or record.rank_order < current.rank_order:
+                self.by_uri[record.uri] = record
+            for aliases, key in ((self.by_document_uri, record.document_uri),
+                                 (self.by_default_name, record.default_name),
+                                 (self.by_license_type, record.license_type),):
+                if key is not None:
+                    aliases.setdefault(key, record)
+            for lang, label in record.names.items():
+                self.by_lang.setdefault((lang, label), record)
+            for token in license.generate_tokens():
+                tokens.setdefault(token, []).append(record)
+
+        # each token points to the license with the newest version
+        self.tokens = dict((token, sorted(records, key=_version_sort_key)[-1])
+                           for token, records in tokens.items())
+
+    def resolve(self, id_or_uri):
+        try:
+            record = self.by_id.get(int(id_or_uri))
+        except (TypeError, ValueError):
+            record = None
+        if record is None:
+            for aliases in (self.by_uri,
+                            self.by_document_uri,
+                            self.by_default_name,
+                            self.by_license_type,):
+                record = aliases.get(id_or_uri)
+                if record is not None:
+                    break
+        return record
+
+
+def _build_license_index():
+    q = License.q().options(orm.joinedload(License.names)).order_by(License.id)
+    index = LicenseIndex(q)
+    log.debug('Built license index with %s licenses and %s tokens', len(index.by_id), len(index.tokens))
+    return index
+
+
+_license_index = GenerationCache(LICENSES_CACHE, _build_license_index)
@@ -12,9 +12,11 @@ from sqlalchemy.ext.declarative import declarative_base, declared_attr
 
 from ckanext.dcat.profiles import DCT
 
+from ckanext.dcatapit.model.cache import GenerationCache, bump_generation
+
 log = logging.getLogger(__name__)
 
-__all__ = ['Subtheme', 'SubthemeLabel',
+__all__ = ['Subtheme', 'SubthemeLabel', 'SubthemeRecord', 'SubthemeTree',
            'clear_subthemes']
 
 DeclarativeBase = declarative_base(metadata=meta.metadata)
@@ -23,6 +25,9 @@ CONFIG_THEME_LANGS = 'ckan.dcatapit.subthemes.langs'
 THEME_LANGS = (config.get(CONFIG_THEME_LANGS) or '').split(' ')
 DEFAULT_LANG = config.get('ckan.locale_default', 'it')
 
+# name of the cache generation bumped when subthemes are (re)loaded
+SUBTHEMES_CACHE = 'subthemes'
+
 
 class ThemeToSubtheme(DeclarativeBase, DomainObject):
     __tablename__ = 'dcatapit_theme_to_subtheme'
@@ -170,6 +175,14 @@ class Subtheme(DeclarativeBase, DomainObject):
                    .order_by(Tag.name)
         return [t[0] for t in q]
 
+    @classmethod
+    def get_tree(cls):
+        """
+        Return the in-memory SubthemeTree, which can be used instead of
+        `for_theme` and `get_theme_names` without querying the DB.
+        """
+        return _tree_cache.get()
+
     @classmethod
     def get_localized(cls, *subthemes):
         q = cls.Session.query(SubthemeLabel.lang, SubthemeLabel.label)\
@@ -178,6 +191,41 @@ class Subtheme(DeclarativeBase, DomainObject):
                                cls.default_label.in_(subthemes)))
         return q
 
+    @classmethod
+    def get_localized_memo(cls, *subthemes):
+        """
+        Same as `get_localized`, but labels are memoized per subtheme reference,
+        so that only references never seen before are queried.
+
+        :return: a list of (lang, label) tuples
+        """
+        memo = _localized_memo.get()
+        missing = [s for s in set(subthemes) if s not in memo]
+        if missing:
+            q = cls.Session.query(cls.id, cls.uri, cls.default_label,
+                                  SubthemeLabel.lang, SubthemeLabel.label)\
+                       .join(SubthemeLabel, cls.id == SubthemeLabel.subtheme_id)\
+                       .filter(or_(cls.uri.in_(missing),
+                                   cls.default_label.in_(missing)))
+            found = {s: [] for s in missing}
+            for sub_id, uri, default_label, lang, label in q:
+                for ref in {uri, default_label}:
+                    if ref in found:
+                        found[ref].append((sub_id, lang, label))
+            memo.update(found)
+
+        out = []
+        seen = set()
+        for s in subthemes:
+            for sub_id, lang, label in memo[s]:
+                if (sub_id, lang) not in seen:
+                    seen.add((sub_id, lang))
+                    out.append((lang, label))
+        return out
+
+
+_localized_memo = GenerationCache(SUBTHEMES_CACHE, dict)
+
 
 class SubthemeLabel(DeclarativeBase, DomainObject):
     __tablename__ = 'dcatapit_subtheme_labels'
@@ -198,7 +246,125 @@ class SubthemeLabel(DeclarativeBase, DomainObject):
                       'subtheme_id', 'lang'),)
 
 
+class SubthemeRecord(object):
+    """
+    Read-only copy of a Subtheme and its localized labels, detached from the DB session
+    """
+
+    __slots__ = ('id', 'uri', 'default_label', 'parent_id', 'depth', 'path', 'labels',)
+
+    def __init__(self, id, uri, default_label, parent_id, depth, path, labels):
+        self.id = id
+        self.uri = uri
+        self.default_label = default_label
+        self.parent_id = parent_id
+        self.depth = depth
+        self.path = path
+        self.labels = labels
+
+    def get_label(self, lang):
+        return self.labels.get(lang)
+
+    def __str__(self):
+        return 'SubthemeRecord({} [{}])'.format(self.uri, self.default_label)
+
+
+class SubthemeTree(object):
+    """
+    In-memory view of the subthemes of each theme.
+
+    Subthemes are kept in the same order returned by `Subtheme.for_theme`
+    (by parent and path); the tree is never modified once built, it is replaced
+    as a whole when the subthemes generation is bumped.
+    """
+
+    def __init__(self, theme_names, records, links):
+        by_id = {r.id: r for r in records}
+        position = {r.id: idx for idx, r in enumerate(records)}
+
+        subthemes = {name: [] for name in theme_names}
+        for theme, subtheme_id in links:
+            if subtheme_id in by_id:
+                subthemes.setdefault(theme, []).append(by_id[subtheme_id])
+
+        self._subthemes = {}
+        self._uris = {}
+        for theme, theme_records in subthemes.items():
+            theme_records = tuple(sorted(set(theme_records), key=lambda r: position[r.id]))
+            self._subthemes[theme] = theme_records
+            self._uris[theme] = frozenset(r.uri for r in theme_records)
+
+    def __len__(self):
+        return sum(len(records) for records in self._subthemes.values())
+
+    def theme_names(self):
+        """
+        Names of the themes having at least one subtheme, sorted
+        """
+        return sorted(theme for theme, records in self._subthemes.items() if records)
+
+    def for_theme(self, theme, lang=None):
+        """
+        Same as `Subtheme.for_theme`: returns the SubthemeRecords for the theme or,
+        if `lang` is given, (record, label) tuples for the subthemes localized in `lang`.
+
+        :raises ValueError: if the theme does not exist
+        """
+        records = self._get(theme)
+        if lang:
+            return [(r, r.labels[lang]) for r in records if lang in r.labels]
+        return list(records)
+
+    def uris_for_theme(self, theme):
+        """
+        Set of the subtheme uris for the theme
+
+        :raises ValueError: if the theme does not exist
+        """
+        self._get(theme)
+        return self._uris[theme]
+
+    def _get(self, theme):
+        try:
+            return self._subthemes[theme]
+        except KeyError:
+            raise ValueError(f'No tag for {theme}')
+
+
+def _load_subtheme_tree():
+    Session = meta.Session
+
+    labels = {}
+    q = Session.query(SubthemeLabel.subtheme_id, SubthemeLabel.lang, SubthemeLabel.label)\
+        .order_by(SubthemeLabel.id)
+    for subtheme_id, lang, label in q:
+        labels.setdefault(subtheme_id, {}).setdefault(lang, label)
+
+    q = Session.query(Subtheme.id, Subtheme.uri, Subtheme.default_label,
+                      Subtheme.parent_id, Subtheme.depth, Subtheme.path)\
+        .order_by(Subtheme.parent_id, Subtheme.path)
+    records = [SubthemeRecord(*row, labels=labels.get(row[0], {})) for row in q]
+
+    theme_names = [t[0] for t in Session.query(Tag.name)
+                   .join(Vocabulary, Vocabulary.id == Tag.vocabulary_id)
+                   .filter(Vocabulary.name == ThemeToSubtheme.VOCAB_NAME)]
+
+    links = Session.query(Tag.name, ThemeToSubtheme.subtheme_id)\
+        .join(ThemeToSubtheme, ThemeToSubtheme.tag_id == Tag.id)\
+        .join(Vocabulary, Vocabulary.id == Tag.vocabulary_id)\
+        .filter(Vocabulary.name == ThemeToSubtheme.VOCAB_NAME)\
+        .all()
+
+    tree = SubthemeTree(theme_names, records, links)
+    log.debug('Loaded subtheme tree with %s themes and %s subthemes', len(theme_names), len(records))
+    return tree
+
+
+_tree_cache = GenerationCache(SUBTHEMES_CACHE, _load_subtheme_tree)
+
+
 def clear_subthemes():
     SubthemeLabel.q().delete()
     ThemeToSubtheme.q().delete()
     Subtheme.q().delete()
+    bump_generation(SUBTHEMES_CACHE)
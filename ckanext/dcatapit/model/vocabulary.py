@@ -2,12 +2,17 @@ import logging
 
 from sqlalchemy import Column, ForeignKey, Table, types
 
-from ckan.model import Session, meta
+from ckan.model import Session, Tag, meta
 from ckan.model.domain_object import DomainObject
 
+from ckanext.dcatapit.model.cache import GenerationCache
+
 log = logging.getLogger(__name__)
 
-__all__ = ['TagLocalization', 'dcatapit_vocabulary_table', ]
+__all__ = ['TagLocalization', 'TagLabels', 'dcatapit_vocabulary_table', ]
+
+# name of the cache generation bumped when a vocabulary is (re)loaded
+VOCABULARY_CACHE = 'vocabulary'
 
 dcatapit_vocabulary_table = Table(
     'dcatapit_vocabulary', meta.metadata,
@@ -56,6 +61,13 @@ class TagLocalization(DomainObject):
 
         return query.first()
 
+    @classmethod
+    def get_labels(cls):
+        """
+        Returns the cached TagLabels for all the vocabularies
+        """
+        return _labels_cache.get()
+
     @classmethod
     def persist(cls, tag, label, lang):
         session = meta.Session
@@ -81,3 +93,57 @@ class TagLocalization(DomainObject):
 
 
 meta.mapper(TagLocalization, dcatapit_vocabulary_table)
+
+
+class TagLabels(object):
+    """
+    In-memory view of the localized tag labels, loaded vocabulary by vocabulary.
+
+    Labels are stored as {lang: text} dicts keyed by tag id and by tag name;
+    since tag names are not unique across vocabularies, the first label found
+    for a (name, lang) pair is used, as in `TagLocalization.by_name`.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_vocabulary = {}
+
+    def add_vocabulary(self, vocabulary_id, rows):
+        vocab_labels = self.by_vocabulary.setdefault(vocabulary_id, {})
+        for tag_id, tag_name, lang, text in rows:
+            self.by_id.setdefault(tag_id, {}).setdefault(lang, text)
+            self.by_name.setdefault(tag_name, {}).setdefault(lang, text)
+            vocab_labels.setdefault(tag_name, {}).setdefault(lang, text)
+
+    def get_by_id(self, tag_id, lang):
+        return self.by_id.get(tag_id, {}).get(lang)
+
+    def get_by_name(self, tag_name, lang):
+        return self.by_name.get(tag_name, {}).get(lang)
+
+    def get_all_by_name(self, tag_name):
+        return dict(self.by_name.get(tag_name, {}))
+
+
+def _load_tag_labels():
+    labels = TagLabels()
+    vocabulary_ids = [v[0] for v in Session.query(Tag.vocabulary_id).distinct()
+                      .join(TagLocalization, TagLocalization.tag_id == Tag.id)
+                      .order_by(Tag.vocabulary_id)]
+
+    for vocabulary_id in vocabulary_ids:
+        q = Session.query(TagLocalization.tag_id,
+                          TagLocalization.tag_name,
+                          TagLocalization.lang,
+                          TagLocalization.text)\
+            .join(Tag, Tag.id == TagLocalization.tag_id)\
+            .filter(Tag.vocabulary_id == vocabulary_id)\
+            .order_by(TagLocalization.id)
+        labels.add_vocabulary(vocabulary_id, q)
+
+    log.debug('Loaded tag labels for %s vocabularies', len(vocabulary_ids))
+    return labels
+
+
+_labels_cache = GenerationCache(VOCABULARY_CACHE, _load_tag_labels)
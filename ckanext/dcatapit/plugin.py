@@ -14,6 +14,7 @@ import ckanext.dcatapit.interfaces as interfaces
 import ckanext.dcatapit.schema as dcatapit_schema
 import ckanext.dcatapit.validators as validators
 from ckanext.dcatapit.commands import dcatapit as dcatapit_cli
+from ckanext.dcatapit.controllers.catalog import stream_catalog
 from ckanext.dcatapit.controllers.harvest import HarvesterController
 from ckanext.dcatapit.helpers import get_org_context
 from ckanext.dcatapit.mapping import populate_theme_groups, theme_name_to_uri
@@ -30,6 +31,8 @@ except ImportError:
     class DefaultTranslation():
         pass
 
+CATALOG_STREAM_ENABLED_KEY = 'ckanext.dcatapit.catalog_stream.enabled'
+
 LOCALIZED_RESOURCES_KEY = 'ckanext.dcatapit.localized_resources'
 LOCALIZED_RESOURCES_ENABLED = toolkit.asbool(config.get(LOCALIZED_RESOURCES_KEY, 'False'))
 MLR = None
@@ -47,6 +50,7 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
     plugins.implements(plugins.IValidators)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IRoutes, inherit=True)
+    plugins.implements(plugins.IBlueprint, inherit=True)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IFacets, inherit=True)
     plugins.implements(plugins.ITranslation, inherit=True)
@@ -75,6 +79,20 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
                       conditions=GET)
         return map
 
+    # ------------- IBlueprint ---------------#
+
+    def get_blueprint(self):
+        if not toolkit.asbool(config.get(CATALOG_STREAM_ENABLED_KEY, False)):
+            return []
+
+        blueprint = Blueprint('dcatapit_catalog', self.__module__)
+        blueprint.add_url_rule(
+            rule='/catalog/stream.<_format>',
+            endpoint='stream_catalog',
+            view_func=stream_catalog,
+        )
+        return blueprint
+
     # ------------- IConfigurer ---------------#
 
     def update_config(self, config_):
@@ -92,7 +110,7 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
 
     def _modify_package_schema(self, schema):
         # Package schema
-        for field in dcatapit_schema.get_custom_package_schema():
+        for field in dcatapit_schema.get_package_schema_plan().fields:
             if field.get('ignore'):
                 continue
 
@@ -156,7 +174,7 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         # Getting custom package schema
         ##
 
-        for field in dcatapit_schema.get_custom_package_schema():
+        for field in dcatapit_schema.get_package_schema_plan().fields:
             if 'ignore' in field and field['ignore'] == True:
                 continue
 
@@ -269,21 +287,12 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         lang = interfaces.get_language()
         otype = pkg_dict.get('type')
         if lang and otype == 'dataset':
+            localized = dcatapit_schema.get_package_schema_plan().localized
             for extra in pkg_dict.get('extras') or []:
-                for field in dcatapit_schema.get_custom_package_schema():
-
-                    couples = field.get('couples', [])
-                    if couples and len(couples) > 0:
-                        for couple in couples:
-                            if extra.get('key') == couple.get('name', None) and couple.get('localized', False) == True:
-                                log.debug(':::::::::::::::Localizing custom schema field: %r', couple['name'])
-                                # Create the localized field recorcd
-                                self.create_loc_field(extra, lang, pkg_dict.get('id'))
-                    else:
-                        if extra.get('key') == field.get('name', None) and field.get('localized', False) == True:
-                            log.debug(':::::::::::::::Localizing custom schema field: %r', field['name'])
-                            # Create the localized field record
-                            self.create_loc_field(extra, lang, pkg_dict.get('id'))
+                if extra.get('key') in localized:
+                    log.debug(':::::::::::::::Localizing custom schema field: %r', extra['key'])
+                    # Create the localized field record
+                    self.create_loc_field(extra, lang, pkg_dict.get('id'), context.get('defer_commit', False))
 
     def after_update(self, context, pkg_dict):
         # During the harvest the get_lang() is not defined
@@ -291,14 +300,11 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         otype = pkg_dict.get('type')
 
         if lang and otype == 'dataset':
+            localized = dcatapit_schema.get_package_schema_plan().localized
             for extra in pkg_dict.get('extras') or []:
-                for field in dcatapit_schema.get_custom_package_schema():
-                    couples = field.get('couples', [])
-                    if couples and len(couples) > 0:
-                        for couple in couples:
-                            self.update_loc_field(extra, pkg_dict.get('id'), couple, lang)
-                    else:
-                        self.update_loc_field(extra, pkg_dict.get('id'), field, lang)
+                field = localized.get(extra.get('key'))
+                if field:
+                    self.update_loc_field(extra, pkg_dict.get('id'), field, lang, context.get('defer_commit', False))
 
     def before_index(self, dataset_dict):
         '''
@@ -327,7 +333,7 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         _licenses = list(set([r.get('license_type') for r in resources if r.get('license_type')]))
 
         for l in _licenses:
-            lic = License.get(l)
+            lic = License.get_record(l)
             if lic:
                 for loclic in lic.get_names():
                     lname = loclic['name']
@@ -339,18 +345,7 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         dataset_dict['resource_license'] = _licenses
 
         org_id = dataset_dict['owner_org']
-        organization_show = plugins.toolkit.get_action('organization_show')
-        if org_id:
-            org = organization_show(get_org_context(), {'id': org_id,
-                                                        'include_tags': False,
-                                                        'include_users': False,
-                                                        'include_groups': False,
-                                                        'include_extras': True,
-                                                        'include_followers': False,
-                                                        'include_datasets': False,
-                                                        })
-        else:
-            org = {}
+        org = interfaces.get_organization_for_index(org_id) if org_id else {}
         if org.get('region'):
 
             # multilang values
@@ -400,7 +395,12 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
         ## #####################################################################
         search_dicts = search_results.get('results', [])
 
-        dcatapit_schema_fields = dcatapit_schema.get_custom_package_schema()
+        extra_fields = dcatapit_schema.get_package_schema_plan().extra_fields
+
+        # resolve the local status of the whole page at once,
+        # and fetch each organization only once for this request
+        local_pkgs = helpers.datasets_are_local([_dict['id'] for _dict in search_dicts])
+        orgs = {}
 
         for _dict in search_dicts:
             _dict_extras = _dict.get('extras', None)
@@ -409,21 +409,16 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
                 _dict_extras = []
                 _dict['extras'] = _dict_extras
 
-            for field in dcatapit_schema_fields:
-                field_couple = field.get('couples', [])
-                if len(field_couple) > 0:
-                    for couple in field_couple:
-                        self.manage_extras_for_search(couple, _dict, _dict_extras)
-                else:
-                    self.manage_extras_for_search(field, _dict, _dict_extras)
+            for field in extra_fields:
+                self.manage_extras_for_search(field, _dict, _dict_extras)
 
             # remove holder info if pkg is local, use org as a source
             # see https://github.com/geosolutions-it/ckanext-dcatapit/pull/213#issuecomment-410668740
-            _dict['dataset_is_local'] = helpers.dataset_is_local(_dict['id'])
+            _dict['dataset_is_local'] = local_pkgs[_dict['id']]
             if _dict['dataset_is_local']:
                 _dict.pop('holder_identifier', None)
                 _dict.pop('holder_name', None)
-            self._update_pkg_rights_holder(_dict)
+            self._update_pkg_rights_holder(_dict, orgs=orgs)
 
         lang = interfaces.get_language()
         facets = search_results['search_facets']
@@ -444,28 +439,25 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
             _dict_extras.append({'key': field_name, 'value': field_value})
             del _dict[field_name]
 
-    def update_loc_field(self, extra, pkg_id, field, lang):
-        interfaces.update_extra_package_multilang(extra, pkg_id, field, lang)
+    def update_loc_field(self, extra, pkg_id, field, lang, defer_commit=False):
+        interfaces.update_extra_package_multilang(extra, pkg_id, field, lang, defer_commit=defer_commit)
 
-    def create_loc_field(self, extra, lang, pkg_id):
-        interfaces.save_extra_package_multilang({'id': pkg_id, 'text': extra.get('value'), 'field': extra.get('key')}, lang, 'extra')
+    def create_loc_field(self, extra, lang, pkg_id, defer_commit=False):
+        interfaces.save_extra_package_multilang({'id': pkg_id, 'text': extra.get('value'), 'field': extra.get('key')},
+                                                lang, 'extra', defer_commit=defer_commit)
 
     def before_view(self, pkg_dict):
         return self._update_pkg_rights_holder(pkg_dict)
 
     def after_show(self, context, pkg_dict):
-        schema = dcatapit_schema.get_custom_package_schema()
         # quick hack on date fields that are in wrong format
-        for fdef in schema:
-            if fdef.get('type') != 'date':
-                continue
-            fname = fdef['name']
+        for fname, fformat in dcatapit_schema.get_package_schema_plan().date_fields:
             df_value = pkg_dict.get(fname)
             if df_value:
                 tmp_value = validators.parse_date(df_value, df_value)
                 if isinstance(tmp_value, datetime.date):
                     try:
-                        tmp_value = tmp_value.strftime(fdef.get('format') or '%d-%m-%Y')
+                        tmp_value = tmp_value.strftime(fformat)
                     except ValueError as err:
                         log.warning('dataset %s, field %s: cannot reformat date for %s (from input %s): %s',
                                     pkg_dict['name'], fname, tmp_value, df_value, err, exc_info=err)
@@ -532,12 +524,18 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
             pkg_dict.pop('holder_name', None)
         return self._update_pkg_rights_holder(pkg_dict)
 
-    def _update_pkg_rights_holder(self, pkg_dict, org=None):
+    def _update_pkg_rights_holder(self, pkg_dict, org=None, orgs=None):
+        """
+        :param orgs: optional dict {org_id: org_dict} used to cache
+                     the organizations across several calls
+        """
         if pkg_dict.get('type') != 'dataset':
             return pkg_dict
         if not (pkg_dict.get('holder_identifier') and pkg_dict.get('holder_name')):
             if not pkg_dict.get('owner_org'):
                 return pkg_dict
+            if org is None and orgs is not None:
+                org = orgs.get(pkg_dict['owner_org'])
             if org is None:
                 get_org = toolkit.get_action('organization_show')
                 ctx = get_org_context()
@@ -551,6 +549,8 @@ class DCATAPITPackagePlugin(plugins.SingletonPlugin, toolkit.DefaultDatasetForm,
                                     'include_followers': False,
                                     'include_datasets': False,
                                     })
+                if orgs is not None:
+                    orgs[pkg_dict['owner_org']] = org
             pkg_dict['holder_name'] = org['title']
             pkg_dict['holder_identifier'] = org.get('identifier') or None
         return pkg_dict
@@ -583,6 +583,9 @@ class DCATAPITOrganizationPlugin(plugins.SingletonPlugin, toolkit.DefaultOrganiz
     # IGroupForm
     plugins.implements(plugins.IGroupForm, inherit=True)
 
+    # IOrganizationController
+    plugins.implements(plugins.IOrganizationController, inherit=True)
+
     # ------------- IConfigurer ---------------#
 
     def update_config(self, config_):
@@ -597,6 +600,15 @@ class DCATAPITOrganizationPlugin(plugins.SingletonPlugin, toolkit.DefaultOrganiz
             'get_dcatapit_organization_schema': helpers.get_dcatapit_organization_schema
         }
 
+    # ------------- IOrganizationController ---------------#
+
+    def edit(self, entity):
+        # organizations are memoized for indexing the datasets
+        interfaces.invalidate_organizations()
+
+    def delete(self, entity):
+        interfaces.invalidate_organizations()
+
     # ------------- IGroupForm ---------------#
 
     def is_fallback(self):
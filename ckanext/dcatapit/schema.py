@@ -2,12 +2,17 @@ import logging
 from ckan.common import _
 from ckan.plugins import PluginImplementations
 
-from ckanext.dcatapit.interfaces import ICustomSchema
+from ckanext.dcatapit.interfaces import ICustomSchema, get_language
 
 FIELD_THEMES_AGGREGATE = 'themes_aggregate'
 
+DEFAULT_DATE_FORMAT = '%d-%m-%Y'
+
 log = logging.getLogger(__name__)
 
+# (language, ICustomSchema plugin names) -> PackageSchemaPlan
+_package_schema_plans = {}
+
 def get_custom_config_schema(show=True):
     if show:
         return [
@@ -361,6 +366,45 @@ def get_custom_package_schema():
     return package_schema
 
 
+class PackageSchemaPlan(object):
+    """
+    Lookups on the custom package schema, computed once instead of scanning
+    the field list for each dataset or extra.
+
+    The fields are shared among all the callers, so they must not be modified.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.field_names = frozenset(f['name'] for f in self.fields if f.get('name'))
+
+        # fields stored as extras: couples are stored as separate fields
+        self.extra_fields = tuple(c for f in self.fields for c in (f.get('couples') or [f]) if c.get('name'))
+
+        self.localized = {}
+        for f in self.extra_fields:
+            if f.get('localized', False) == True:
+                self.localized.setdefault(f['name'], f)
+
+        self.date_fields = tuple((f['name'], f.get('format') or DEFAULT_DATE_FORMAT)
+                                 for f in self.fields if f.get('type') == 'date')
+
+
+def get_package_schema_plan():
+    """
+    Return the PackageSchemaPlan for the current language.
+
+    Plans are built once per process, for each language (labels are translated)
+    and set of ICustomSchema plugins.
+    """
+    key = (get_language(), tuple(plugin.name for plugin in PluginImplementations(ICustomSchema)))
+    plan = _package_schema_plans.get(key)
+    if plan is None:
+        plan = _package_schema_plans[key] = PackageSchemaPlan(get_custom_package_schema())
+        log.debug(f'Built package schema plan for {key}')
+    return plan
+
+
 def _update_schema_fields(package_schema: dict):
     for plugin in PluginImplementations(ICustomSchema):
         if hasattr(plugin, 'get_schema_updates'):
@@ -2,9 +2,19 @@ import os
 import pytest
 import unittest
 
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from ckan.tests.helpers import change_config
+
 import ckanext.dcatapit.interfaces as interfaces
+from ckanext.dcatapit.mapping import DCATAPIT_THEME_TO_MAPPING_SOURCE
 from ckanext.dcatapit.tests.utils import get_test_file, SKOS_THEME_FILE
 
+TEST_MAP_FILE = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'examples', 'test_map.ini')
+
 
 class BaseCommandTest(unittest.TestCase):
     pass
@@ -21,3 +31,298 @@ class TestDCATAPITCommand(BaseCommandTest):
 
         tag_localized = interfaces.get_localized_tag_name('ECON')
         self.assertTrue(tag_localized)
+
+    @pytest.mark.usefixtures('with_request_context', 'clean_dcatapit_db')
+    def test_vocabulary_labels_cache(self):
+        from ckanext.dcatapit.commands.vocabulary import load_from_file
+        from ckanext.dcatapit.model import TagLocalization
+
+        # warm up the cache before loading, it must be invalidated by the load
+        self.assertIsNone(interfaces.get_localized_tag_by_id('missing', 'it'))
+
+        vocab_file_path = get_test_file(SKOS_THEME_FILE)
+        load_from_file(filename=vocab_file_path, format='xml')
+
+        self.assertEqual(interfaces.get_localized_tag_name('ECON', lang='it'), 'Economia e finanze')
+        self.assertEqual(interfaces.get_localized_tag_name('ECON', 'it', lang='xx'), 'Economia e finanze')
+        self.assertEqual(interfaces.get_localized_tag_name('ECON', lang='xx'), 'ECON')
+
+        labels = interfaces.get_all_localized_tag_labels('ECON')
+        self.assertEqual(labels['en'], 'Economy and finance')
+
+        # returned dicts are copies, the cache must not be altered
+        labels['en'] = 'changed'
+        self.assertEqual(interfaces.get_all_localized_tag_labels('ECON')['en'], 'Economy and finance')
+
+        tag_loc = TagLocalization.by_name('ECON', 'en')
+        self.assertEqual(interfaces.get_localized_tag_by_id(tag_loc.tag_id, 'en'), 'Economy and finance')
+
+    @pytest.mark.usefixtures('with_request_context', 'clean_dcatapit_db')
+    def test_vocabulary_bulk_load(self):
+        from rdflib import Literal
+        from rdflib.namespace import DC, SKOS
+        from ckanext.dcatapit.commands.vocabulary import EUROPEAN_THEME_NAME, do_load
+        from ckanext.dcatapit.tests.utils import load_graph
+
+        g = load_graph(path=get_test_file(SKOS_THEME_FILE))
+
+        created = do_load(g, EUROPEAN_THEME_NAME)
+        self.assertTrue(created.get('tag_added'))
+        self.assertTrue(created.get('label_added'))
+        self.assertFalse(created.get('tag_exists'))
+
+        # reloading the same graph changes nothing
+        reloaded = do_load(g, EUROPEAN_THEME_NAME)
+        self.assertEqual(reloaded.get('tag_exists'), created['tag_added'])
+        self.assertEqual(reloaded.get('label_exists'), created['label_added'])
+        self.assertFalse(reloaded.get('tag_added'))
+        self.assertFalse(reloaded.get('label_added'))
+        self.assertFalse(reloaded.get('tag_deleted'))
+
+        # removed concepts are deleted, changed labels are updated
+        concepts = {str(o): s for s, o in g.subject_objects(DC.identifier)}
+        g.remove((concepts['ECON'], None, None))
+        envi = concepts['ENVI']
+        g.remove((envi, SKOS.prefLabel, Literal('Ambiente', lang='it')))
+        g.add((envi, SKOS.prefLabel, Literal('Ambiente modificato', lang='it')))
+
+        updated = do_load(g, EUROPEAN_THEME_NAME)
+        self.assertEqual(updated.get('tag_deleted'), 1)
+        self.assertEqual(updated.get('label_updated'), 1)
+        self.assertEqual(interfaces.get_localized_tag_name('ENVI', lang='it'), 'Ambiente modificato')
+        self.assertEqual(interfaces.get_localized_tag_name('ECON', lang='it'), 'ECON')
+
+        # tags used only by deleted packages are deleted, tags used by active packages are kept
+        from ckan import model
+
+        def _tag(name):
+            return model.Session.query(model.Tag).filter_by(name=name).first()
+
+        for name, state in (('AGRI', 'deleted'), ('EDUC', 'active')):
+            pkg = model.Package(name=f'vocabulary-{name.lower()}', state=state)
+            model.Session.add(pkg)
+            model.Session.add(model.PackageTag(package=pkg, tag=_tag(name), state='active'))
+            g.remove((concepts[name], None, None))
+        model.Session.commit()
+
+        updated = do_load(g, EUROPEAN_THEME_NAME)
+        self.assertEqual(updated.get('tag_deleted'), 1)
+        self.assertIsNone(_tag('AGRI'))
+        self.assertIsNotNone(_tag('EDUC'))
+
+    @pytest.mark.usefixtures('with_request_context', 'remove_dataset_groups')
+    @change_config(DCATAPIT_THEME_TO_MAPPING_SOURCE, TEST_MAP_FILE)
+    def test_theme_groups_bulk(self):
+        from ckan import model
+        from ckanext.dcatapit.mapping import populate_theme_groups_bulk
+
+        existing = model.Group(name='existing-group')
+        model.Session.add(existing)
+        packages = []
+        for idx in range(5):
+            pkg = model.Package(name=f'theme-groups-{idx}')
+            theme = 'ECON' if idx % 2 else 'AGRI'
+            pkg.extras = {'theme': f'["{theme}"]'}
+            model.Session.add(pkg)
+            packages.append(pkg)
+        no_themes = model.Package(name='theme-groups-no-themes')
+        model.Session.add(no_themes)
+        model.Session.commit()
+
+        updated = set().union(*populate_theme_groups_bulk(chunk_size=2))
+        self.assertEqual(updated, {pkg.id for idx, pkg in enumerate(packages) if idx % 2})
+
+        # memberships already there are not added again
+        self.assertEqual(set().union(*populate_theme_groups_bulk(chunk_size=2)), set())
+
+        for idx, pkg in enumerate(packages):
+            groups = [g.name for g in model.Package.get(pkg.id).get_groups(group_type='group')]
+            self.assertEqual(groups, ['existing-group'] if idx % 2 else [])
+
+        # cleaning removes the groups not in the mapping, but only for datasets with themes,
+        # and never touches the organizations
+        other = model.Group(name='other-group')
+        org = model.Group(name='theme-groups-org', type='organization', is_organization=True)
+        model.Session.add_all([other, org])
+        model.Session.flush()
+        for pkg in packages + [no_themes]:
+            model.Session.add(model.Member(table_name='package', table_id=pkg.id, group=other,
+                                           group_id=other.id, capacity='public', state='active'))
+            model.Session.add(model.Member(table_name='package', table_id=pkg.id, group=org,
+                                           group_id=org.id, capacity='organization', state='active'))
+        model.Session.commit()
+
+        updated = set().union(*populate_theme_groups_bulk(chunk_size=2, clean_existing=True))
+        self.assertEqual(updated, {pkg.id for pkg in packages})
+
+        for idx, pkg in enumerate(packages):
+            groups = [g.name for g in model.Package.get(pkg.id).get_groups(group_type='group')]
+            self.assertEqual(groups, ['existing-group'] if idx % 2 else [])
+        no_themes_groups = [g.name for g in model.Package.get(no_themes.id).get_groups(group_type='group')]
+        self.assertEqual(no_themes_groups, ['other-group'])
+
+        org_members = model.Session.query(model.Member)\
+            .filter(model.Member.group_id == org.id, model.Member.state == 'active')\
+            .count()
+        self.assertEqual(org_members, len(packages) + 1)
+
+    @pytest.mark.usefixtures('with_request_context', 'remove_dataset_groups')
+    def test_migrate_200_themes(self):
+        import json
+        from ckan import model
+        from ckanext.dcatapit.commands import migrate200
+        from ckanext.dcatapit.schema import FIELD_THEMES_AGGREGATE
+        from ckanext.dcatapit.tests.utils import load_themes
+
+        load_themes()
+        aggr = json.dumps([{'theme': 'AGRI', 'subthemes': []}])
+        extras = [{'theme': aggr},
+                  {'theme': '{ECON,ENVI}'},
+                  {'theme': '{ECON}', FIELD_THEMES_AGGREGATE: aggr},
+                  {'theme': ''},
+                  {'theme': '{"ECON"}'},
+                  {'theme': '"ECON"'},
+                  {'theme': '{UNKNOWN,ENVI}'},
+                  {'theme': '{UNKNOWN}'},
+                  {'theme': '{ECON}'}]
+        packages = []
+        for idx, pkg_extras in enumerate(extras):
+            pkg = model.Package(name=f'migrate-200-{idx}')
+            pkg.extras = pkg_extras
+            model.Session.add(pkg)
+            packages.append(pkg)
+        # deleted aggregated themes don't take precedence over the obsolete ones
+        model.Session.add(model.PackageExtra(package=packages[-1], key=FIELD_THEMES_AGGREGATE,
+                                             value=aggr, state='deleted'))
+        model.Session.commit()
+        pkg_ids = [pkg.id for pkg in packages]
+
+        migrate200.migrate(fix_old=True, reindex=False)
+        model.Session.remove()
+
+        def _themes(pkg_id):
+            pkg_extras = model.Package.get(pkg_id).extras
+            self.assertNotIn('theme', pkg_extras)
+            return [t['theme'] for t in json.loads(pkg_extras[FIELD_THEMES_AGGREGATE])]
+
+        self.assertEqual(_themes(pkg_ids[0]), ['AGRI'])
+        self.assertEqual(_themes(pkg_ids[1]), ['ECON', 'ENVI'])
+        self.assertEqual(_themes(pkg_ids[2]), ['AGRI'])
+        self.assertEqual(_themes(pkg_ids[3]), ['OP_DATPRO'])
+        self.assertEqual(_themes(pkg_ids[4]), ['ECON'])
+        self.assertEqual(_themes(pkg_ids[5]), ['ECON'])
+        self.assertEqual(_themes(pkg_ids[6]), ['ENVI'])
+        self.assertEqual(_themes(pkg_ids[7]), ['OP_DATPRO'])
+        self.assertEqual(_themes(pkg_ids[8]), ['ECON'])
+
+        # the deleted aggregated themes extra is reused, not duplicated
+        aggr_extras = model.Session.query(model.PackageExtra)\
+            .filter(model.PackageExtra.package_id == pkg_ids[8],
+                    model.PackageExtra.key == FIELD_THEMES_AGGREGATE)\
+            .all()
+        self.assertEqual([e.state for e in aggr_extras], ['active'])
+
+
+def test_migrate_110_checkpoint(tmp_path):
+    from ckanext.dcatapit.commands.migrate110 import read_checkpoint, write_checkpoint
+
+    path = str(tmp_path / 'migrate.checkpoint')
+    assert read_checkpoint(path) == set()
+
+    write_checkpoint(path, ['a', 'b'], [('c', 'pkg-c', 'error')])
+    assert read_checkpoint(path) == {'a', 'b'}
+
+    # failed packages are retried, and recorded again with the new outcome
+    write_checkpoint(path, ['c'], [('b', 'pkg-b', 'error')])
+    with open(path, 'a') as f:
+        f.write('{"id": "d", "sta')
+    assert read_checkpoint(path) == {'a', 'c'}
+
+    # the truncated line is skipped when resuming
+    write_checkpoint(path, ['d'], [])
+    assert read_checkpoint(path) == {'a', 'c', 'd'}
+
+
+def _create_migration_datasets(count):
+    import uuid
+    import ckan.tests.factories as factories
+    from ckanext.dcatapit.mapping import themes_to_aggr_json
+    from ckanext.dcatapit.schema import FIELD_THEMES_AGGREGATE
+
+    org = factories.Organization(identifier=uuid.uuid4().hex, is_org=True)
+    return [factories.Dataset(owner_org=org['id'],
+                              identifier=str(uuid.uuid4()),
+                              modified='2016-11-29',
+                              frequency='UPDATE_CONT',
+                              publisher_name='bolzano',
+                              publisher_identifier='234234234',
+                              language='{ITA}',
+                              **{FIELD_THEMES_AGGREGATE: themes_to_aggr_json(('ECON',))})['id']
+            for idx in range(count)]
+
+
+@pytest.mark.usefixtures('with_request_context', 'remove_dataset_groups')
+def test_migrate_110_invalid_dataset(tmp_path):
+    from ckan import model
+    from ckanext.dcatapit.commands import migrate110
+
+    pkg_ids = _create_migration_datasets(3)
+    invalid_id = pkg_ids[1]
+    migrate_package = migrate110.migrate_package
+
+    def _migrate_package(context, pupdate_schema, pkg_id):
+        migrate_package(context, pupdate_schema, pkg_id)
+        if pkg_id == invalid_id:
+            # fails only when the transaction is flushed at commit
+            model.Package.get(pkg_id).name = None
+
+    checkpoint = str(tmp_path / 'migrate.checkpoint')
+    with mock.patch.object(migrate110, 'migrate_package', side_effect=_migrate_package):
+        migrated = migrate110.do_migrate_data(skip_orgs=True, pkg_uuid=pkg_ids,
+                                              checkpoint=checkpoint, chunk_size=len(pkg_ids))
+
+    # the other packages of the chunk are migrated, the invalid one is recorded as failed
+    assert migrated == 2
+    assert migrate110.read_checkpoint(checkpoint) == set(pkg_ids) - {invalid_id}
+    with open(checkpoint) as f:
+        assert invalid_id in f.read()
+    assert model.Package.get(invalid_id).name
+
+
+@pytest.mark.usefixtures('with_request_context', 'remove_dataset_groups')
+def test_migrate_110_chunk_rollback():
+    from ckan import model
+    from ckan.logic import ValidationError
+    from ckanext.multilang.model import PackageMultilang
+    from ckanext.dcatapit.commands import migrate110
+
+    pkg_ids = _create_migration_datasets(3)
+    invalid_id = pkg_ids[1]
+    # the localized fields are created again by the migration
+    model.Session.query(PackageMultilang).filter(PackageMultilang.package_id.in_(pkg_ids)).delete(
+        synchronize_session=False)
+    model.Session.commit()
+    modified = model.Package.get(invalid_id).metadata_modified
+
+    migrate_package = migrate110.migrate_package
+
+    def _migrate_package(context, pupdate_schema, pkg_id):
+        migrate_package(context, pupdate_schema, pkg_id)
+        if pkg_id == invalid_id:
+            raise ValidationError({'name': ['invalid']})
+
+    with mock.patch.object(migrate110, 'migrate_package', side_effect=_migrate_package):
+        migrated, failed = migrate110.migrate_chunk(pkg_ids)
+    model.Session.remove()
+
+    assert migrated == [pkg_ids[0], pkg_ids[2]]
+    assert [f[0] for f in failed] == [invalid_id]
+
+    # nothing of the failed package was committed with the rest of the chunk
+    assert model.Package.get(invalid_id).metadata_modified == modified
+    localized = model.Session.query(PackageMultilang.package_id, PackageMultilang.field, PackageMultilang.lang)\
+        .filter(PackageMultilang.package_id.in_(pkg_ids)).all()
+    assert not [row for row in localized if row[0] == invalid_id]
+    # the packages migrated again one by one have their localized fields once
+    assert {row[0] for row in localized} == {pkg_ids[0], pkg_ids[2]}
+    assert len(localized) == len(set(localized))
@@ -1,10 +1,14 @@
+import copy
 import json
+import logging
 import os
+import time
 import uuid
 from datetime import datetime
 from uuid import uuid4
 
-from rdflib import Literal, URIRef
+from rdflib import BNode, ConjunctiveGraph, Literal, URIRef
+from rdflib.namespace import RDF
 
 import pytest
 import unittest
@@ -29,12 +33,16 @@ except ImportError:
 from ckanext.harvest.model import HarvestObject
 
 from ckanext.dcat.processors import RDFParser, RDFSerializer
-from ckanext.dcat.profiles import DCT, FOAF
+from ckanext.dcat.profiles import DCAT, DCT, FOAF, SCHEMA, EuroDCATAPProfile
 
 from ckanext.dcatapit import validators
+from ckanext.dcatapit.dcat.const import DCATAPIT, FORMAT_BASE_URI, FREQ_BASE_URI, LANG_BASE_URI, THEME_BASE_URI
+from ckanext.dcatapit.dcat.parallel import ParallelRDFParser, get_parse_workers
+from ckanext.dcatapit.dcat.profiles import ItalianDCATAPProfile
 from ckanext.dcatapit.schema import FIELD_THEMES_AGGREGATE
 from ckanext.dcatapit.tests.utils import (
     LICENSES_FILE,
+    benchmark,
     get_example_file,
     get_voc_file,
     load_graph,
@@ -54,6 +62,8 @@ Session = meta.Session
 
 DEFAULT_LANG = config.get('ckan.locale_default', 'en')
 
+log = logging.getLogger(__name__)
+
 
 class BaseParseTest(unittest.TestCase):
 
@@ -791,3 +801,126 @@ class TestDCATAPITProfileParsing(BaseParseTest):
                         if not lang_hit:
                             lang_hit = pname == lname.value
                 assert lang_hit, 'There should be lang hit'
+
+    def test_parallel_parse(self):
+
+        with open(get_example_file('catalog_dati_unibo.rdf'), 'r') as f:
+            contents = f.read()
+
+        p = RDFParser(profiles=['euro_dcat_ap', 'it_dcat_ap'])
+        p.parse(contents)
+        datasets = [d for d in p.datasets()]
+        assert len(datasets) > 1
+
+        parallel = ParallelRDFParser(p, 2)
+        # the wrapped parser is still available
+        assert parallel.g is p.g
+        assert parallel.profile_names() == ['euro_dcat_ap', 'it_dcat_ap']
+        assert [d for d in parallel.datasets()] == datasets
+
+        # the workers use the profiles of the wrapped parser, not the default ones
+        p = RDFParser(profiles=['euro_dcat_ap'])
+        p.parse(contents)
+        datasets = [d for d in p.datasets()]
+
+        parallel = ParallelRDFParser(p, 2)
+        assert parallel.profile_names() == ['euro_dcat_ap']
+        assert [d for d in parallel.datasets()] == datasets
+
+        assert get_parse_workers({}) == 0
+        assert get_parse_workers({'parse_workers': '4'}) == 4
+
+
+@pytest.mark.usefixtures("with_plugins", "with_request_context")
+class TestDCATAPITParseBenchmark(BaseParseTest):
+
+    DATASETS = 10000
+    DISTRIBUTIONS = 3
+
+    def tearDown(self):
+        Session.rollback()
+
+    def _build_catalog(self, count):
+        g = ConjunctiveGraph()
+        catalog = URIRef('http://test.catalog/')
+        g.add((catalog, RDF.type, DCAT.Catalog))
+        license = URIRef('https://w3id.org/italia/controlled-vocabulary/licences/A21_CCBY40')
+        g.add((license, RDF.type, DCT.LicenseDocument))
+        g.add((license, FOAF.name, Literal('Creative Commons Attribuzione 4.0 Internazionale (CC BY 4.0)', lang='it')))
+        publishers = []
+        for idx in range(10):
+            agent = URIRef(f'http://test.catalog/agent/{idx}')
+            g.add((agent, RDF.type, FOAF.Agent))
+            g.add((agent, DCT.identifier, Literal(f'ipa{idx}')))
+            g.add((agent, FOAF.name, Literal(f'agent {idx}', lang='it')))
+            g.add((agent, FOAF.name, Literal(f'agent {idx} en', lang='en')))
+            publishers.append(agent)
+
+        for idx in range(count):
+            ref = URIRef(f'http://test.catalog/dataset/{idx}')
+            g.add((catalog, DCAT.dataset, ref))
+            g.add((ref, RDF.type, DCAT.Dataset))
+            g.add((ref, RDF.type, DCATAPIT.Dataset))
+            g.add((ref, DCT.identifier, Literal(f'ipa:dataset-{idx}')))
+            g.add((ref, DCT.title, Literal(f'dataset {idx}', lang='it')))
+            g.add((ref, DCT.title, Literal(f'dataset {idx} en', lang='en')))
+            g.add((ref, DCT.description, Literal(f'description {idx}', lang='it')))
+            g.add((ref, DCT.issued, Literal('2020-01-01')))
+            g.add((ref, DCT.modified, Literal('2021-02-03')))
+            g.add((ref, DCT.accrualPeriodicity, URIRef(FREQ_BASE_URI + 'ANNUAL')))
+            g.add((ref, DCT.language, URIRef(LANG_BASE_URI + 'ITA')))
+            g.add((ref, DCAT.theme, URIRef(THEME_BASE_URI + 'ECON')))
+            g.add((ref, DCT.publisher, publishers[idx % 10]))
+            g.add((ref, DCT.rightsHolder, publishers[idx % 10]))
+
+            temporal = BNode()
+            g.add((ref, DCT.temporal, temporal))
+            g.add((temporal, RDF.type, DCT.PeriodOfTime))
+            g.add((temporal, SCHEMA.startDate, Literal('2020-01-01')))
+
+            for ridx in range(self.DISTRIBUTIONS):
+                distribution = URIRef(f'http://test.catalog/dataset/{idx}/distribution/{ridx}')
+                g.add((ref, DCAT.distribution, distribution))
+                g.add((distribution, RDF.type, DCAT.Distribution))
+                g.add((distribution, DCT.title, Literal(f'distribution {ridx}', lang='it')))
+                g.add((distribution, DCAT.accessURL, URIRef(f'http://test.catalog/download/{idx}/{ridx}')))
+                g.add((distribution, DCT['format'], URIRef(FORMAT_BASE_URI + 'CSV')))
+                g.add((distribution, DCT.license, license))
+        return g
+
+    def _parse(self, count):
+        load_licenses(load_graph(path=get_voc_file(LICENSES_FILE)))
+        Session.flush()
+
+        g = self._build_catalog(count)
+        p = RDFParser(profiles=['euro_dcat_ap', 'it_dcat_ap'])
+        p.g = g
+
+        start = time.perf_counter()
+        datasets = [d for d in p.datasets()]
+        elapsed = time.perf_counter() - start
+        log.info(f'Parsed {len(datasets)} datasets ({len(g)} triples) in {elapsed:.3f}s')
+
+        self.assertEqual(len(datasets), count)
+        for d in datasets[:10]:
+            self.assertTrue(d['identifier'].startswith('ipa:dataset-'))
+            self.assertEqual(len(d['resources']), self.DISTRIBUTIONS)
+            self.assertTrue(d['publisher_name'])
+
+        # parsing with the dataset index gives the same results as parsing the whole graph
+        euro_profile = EuroDCATAPProfile(g)
+        it_profile = ItalianDCATAPProfile(g)
+        for idx in range(0, count, max(count // 10, 1)):
+            ref = URIRef(f'http://test.catalog/dataset/{idx}')
+            base_dict = {}
+            euro_profile.parse_dataset(base_dict, ref)
+            indexed = it_profile.parse_dataset(copy.deepcopy(base_dict), ref)
+            plain = it_profile._parse_dataset(copy.deepcopy(base_dict), ref)
+            self.assertEqual(indexed, plain)
+
+    def test_parse_indexed(self):
+        self._parse(20)
+
+    @benchmark
+    def test_parse_benchmark(self):
+        self._parse(self.DATASETS)
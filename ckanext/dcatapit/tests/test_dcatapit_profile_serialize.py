@@ -389,3 +389,151 @@ class TestDCATAPITProfileSerializeDataset(BaseSerializeTest):
                 has_identifier = _holder_ids[0] == test_id
                 assert has_identifier, \
                     f'No identifier in {_holder_ids} (expected {test_id}) for\n {pkg}\n{s.serialize_dataset(pkg)}'
+
+
+@pytest.mark.usefixtures("with_request_context")
+class TestDCATAPITStreamCatalog(BaseSerializeTest):
+
+    def _create_packages(self, count=2):
+        org = factories.Organization(identifier=uuid.uuid4().hex, is_org=True)
+        out = []
+        for idx in range(count):
+            out.append(factories.Dataset(
+                owner_org=org['id'],
+                identifier=str(uuid.uuid4()),
+                notes='dcatapit dataset di test',
+                modified='2016-11-29',
+                frequency='UPDATE_CONT',
+                publisher_name='bolzano',
+                publisher_identifier='234234234',
+                language='{ITA}',
+                **{FIELD_THEMES_AGGREGATE: themes_to_aggr_json(('ECON',))}))
+        return out
+
+    def test_stream_catalog(self):
+        from rdflib import Graph
+        from ckanext.dcatapit.dcat.stream import StreamingCatalogSerializer
+
+        packages = self._create_packages()
+        catalog_ref = URIRef(utils.catalog_uri())
+
+        for _format, rdf_format in (('nt', 'nt'), ('ttl', 'turtle'), ('xml', 'xml')):
+            serializer = StreamingCatalogSerializer(_format)
+            out = ''.join(serializer.serialize(packages))
+
+            g = Graph()
+            g.parse(data=out, format=rdf_format)
+
+            assert self._triple(g, catalog_ref, RDF.type, DCAT.Catalog)
+            for pkg in packages:
+                dataset_ref = URIRef(utils.dataset_uri(pkg))
+                assert self._triple(g, catalog_ref, DCAT.dataset, dataset_ref)
+                assert self._triple(g, dataset_ref, RDF.type, DCATAPIT.Dataset)
+                assert self._triple(g, dataset_ref, DCAT.theme, URIRef(theme_name_to_uri('ECON')))
+
+            # the datasets reference the same publisher agent
+            publishers = {g.value(URIRef(utils.dataset_uri(pkg)), DCT.publisher) for pkg in packages}
+            self.assertEqual(len(publishers), 1)
+            self.assertEqual(str(g.value(publishers.pop(), DCT.identifier)), '234234234')
+
+            if _format == 'nt':
+                # shared nodes are emitted only once
+                lines = [l for l in out.splitlines() if l.strip()]
+                self.assertEqual(len(lines), len(set(lines)))
+
+    def test_prefetch_multilang(self):
+        from sqlalchemy import event
+
+        packages = []
+        for pkg in self._create_packages(count=3):
+            res = factories.Resource(package_id=pkg['id'], url='http://localhost/res', name='res')
+            interfaces.save_multilang_bulk(pkg['id'],
+                                           {'title': {'en': f'{pkg["name"]} en', 'it': f'{pkg["name"]} it'}},
+                                           {res['id']: {'name': {'en': 'res en', 'it': 'res it'}}})
+            packages.append(toolkit.get_action('package_show')({'ignore_auth': True}, {'id': pkg['id']}))
+
+        expected = [(interfaces.get_for_package(pkg['id']),
+                     interfaces.get_for_group_or_organization(pkg['owner_org']),
+                     [interfaces.get_for_resource(r['id']) for r in pkg['resources']])
+                    for pkg in packages]
+        assert expected[0][0]['title']['en'] == f'{packages[0]["name"]} en'
+        assert expected[0][2][0]['name']['it'] == 'res it'
+
+        queries = []
+
+        def _count(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(meta.engine, 'before_cursor_execute', _count)
+        try:
+            with interfaces.prefetch_multilang(packages):
+                loaded = len(queries)
+                found = [(interfaces.get_for_package(pkg['id']),
+                          interfaces.get_for_group_or_organization(pkg['owner_org']),
+                          [interfaces.get_for_resource(r['id']) for r in pkg['resources']])
+                         for pkg in packages]
+                self.assertEqual(len(queries), loaded)
+        finally:
+            event.remove(meta.engine, 'before_cursor_execute', _count)
+
+        # packages, organizations and resources
+        self.assertEqual(loaded, 3)
+        self.assertEqual(found, expected)
+
+        # the localized fields are in the streamed catalog
+        from rdflib import Graph
+        from ckanext.dcatapit.dcat.stream import StreamingCatalogSerializer
+
+        g = Graph()
+        g.parse(data=''.join(StreamingCatalogSerializer('nt', page_size=2).serialize(packages)), format='nt')
+        for pkg in packages:
+            dataset_ref = URIRef(utils.dataset_uri(pkg))
+            assert self._triple(g, dataset_ref, DCT.title, Literal(f'{pkg["name"]} en', lang='en'))
+
+
+@pytest.mark.usefixtures("with_request_context")
+class TestDCATAPITConceptCache(BaseSerializeTest):
+
+    def test_concepts_memo(self):
+        from ckanext.dcatapit.dcat import profiles
+        from ckanext.dcatapit.model.cache import bump_generation
+        from ckanext.dcatapit.model.vocabulary import VOCABULARY_CACHE
+        from ckanext.dcatapit.tests.utils import load_themes
+
+        load_themes()
+        theme_ref = URIRef(theme_name_to_uri('ECON'))
+
+        graphs = []
+        for idx in range(2):
+            pkg = factories.Dataset(identifier=str(uuid.uuid4()),
+                                    **{FIELD_THEMES_AGGREGATE: themes_to_aggr_json(('ECON',))})
+            s = RDFSerializer()
+            s.graph_from_dataset(pkg)
+            graphs.append(s.g)
+
+        labels = [set(g.objects(theme_ref, SKOS.prefLabel)) for g in graphs]
+        assert labels[0], 'Theme labels not found'
+        self.assertEqual(labels[0], labels[1])
+        assert any(key[0] == str(theme_ref) for key in profiles._tag_concepts.get())
+
+        # reloading a vocabulary drops the prebuilt concepts
+        bump_generation(VOCABULARY_CACHE)
+        self.assertEqual(profiles._tag_concepts.get(), {})
+
+    def test_license_memo(self):
+        from rdflib import Graph
+        from ckanext.dcatapit.commands.vocabulary import load_licenses
+        from ckanext.dcatapit.dcat import profiles
+        from ckanext.dcatapit.model.license import License
+        from ckanext.dcatapit.tests.utils import LICENSES_FILE, get_voc_file, load_graph
+
+        load_licenses(load_graph(path=get_voc_file(LICENSES_FILE)))
+        profile = profiles.ItalianDCATAPProfile(Graph())
+
+        default = profile._get_license_triples(License.DEFAULT_LICENSE)
+        assert default[0], 'Default license not found'
+
+        # unknown license types fall back to the default license, without adding entries
+        for idx in range(5):
+            self.assertEqual(profile._get_license_triples(f'unknown-license-{idx}'), default)
+        self.assertEqual(len(profiles._license_concepts.get()), 1)
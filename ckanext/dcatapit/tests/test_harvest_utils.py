@@ -84,3 +84,53 @@ def test_get_responsible_party():
 
     eq_(name, 'Comune di Bolzano  - Ufficio Sistema Informativo Territoriale')
     eq_(code, 'c_a952')
+
+
+def test_controlled_vocabulary_values():
+    index = utils.KeywordIndex([('ENVI', 'Ambiente'),
+                                ('ENVI', 'Environment'),
+                                ('AGRI', 'Agricoltura, pesca, silvicoltura e prodotti alimentari'),
+                                ('ECON', 'Ambiente')])
+    eq_(len(index), 3)
+    eq_(index.get(' ambiente '), 'ENVI')
+    eq_(index.get('ENVIRONMENT'), 'ENVI')
+    eq_(index.get('Agricoltura,  pesca, silvicoltura e prodotti alimentari'), 'AGRI')
+    ok_(index.get('Economia') is None)
+
+    keywords = [{'keyword': ['Ambiente', 'Boschi'],
+                 'thesaurus-identifier': 'theme.data-theme-skos',
+                 'thesaurus-title': ''},
+                {'keyword': ['agricoltura, pesca, silvicoltura e prodotti alimentari'],
+                 'thesaurus-identifier': 'other',
+                 'thesaurus-title': 'theme.data-theme-skos'},
+                {'keyword': ['Environment'],
+                 'thesaurus-identifier': 'other',
+                 'thesaurus-title': 'other'}]
+    values = utils.get_controlled_vocabulary_values('eu_themes', 'theme.data-theme-skos', keywords, index=index)
+    eq_(values, ['ENVI', 'AGRI'])
+
+
+def test_harvest_config():
+    harvest_config = utils.CSWHarvestConfig({'dcatapit_config': csw_harvester_config},
+                                            csw_harvester_config)
+    publisher = harvest_config.agents['publisher']
+    ok_(isinstance(publisher, utils.AgentConfig))
+    eq_(publisher.parse(responsiblePartys[0]['organisation-name']),
+        utils.get_agent(responsiblePartys[0]['organisation-name'], csw_harvester_config['agents']['publisher']))
+    eq_(utils.get_responsible_party(responsiblePartys, publisher),
+        ['Provincia Autonoma di Bolzano  - Ripartizione 28 - Natura, paesaggio e sviluppo del territorio', 'p_bz'])
+    eq_(harvest_config.mapping_frequencies['weekly'], 'WEEKLY')
+
+
+def test_license_matcher():
+    licenses = [{'id': 'notspecified', 'url': ''},
+                {'id': 'cc-by', 'url': 'http://www.opendefinition.org/licenses/cc-by'},
+                {'id': 'cc-by-sa', 'url': 'http://www.opendefinition.org/licenses/cc-by-sa'},
+                {'id': 'odc-odbl', 'url': 'http://www.opendefinition.org/licenses/odc-odbl'}]
+    matcher = utils.LicenseMatcher(licenses)
+
+    eq_(matcher.find('odc-odbl')['id'], 'odc-odbl')
+    eq_(matcher.find('http://www.opendefinition.org/licenses/cc-by-sa')['id'], 'cc-by-sa')
+    # id contained in the constraint, the first one in the list wins
+    eq_(matcher.find('Licenza CC-BY-SA 4.0')['id'], 'cc-by')
+    ok_(matcher.find('Licenza proprietaria') is None)
@@ -3,7 +3,13 @@ import os
 import unittest
 
 import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
 from ckan import model
+from sqlalchemy import event
 from ckan.lib.munge import munge_name
 from ckan.model import User, Group, Session
 from ckanext.dcatapit.tests.utils import (
@@ -18,6 +24,8 @@ except ImportError:
     from ckan.new_tests import helpers
 
 from ckanext.dcat.harvesters.rdf import DCATRDFHarvester
+from ckanext.dcatapit import interfaces
+from ckanext.dcatapit.dcat.harvester import DCATAPITHarvesterPlugin
 from ckanext.dcatapit.harvesters.ckanharvester import CKANMappingHarvester
 from ckanext.dcatapit.model.license import (
     License,
@@ -284,3 +292,126 @@ class HarvestersTestCase(unittest.TestCase):
         self.assertEqual(pkg_dict['title'], dataset2['title'])
         self.assertEqual(pkg_dict['name'], 'duplicated-title1')
 
+
+    @pytest.mark.usefixtures('remove_dataset_groups')
+    def test_save_multilang_bulk(self):
+        pkg = model.Package(name='multilang-bulk')
+        Session.add(pkg)
+        Session.flush()
+        resources = []
+        for idx in range(10):
+            res = model.Resource(package_id=pkg.id, url=f'http://resource/{idx}')
+            Session.add(res)
+            resources.append(res)
+        Session.flush()
+
+        langs = ('it', 'en', 'de', 'fr')
+        base_dict = {'title': {lang: f'title {lang}' for lang in langs},
+                     'notes': {lang: f'notes {lang}' for lang in langs}}
+        res_fields = {res.id: {'name': {lang: f'{res.url} {lang}' for lang in langs}} for res in resources}
+
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(model.meta.engine, 'before_cursor_execute', _count)
+        try:
+            stats = interfaces.save_multilang_bulk(pkg.id, base_dict, res_fields)
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', _count)
+
+        self.assertEqual(stats, {'package_created': 8, 'resource_created': 40})
+        # one select per table, plus the inserts, however many languages and resources
+        self.assertLess(len(statements), 10)
+
+        self.assertEqual(interfaces.get_for_package(pkg.id), base_dict)
+        self.assertEqual(interfaces.get_for_resource(resources[0].id), res_fields[resources[0].id])
+
+        # update, delete and keep
+        base_dict = {'title': {'it': 'new title it', 'en': '', 'de': 'title de'}}
+        stats = interfaces.save_multilang_bulk(pkg.id, base_dict, {})
+        self.assertEqual(stats, {'package_updated': 1, 'package_deleted': 1, 'package_unchanged': 1})
+
+        localized = interfaces.get_for_package(pkg.id)
+        self.assertEqual(localized['title'], {'it': 'new title it', 'de': 'title de', 'fr': 'title fr'})
+
+        # a failed save is rolled back, so the session can still be used
+        with mock.patch.object(Session, 'commit', side_effect=RuntimeError('commit failed')):
+            with self.assertRaises(RuntimeError):
+                interfaces.save_multilang_bulk(pkg.id, {'title': {'it': 'failed', 'es': 'failed'}}, {})
+        self.assertEqual(interfaces.get_for_package(pkg.id)['title'], localized['title'])
+
+    @pytest.mark.usefixtures('remove_dataset_groups')
+    def test_resource_uri_id_mapping(self):
+        pkg = model.Package(name='resource-uri-mapping')
+        Session.add(pkg)
+        Session.flush()
+        resources = []
+        for idx in range(3):
+            res = model.Resource(package_id=pkg.id, url=f'http://resource/{idx}',
+                                 extras={'uri': f'http://remote/resource/{idx}'})
+            Session.add(res)
+            resources.append(res)
+        # no uri, can't be mapped
+        Session.add(model.Resource(package_id=pkg.id, url='http://resource/nouri'))
+        Session.flush()
+
+        mapping = DCATAPITHarvesterPlugin()._get_resource_uri_id_mapping(pkg.id)
+        self.assertEqual(mapping, {f'http://remote/resource/{idx}': res.id for idx, res in enumerate(resources)})
+
+
+class SolrIndexQueueTestCase(unittest.TestCase):
+
+    def _run(self, commit_every, count):
+        datasets = [{'id': f'pkg-{idx}', 'owner_org': 'org'} for idx in range(count)]
+
+        def _run_query(q):
+            return {'results': [{'data_dict': json.dumps(d)} for d in datasets if f'id:"{d["id"]}"' in q['q']]}
+
+        with mock.patch('ckan.lib.search.PackageSearchQuery.run', side_effect=_run_query), \
+                mock.patch('ckan.lib.search.PackageSearchIndex.index_package') as index_package, \
+                mock.patch('ckan.lib.search.PackageSearchIndex.commit') as commit:
+            queue = interfaces.SolrIndexQueue(commit_every=commit_every)
+            for dataset in datasets:
+                queue.add(dataset)
+            queue.flush()
+            # nothing left to commit
+            queue.flush()
+
+        self.assertEqual(index_package.call_count, count)
+        for call in index_package.call_args_list:
+            self.assertTrue(call[1]['defer_commit'])
+        return commit.call_count
+
+    def test_single_commit(self):
+        self.assertEqual(self._run(0, 120), 1)
+
+    def test_commit_every(self):
+        self.assertEqual(self._run(1, 5), 5)
+        self.assertEqual(self._run(50, 120), 3)
+
+    def test_idle_flush(self):
+        import threading
+
+        datasets = [{'id': f'pkg-{idx}', 'owner_org': 'org'} for idx in range(3)]
+        harvest_object = mock.Mock(harvest_job_id='idle-flush-job',
+                                   source=mock.Mock(config=json.dumps({'solr_commit_idle': 0.1})))
+        committed = threading.Event()
+
+        def _run_query(q):
+            return {'results': [{'data_dict': json.dumps(d)} for d in datasets if f'id:"{d["id"]}"' in q['q']]}
+
+        plugin = DCATAPITHarvesterPlugin()
+        with mock.patch('ckan.lib.search.PackageSearchQuery.run', side_effect=_run_query), \
+                mock.patch('ckan.lib.search.PackageSearchIndex.index_package') as index_package, \
+                mock.patch('ckan.lib.search.PackageSearchIndex.commit', side_effect=committed.set) as commit, \
+                mock.patch.object(DCATAPITHarvesterPlugin, '_job_has_waiting_objects', return_value=True):
+            # the following objects of the job are deleted or fail, so they are never reindexed
+            for dataset in datasets[:2]:
+                plugin._queue_solr_index(harvest_object, dataset)
+            self.assertEqual(commit.call_count, 0)
+
+            self.assertTrue(committed.wait(5), 'The reindexed datasets have not been committed')
+            self.assertEqual(index_package.call_count, 2)
+            self.assertEqual(len(plugin._get_solr_index_queue(harvest_object)), 0)
@@ -5,6 +5,7 @@ import nose
 import pytest
 
 import ckanext.dcatapit.helpers as helpers
+import ckanext.dcatapit.schema as dcatapit_schema
 from ckanext.dcatapit.tests.utils import get_voc_file, SKOS_THEME_FILE, get_test_file, load_graph
 
 eq_ = nose.tools.eq_
@@ -17,6 +18,21 @@ def test_get_dcatapit_package_schema():
     eq_(schema[0].get('name'), 'identifier')
 
 
+def test_get_package_schema_plan():
+    plan = dcatapit_schema.get_package_schema_plan()
+    ok_(plan is dcatapit_schema.get_package_schema_plan())
+
+    schema = helpers.get_dcatapit_package_schema()
+    eq_([f['name'] for f in plan.fields], [f['name'] for f in schema])
+
+    ok_('publisher' in plan.field_names)
+    extra_names = [f['name'] for f in plan.extra_fields]
+    ok_('publisher_name' in extra_names)
+    ok_('publisher' not in extra_names)
+    eq_(set(plan.localized), {'publisher_name', 'holder_name', 'creator_name'})
+    eq_(dict(plan.date_fields), {'issued': '%d-%m-%Y', 'modified': '%d-%m-%Y'})
+
+
 def test_get_dcatapit_organization_schema():
     schema = helpers.get_dcatapit_organization_schema()
     ok_(schema)
@@ -69,3 +85,25 @@ def test_org_context():
     ctx2 = helpers.get_org_context()
 
     assert ctx2.get('test') is None
+
+
+@pytest.mark.usefixtures("with_request_context")
+def test_datasets_are_local():
+    import ckan.tests.factories as factories
+    from ckanext.harvest.model import HarvestObject, HarvestSource, HarvestJob
+
+    local = factories.Dataset()
+    remote = factories.Dataset()
+
+    source = HarvestSource(url='http://example.com/csw', type='csw')
+    source.save()
+    job = HarvestJob(source=source)
+    job.save()
+    HarvestObject(guid='remote', job=job, package_id=remote['id']).save()
+
+    out = helpers.datasets_are_local([local['id'], remote['id']])
+    eq_(out, {local['id']: True, remote['id']: False})
+    for pkg_id, is_local in out.items():
+        eq_(helpers.dataset_is_local(pkg_id), is_local)
+
+    eq_(helpers.datasets_are_local([]), {})
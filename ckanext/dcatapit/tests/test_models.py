@@ -1,12 +1,17 @@
+import logging
 import os
+import time
 import unittest
 
+from ckan.model import meta
 from ckan.model.meta import Session
-from rdflib import RDF, Graph
+from rdflib import RDF, Graph, Literal, URIRef
+from sqlalchemy import event
 
 from ckanext.dcatapit.tests.utils import (
     EUROVOC_FILE,
     MAPPING_FILE,
+    benchmark,
     get_example_file,
     get_test_file,
     get_voc_file,
@@ -18,8 +23,11 @@ try:
 except ImportError:
     from ckan.new_tests import helpers
 
+from ckanext.dcatapit import interfaces
 from ckanext.dcatapit.model.license import (
     License,
+    LicenseIndex,
+    LicenseRecord,
     LocalizedLicenseName,
 )
 from ckanext.dcatapit.commands.vocabulary import SKOS, load_licenses as load_license, load_subthemes
@@ -29,6 +37,9 @@ from ckanext.dcatapit.model.subtheme import (
 )
 
 
+log = logging.getLogger(__name__)
+
+
 class LicenseTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -85,6 +96,159 @@ class LicenseTestCase(unittest.TestCase):
         self.assertTrue(from_token)
         self.assertTrue('odbl' in from_token.default_name.lower())
 
+    @benchmark
+    def test_tokenizer_benchmark(self):
+
+        load_license(self.g)
+        Session.flush()
+
+        search_for = ['cc-by-sa', 'cc-zero', 'Creative Commons Attribuzione', 'odbl', 'not-a-license']
+        rounds = 50
+
+        def _per_call_tokens(*search_for):
+            # the pre-index behaviour: rebuild the token table on each lookup
+            tokenized = License.get_as_tokens()
+            for token in License.generate_tokens_from_str(*search_for):
+                if token in tokenized:
+                    return tokenized[token][-1]
+
+        def _lookups_per_second(func):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for s in search_for:
+                    func(s)
+            return (rounds * len(search_for)) / (time.perf_counter() - start)
+
+        before = _lookups_per_second(_per_call_tokens)
+        # warm up the index
+        License.find_by_token('cc-by')
+        after = _lookups_per_second(License.find_by_token)
+
+        log.info('License.find_by_token: %.1f lookups/s before, %.1f lookups/s with token index', before, after)
+        self.assertGreater(after, before)
+
+    def test_token_index_reload(self):
+
+        load_license(self.g)
+        Session.flush()
+        # warm up the index
+        License.find_by_token('cc-by')
+
+        # a reload must invalidate the index
+        load_license(self.g)
+        Session.flush()
+        from_token, default = License.find_by_token('cc-by-sa')
+        self.assertFalse(default)
+        self.assertIs(from_token, License.q().filter_by(id=from_token.id).one())
+
+    def test_get_aliases(self):
+
+        load_license(self.g)
+        Session.flush()
+
+        for lic in License.q():
+            self.assertEqual(License.get(lic.id), lic)
+            self.assertEqual(License.get(str(lic.id)), lic)
+            self.assertEqual(License.get(lic.uri), lic)
+
+            record = License.get_record(lic.uri)
+            self.assertIsInstance(record, LicenseRecord)
+            self.assertEqual(record.id, lic.id)
+            self.assertEqual(record.get_names(), lic.get_names())
+            if lic.document_uri:
+                self.assertEqual(License.get(lic.document_uri).document_uri, lic.document_uri)
+            self.assertEqual(License.get(lic.default_name).default_name, lic.default_name)
+
+        self.assertIsNone(License.get('http://not.a.license/'))
+        self.assertIsNone(License.get(None))
+
+    def test_index_duplicate_uri(self):
+
+        class _License(object):
+            def __init__(self, id, rank_order):
+                self.id = id
+                self.license_type = None
+                self.version = None
+                self.uri = 'http://license/duplicated'
+                self.path = f'/{id}'
+                self.document_uri = None
+                self.rank_order = rank_order
+                self.default_name = f'license {id}'
+                self.parent_id = None
+                self.names = []
+
+            def generate_tokens(self):
+                return []
+
+        # the licenses are indexed by id, the one with the lowest rank is returned for the uri
+        index = LicenseIndex([_License(1, 3), _License(2, 1), _License(3, 2)])
+        self.assertEqual(index.resolve('http://license/duplicated').id, 2)
+        self.assertEqual(index.resolve('3').id, 3)
+
+    def test_get_no_queries_after_warm_up(self):
+
+        load_license(self.g)
+        Session.flush()
+
+        uris = [lic.uri for lic in License.q()]
+        # warm up
+        interfaces.get_license_for_dcat(License.DEFAULT_LICENSE)
+
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(meta.engine, 'before_cursor_execute', _count)
+        try:
+            for uri in uris * 10:
+                license_type, default_name, document_uri, version, uri, names = interfaces.get_license_for_dcat(uri)
+                self.assertTrue(names)
+            interfaces.get_license_from_dcat('http://not.a.license/', None, None, it='Not a license')
+        finally:
+            event.remove(meta.engine, 'before_cursor_execute', _count)
+
+        self.assertEqual(statements, [])
+
+    def test_incremental_reload(self):
+
+        load_license(self.g)
+        Session.flush()
+        ids = {lic.uri: lic.id for lic in License.q()}
+
+        # reloading the same vocabulary leaves the licenses untouched
+        stats = load_license(self.g)
+        self.assertEqual(stats, {'licenses_unchanged': len(ids)})
+        self.assertEqual({lic.uri: lic.id for lic in License.q()}, ids)
+
+        # remove a leaf license and rename another one
+        leaves = [s for s in self.g.subjects(None, SKOS.Concept)
+                  if not list(self.g.subjects(SKOS.broader, s))]
+        removed, renamed = leaves[0], leaves[1]
+        self.g.remove((removed, None, None))
+        for label in list(self.g.objects(renamed, SKOS.prefLabel)):
+            if label.language == 'en':
+                self.g.remove((renamed, SKOS.prefLabel, label))
+        self.g.add((renamed, SKOS.prefLabel, Literal('Renamed license', lang='en')))
+
+        stats = load_license(self.g)
+        self.assertEqual(stats['licenses_deleted'], 1)
+        self.assertEqual(stats['licenses_updated'], 1)
+        self.assertNotIn('licenses_created', stats)
+
+        self.assertIsNone(License.get_record(str(removed)))
+        record = License.get_record(str(renamed))
+        self.assertEqual(record.id, ids[str(renamed)])
+        self.assertEqual(record.get_name('en'), 'Renamed license')
+
+        for lic in License.q():
+            self.assertEqual(lic.id, ids[lic.uri])
+            parents = list(self.g.objects(URIRef(lic.uri), SKOS.broader))
+            if parents:
+                self.assertEqual(lic.parent.uri, str(parents[0]))
+            else:
+                self.assertIsNone(lic.parent_id)
+
     def tearDown(self):
         Session.rollback()
 
@@ -124,5 +288,72 @@ class SubthemeTestCase(unittest.TestCase):
             q = Subtheme.for_theme(theme_name)
             self.assertGreaterEqual(q.count(), len(list(theme_len)))
 
+    def test_subtheme_tree(self):
+        clear_subthemes()
+        load_subthemes(self.map_f, self.voc_f)
+
+        tree = Subtheme.get_tree()
+        theme_names = tree.theme_names()
+        self.assertEqual(theme_names, sorted(set(Subtheme.get_theme_names())))
+        self.assertEqual(len(tree), sum(Subtheme.for_theme(theme).count() for theme in theme_names))
+
+        expected = {}
+        for theme in theme_names:
+            expected[theme] = [(s.uri, s.depth, label) for s, label in Subtheme.for_theme(theme, 'it')]
+
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(meta.engine, 'before_cursor_execute', _count)
+        try:
+            tree = Subtheme.get_tree()
+            for theme in theme_names:
+                records = tree.for_theme(theme, 'it')
+                self.assertEqual([(s.uri, s.depth, label) for s, label in records], expected[theme])
+                for uri, depth, label in expected[theme]:
+                    self.assertIn(uri, tree.uris_for_theme(theme))
+            with self.assertRaises(ValueError):
+                tree.for_theme('not-a-theme')
+        finally:
+            event.remove(meta.engine, 'before_cursor_execute', _count)
+
+        self.assertEqual(statements, [])
+
+        # the tree is replaced when subthemes are reloaded
+        clear_subthemes()
+        self.assertIsNot(Subtheme.get_tree(), tree)
+        self.assertEqual(Subtheme.get_tree().theme_names(), [])
+
+    def test_subthemes_benchmark(self):
+        clear_subthemes()
+
+        statements = []
+
+        def _count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(meta.engine, 'before_cursor_execute', _count)
+        start = time.perf_counter()
+        try:
+            load_subthemes(self.map_f, self.voc_f)
+        finally:
+            elapsed = time.perf_counter() - start
+            event.remove(meta.engine, 'before_cursor_execute', _count)
+
+        count = Subtheme.q().count()
+        log.info(f'Loaded {count} subthemes from {EUROVOC_FILE} in {elapsed:.3f}s '
+                 f'with {len(statements)} statements')
+
+        self.assertGreater(count, 0)
+        # bulk statements: the number of round trips does not depend on the number of subthemes
+        self.assertLess(len(statements), 20)
+
+        for subtheme in Subtheme.q():
+            self.assertEqual(subtheme.path, subtheme.get_path())
+            self.assertTrue(subtheme.themes)
+            self.assertTrue(subtheme.get_names_dict())
+
     def tearDown(self):
         Session.rollback()
@@ -1,13 +1,22 @@
 from unittest import TestCase
 from uuid import uuid4
 import json
+import os
 
 import nose
 import pytest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import ckan.tests.factories as factories
+from ckan.common import config
+from ckan.model import meta
 from ckan.tests.helpers import call_action
+from sqlalchemy import event
 
+import ckanext.dcatapit.mapping as mapping
 import ckanext.dcatapit.plugin as plugin
 from ckanext.dcatapit.mapping import themes_to_aggr_json, theme_aggr_to_theme_uris, theme_names_to_uris, \
     theme_name_to_uri
@@ -141,6 +150,65 @@ def test_package_after_show():
     eq_(out['modified'], '01-02-2013')
 
 
+
+def _touch_later(fpath, content):
+    # rewrite the file, making sure the mtime changes even on coarse-grained filesystems
+    stat = os.stat(fpath)
+    with open(fpath, 'w') as f:
+        f.write(content)
+    os.utime(fpath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+
+def _with_config(key, value, func):
+    old = config.get(key)
+    config[key] = value
+    try:
+        return func()
+    finally:
+        if old is None:
+            config.pop(key, None)
+        else:
+            config[key] = old
+
+
+def test_theme_to_groups_cache(tmp_path):
+    fpath = str(tmp_path / 'theme_to_group.ini')
+    with open(fpath, 'w') as f:
+        f.write('[dcatapit:theme_group_mapping]\nECON = group1, group2\n')
+
+    loader = mock.Mock(wraps=mapping.import_theme_to_group)
+    with mock.patch.object(mapping, 'import_theme_to_group', loader):
+        get = lambda: _with_config(mapping.DCATAPIT_THEME_TO_MAPPING_SOURCE, fpath, mapping.get_theme_to_groups)
+
+        first = get()
+        eq_(dict(first), {'ECON': ('group1', ' group2')})
+        # parsed once while the file is unchanged
+        ok_(get() is first)
+        eq_(loader.call_count, 1)
+
+        _touch_later(fpath, '[dcatapit:theme_group_mapping]\nECON = group3\n')
+        eq_(dict(get()), {'ECON': ('group3',)})
+        eq_(loader.call_count, 2)
+
+
+def test_nonconformant_themes_mapping_cache(tmp_path):
+    fpath = str(tmp_path / 'themes_mapping.json')
+    with open(fpath, 'w') as f:
+        json.dump({'data': [{'syn': ['AGRI', 'agricoltura']}]}, f)
+
+    loader = mock.Mock(wraps=mapping._read_mapping_data)
+    with mock.patch.object(mapping, '_read_mapping_data', loader):
+        get = lambda: _with_config(mapping.DCATAPIT_THEMES_MAP, fpath, mapping._load_mapping_data)
+
+        first = get()
+        eq_(dict(first), {'agricoltura': ('AGRI',)})
+        ok_(get() is first)
+        eq_(loader.call_count, 1)
+
+        _touch_later(fpath, json.dumps({'data': [{'syn': ['ECON', 'economia', 'finanze']}]}))
+        eq_(dict(get()), {'economia': ('ECON',), 'finanze': ('ECON',)})
+        eq_(loader.call_count, 2)
+
 @pytest.mark.usefixtures("with_request_context")
 class ValidationTests(TestCase):
 
@@ -242,3 +310,42 @@ class ValidationTests(TestCase):
         theme_uri_list = json.loads(theme)
         self.assertEquals(len(expected_themes), len(theme_uri_list))
         self.assertSetEqual(set(expected_uris), set(theme_uri_list))
+
+
+@pytest.mark.usefixtures("with_request_context")
+class IndexingTests(TestCase):
+
+    def _get_index_dict(self, org_id):
+        return {
+            'type': 'dataset',
+            'owner_org': org_id,
+            f'extras_{FIELD_THEMES_AGGREGATE}': themes_to_aggr_json(['ECON']),
+            'data_dict': json.dumps({'resources': [{'license_type': 'https://w3id.org/italia/controlled-vocabulary/licences/A21_CCBY40'}]}),
+        }
+
+    def test_before_index_memo(self):
+        org = factories.Organization(identifier=uuid4().hex, is_org=True, name=uuid4().hex)
+
+        # warm up
+        out = package_plugin.before_index(self._get_index_dict(org['id']))
+        eq_(out['holder_name'], org['title'])
+
+        queries = []
+
+        def _count(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        event.listen(meta.engine, 'before_cursor_execute', _count)
+        try:
+            for _ in range(10):
+                out = package_plugin.before_index(self._get_index_dict(org['id']))
+        finally:
+            event.remove(meta.engine, 'before_cursor_execute', _count)
+
+        eq_(queries, [])
+        eq_(out['holder_identifier'], org['identifier'])
+
+        # editing the organization drops the memoized info
+        call_action('organization_patch', id=org['id'], title='new title')
+        out = package_plugin.before_index(self._get_index_dict(org['id']))
+        eq_(out['holder_name'], 'new title')
@@ -1,11 +1,21 @@
 import json
+import logging
+import time
 from builtins import Exception
 
 import nose
 import pytest
 from unittest import TestCase
 
+from ckan import model
+from ckan.model.meta import Session
+from ckan.model.types import make_uuid
+
 import ckanext.dcatapit.validators as validators
+from ckanext.dcatapit.model import IDENTIFIER_INDEX, setup_identifier_index
+from ckanext.dcatapit.tests.utils import benchmark
+
+log = logging.getLogger(__name__)
 
 eq_ = nose.tools.eq_
 ok_ = nose.tools.ok_
@@ -183,3 +193,58 @@ class ValidationTests(TestCase):
             if passed != should_pass:
                 self.fail(f'{name} validation failed for value IN::{test_val}:: OUT::{value} : '
                           f'{"expected error, but got no validation error" if passed else ""}')
+
+
+class IdentifierUniqueTests(TestCase):
+
+    DATASETS = 100000
+
+    def setUp(self):
+        setup_identifier_index()
+
+    def tearDown(self):
+        Session.rollback()
+
+    def _create_datasets(self, count):
+        packages = []
+        extras = []
+        for idx in range(count):
+            pkg_id = make_uuid()
+            packages.append({'id': pkg_id, 'name': f'id-unique-{idx}', 'type': 'dataset', 'state': 'active'})
+            extras.append({'id': make_uuid(), 'package_id': pkg_id, 'key': 'identifier',
+                           'value': f'id-unique:{idx}', 'state': 'active'})
+        Session.execute(model.package_table.insert(), packages)
+        Session.execute(model.package_extra_table.insert(), extras)
+        Session.execute('ANALYZE package_extra')
+        return packages
+
+    def test_id_unique(self):
+        packages = self._create_datasets(10)
+        context = {'model': model, 'session': Session}
+
+        eq_(validators.dcatapit_id_unique('id-unique:new', context), 'id-unique:new')
+        with self.assertRaises(validators.Invalid):
+            validators.dcatapit_id_unique('id-unique:3', context)
+
+        # the dataset being updated can keep its own identifier
+        context['package'] = model.Package.get(packages[3]['id'])
+        eq_(validators.dcatapit_id_unique('id-unique:3', context), 'id-unique:3')
+        with self.assertRaises(validators.Invalid):
+            validators.dcatapit_id_unique('id-unique:4', context)
+
+    @benchmark
+    def test_id_unique_benchmark(self):
+        self._create_datasets(self.DATASETS)
+        context = {'model': model, 'session': Session}
+
+        plan = '\n'.join(r[0] for r in Session.execute(
+            "EXPLAIN SELECT 1 FROM package_extra "
+            "WHERE key = 'identifier' AND md5(value) = md5('id-unique:1') AND value = 'id-unique:1'"))
+        ok_(IDENTIFIER_INDEX in plan, plan)
+
+        checks = 1000
+        start = time.perf_counter()
+        for idx in range(checks):
+            validators.dcatapit_id_unique(f'id-unique:new-{idx}', context)
+        elapsed = time.perf_counter() - start
+        log.info(f'{checks} identifier checks on {self.DATASETS} datasets in {elapsed:.3f}s')
@@ -1,5 +1,7 @@
 
 import os
+
+import pytest
 from rdflib import Graph
 
 from ckan.model import meta, Tag, Vocabulary
@@ -17,6 +19,11 @@ MAPPING_FILE = 'theme-subtheme-mapping.rdf'
 EUROVOC_FILE = 'eurovoc_filtered.rdf'
 LICENSES_FILE = 'licences.rdf'
 
+# benchmarks on large generated data run only when requested
+BENCHMARK_ENV = 'DCATAPIT_BENCHMARK'
+benchmark = pytest.mark.skipif(os.environ.get(BENCHMARK_ENV, '').lower() not in ('1', 'true', 'yes'),
+                               reason=f'set {BENCHMARK_ENV}=1 to run the benchmarks')
+
 
 def _get_base_file(fname, dir_name):
     return os.path.join(os.path.dirname(__file__),
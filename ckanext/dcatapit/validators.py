@@ -6,7 +6,7 @@ from ckan.common import _, config
 from ckan.lib.i18n import get_locales
 from ckan.logic.validators import url_validator
 from ckan.plugins.toolkit import Invalid
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 
 from ckanext.dcatapit.mapping import themes_to_aggr_json, themes_parse_to_uris
 from ckanext.dcatapit.model.subtheme import Subtheme
@@ -42,29 +42,22 @@ def dcatapit_id_unique(value, context):
     model = context['model']
     session = context['session']
 
+    # md5 condition matches the dcatapit_package_extra_identifier_idx index,
+    # so that this is a single index lookup
+    q = session.query(model.PackageExtra.package_id)\
+               .join(model.Package, and_(model.PackageExtra.package_id == model.Package.id,
+                                         model.Package.type == 'dataset',
+                                         model.Package.state == 'active'))\
+               .filter(model.PackageExtra.key == 'identifier',
+                       func.md5(model.PackageExtra.value) == func.md5(value),
+                       model.PackageExtra.value == value)
+
     package = context.get('package', None)
     if package:
-        package_id = package.id
-
         # existing dataset, exclude current one from search
-        result = session.query(model.PackageExtra)\
-                        .join(model.Package, and_(model.PackageExtra.package_id == model.Package.id,
-                                                  model.Package.type == 'dataset',
-                                                  model.Package.state == 'active'))\
-                        .filter(model.PackageExtra.package_id != package_id,
-                                model.PackageExtra.key == 'identifier',
-                                model.PackageExtra.value == value)\
-                        .first()
-    else:
-        # no package in context, so this is new dataset, no exclude here
-        # just search among live datasets
-        result = session.query(model.PackageExtra)\
-                        .join(model.Package, and_(model.PackageExtra.package_id == model.Package.id,
-                                                  model.Package.type == 'dataset',
-                                                  model.Package.state == 'active'))\
-                        .filter(model.PackageExtra.key == 'identifier',
-                                model.PackageExtra.value == value)\
-                        .first()
+        q = q.filter(model.PackageExtra.package_id != package.id)
+
+    result = q.first()
 
     if result is not None:
         raise Invalid(_('Another package exists with the same identifier'))
@@ -476,7 +469,7 @@ def dcatapit_subthemes(key, flattened_data, errors, context):
         theme_name = aggr['theme']
         subthemes = aggr.get('subthemes') or []
         try:
-            slist = [s.uri for s in Subtheme.for_theme(theme_name)]
+            slist = Subtheme.get_tree().uris_for_theme(theme_name)
         except ValueError:
             raise Invalid(_('Invalid theme {}'.format(theme_name)))
 